@@ -1,7 +1,11 @@
 from __future__ import unicode_literals
+import base64
+import binascii
+import json
 from collections import OrderedDict
 
-from rest_framework import pagination
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions, pagination
 from rest_framework.response import Response
 from rest_framework.utils.urls import remove_query_param, replace_query_param
 
@@ -51,3 +55,99 @@ class UnlimitedLinkHeaderPagination(LinkHeaderPagination):
     Should be used only as a temporary workaround!
     """
     page_size = None
+
+
+class LinkHeaderCursorPagination(pagination.CursorPagination):
+    """
+    Keyset paginator for large tables: page is selected by the position of the last object
+    of previous page instead of offset, so deep pages are as cheap as the first one.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 300
+    ordering = 'pk'
+
+    def get_page_size(self, request):
+        # Cursor paginator of DRF 3.6 does not support page size query parameter.
+        try:
+            return pagination._positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_paginated_response(self, data):
+        link_candidates = OrderedDict((
+            ('prev', self.get_previous_link),
+            ('next', self.get_next_link),
+        ))
+
+        link = ', '.join(
+            '<%s>; rel="%s"' % (get_link(), rel)
+            for rel, get_link in link_candidates.items()
+            if get_link()
+        )
+
+        return Response(data, headers={'Link': link})
+
+
+class LinkHeaderSearchAfterPagination(pagination.BasePagination):
+    """
+    Cursor paginator for search results that support search_after paging, for example, Elasticsearch events.
+    Result list should implement method get_page_after(search_after, size) that returns
+    dictionary with page items in 'events' and sort values of the last item in 'search_after'.
+
+    Cursor is an opaque encoding of sort values of the last item of previous page.
+    Only link to the next page is provided.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = pagination.api_settings.PAGE_SIZE
+    max_page_size = 300
+    invalid_cursor_message = _('Invalid cursor.')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page = queryset.get_page_after(
+            search_after=self.decode_cursor(request),
+            size=self.get_page_size(request),
+        )
+        self.search_after = page['search_after']
+        return page['events']
+
+    def get_page_size(self, request):
+        try:
+            return pagination._positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            search_after = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, binascii.Error):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        if not isinstance(search_after, list):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        return search_after
+
+    def encode_cursor(self, search_after):
+        return base64.urlsafe_b64encode(json.dumps(search_after).encode('utf-8')).decode('ascii')
+
+    def get_next_link(self):
+        if self.search_after is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.search_after))
+
+    def get_paginated_response(self, data):
+        next_link = self.get_next_link()
+        link = '<%s>; rel="next"' % next_link if next_link else ''
+        return Response(data, headers={'Link': link})
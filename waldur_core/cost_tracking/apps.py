@@ -29,6 +29,21 @@ class CostTrackingConfig(AppConfig):
                 dispatch_uid='waldur_core.cost_tracking.resource_update_%s_%s' % (model.__name__, index),
             )
 
+        signals.m2m_changed.connect(
+            handlers.update_price_estimate_links,
+            sender=PriceEstimate.parents.through,
+            dispatch_uid='waldur_core.cost_tracking.handlers.update_price_estimate_links',
+        )
+
+        for model in (self.get_model('DefaultPriceListItem'), self.get_model('PriceListItem')):
+            for signal, signal_name in ((signals.post_save, 'post_save'), (signals.post_delete, 'post_delete')):
+                signal.connect(
+                    handlers.clean_price_list_index,
+                    sender=model,
+                    dispatch_uid='waldur_core.cost_tracking.handlers.clean_price_list_index_%s_%s' % (
+                        model.__name__, signal_name),
+                )
+
         signals.post_save.connect(
             handlers.resource_quota_update,
             sender=quotas_models.Quota,
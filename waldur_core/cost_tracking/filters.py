@@ -63,12 +63,9 @@ class PriceEstimateCustomerFilterBackend(filters.BaseFilterBackend):
         except structure_models.Customer.DoesNotExist:
             return queryset.none()
 
-        ids = []
-        for estimate in models.PriceEstimate.objects.filter(scope=customer):
-            ids.append(estimate.pk)
-            for child in estimate.collect_children():
-                ids.append(child.pk)
-        return queryset.filter(pk__in=ids)
+        estimates = models.PriceEstimate.objects.filter(scope=customer)
+        descendants = models.PriceEstimateLink.objects.filter(ancestor__in=estimates)
+        return queryset.filter(Q(pk__in=estimates.values('pk')) | Q(pk__in=descendants.values('descendant_id')))
 
 
 class PriceListItemServiceFilterBackend(core_filters.GenericKeyFilterBackend):
@@ -7,7 +7,7 @@ from dateutil.relativedelta import relativedelta
 from django.utils import timezone
 
 from waldur_core.core import utils as core_utils
-from waldur_core.cost_tracking import models, CostTrackingRegister, ResourceNotRegisteredError
+from waldur_core.cost_tracking import models, price_list, CostTrackingRegister, ResourceNotRegisteredError
 from waldur_core.structure import models as structure_models
 
 logger = logging.getLogger(__name__)
@@ -39,8 +39,11 @@ def _resource_unlink(resource):
     if resource.__class__ not in CostTrackingRegister.registered_resources:
         return
     for price_estimate in models.PriceEstimate.objects.filter(scope=resource):
-        price_estimate.update_ancestors_total(diff=-price_estimate.total)
+        ancestors_ids = [ancestor.pk for ancestor in price_estimate.get_ancestors()]
+        models.PriceEstimate.objects.filter(children=price_estimate).update(is_dirty=True)
         price_estimate.delete()
+        models.PriceEstimate.objects.update_total_from_descendants(
+            models.PriceEstimate.objects.filter(pk__in=ancestors_ids))
 
 
 def _customer_deletion(customer):
@@ -58,6 +61,26 @@ def _resource_deletion(resource):
     price_estimate.init_details()
 
 
+def update_price_estimate_links(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Store ancestry of price estimates in closure table when parents are added or removed. """
+    if action == 'post_add':
+        for pk in pk_set:
+            parent_id, child_id = (instance.pk, pk) if reverse else (pk, instance.pk)
+            models.PriceEstimateLink.objects.link(parent_id, child_id)
+    elif action in ('post_remove', 'post_clear'):
+        # Closure table is not changed yet, so it still contains the whole affected subtree.
+        descendants_ids = set(models.PriceEstimateLink.objects.filter(
+            ancestor_id=instance.pk).values_list('descendant_id', flat=True))
+        if not reverse:
+            descendants_ids.add(instance.pk)
+        models.PriceEstimateLink.objects.rebuild(descendants_ids)
+
+
+def clean_price_list_index(sender, **kwargs):
+    """ Invalidate cached price list index when price list items are changed. """
+    price_list.clean_price_list_index()
+
+
 def _is_in_celery_task():
     """ Return True if current code is executed in celery task """
     return bool(current_task)
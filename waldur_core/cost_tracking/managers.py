@@ -3,13 +3,14 @@ import datetime
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models as django_models
-from django.db.models import Q
+from django.db.models import FloatField, OuterRef, Q, Subquery, Sum, Value, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from waldur_core.core import utils as core_utils
 from waldur_core.core.managers import GenericKeyMixin
 from waldur_core.structure.managers import filter_queryset_for_user
-from waldur_core.structure.models import Service
+from waldur_core.structure.models import ResourceMixin, Service
 
 
 # TODO: This mixin duplicates quota filter manager - they need to be moved to core (NC-686)
@@ -53,6 +54,74 @@ class PriceEstimateManager(GenericKeyMixin, UserFilterMixin, django_models.Manag
         now = timezone.now()
         return self.filter(year=now.year, month=now.month)
 
+    def update_total_from_descendants(self, queryset):
+        """ Set total of each estimate in queryset to the sum of its resources descendants totals.
+
+            Totals are aggregated with GROUP BY subquery of single UPDATE query.
+        """
+        from waldur_core.cost_tracking.models import PriceEstimateLink
+        resource_content_types = ContentType.objects.get_for_models(*ResourceMixin.get_all_models()).values()
+        totals = (PriceEstimateLink.objects
+                  .filter(ancestor=OuterRef('pk'), descendant__content_type__in=resource_content_types)
+                  .order_by()
+                  .values('ancestor')
+                  .annotate(total=Sum('descendant__total'))
+                  .values('total'))
+        return queryset.update(total=Coalesce(Subquery(totals, output_field=FloatField()), Value(0)))
+
+
+class PriceEstimateLinkManager(django_models.Manager):
+
+    def link(self, parent_id, child_id):
+        """ Link child estimate with its descendants to parent estimate with its ancestors. """
+        ancestors = dict(self.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth'))
+        ancestors[parent_id] = 0
+        descendants = dict(self.filter(ancestor_id=child_id).values_list('descendant_id', 'depth'))
+        descendants[child_id] = 0
+
+        existing = {(ancestor_id, descendant_id): depth for ancestor_id, descendant_id, depth in self.filter(
+            ancestor_id__in=ancestors.keys(), descendant_id__in=descendants.keys()).values_list(
+            'ancestor_id', 'descendant_id', 'depth')}
+        links = []
+        for ancestor_id, ancestor_depth in ancestors.items():
+            for descendant_id, descendant_depth in descendants.items():
+                depth = ancestor_depth + descendant_depth + 1
+                key = (ancestor_id, descendant_id)
+                if key not in existing:
+                    links.append(self.model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth))
+                elif existing[key] > depth:
+                    self.filter(ancestor_id=ancestor_id, descendant_id=descendant_id).update(depth=depth)
+        if links:
+            self.bulk_create(links)
+
+    def rebuild(self, estimates_ids):
+        """ Rebuild links of given estimates subtree to estimates outside of it.
+
+            Links are restored from current parents of subtree estimates, so it is
+            used when parents are removed and ancestors of subtree could be changed.
+        """
+        from waldur_core.cost_tracking.models import PriceEstimate
+        estimates_ids = set(estimates_ids)
+        if not estimates_ids:
+            return
+        self.filter(descendant_id__in=estimates_ids).exclude(ancestor_id__in=estimates_ids).delete()
+        field = PriceEstimate._meta.get_field('parents')
+        child_field, parent_field = field.m2m_column_name(), field.m2m_reverse_name()
+        parents = field.remote_field.through.objects.filter(**{child_field + '__in': estimates_ids}).exclude(
+            **{parent_field + '__in': estimates_ids}).values_list(parent_field, child_field)
+        for parent_id, child_id in parents:
+            self.link(parent_id, child_id)
+
+    def prefetch_children(self, estimates, depth):
+        """ Populate children of estimates and of their descendants up to given depth.
+
+            Children are prefetched with one query per level, so serialization of
+            estimates tree does not query children of each estimate separately.
+        """
+        if depth <= 0 or not estimates:
+            return
+        prefetch_related_objects(list(estimates), '__'.join(['children'] * depth))
+
 
 class ConsumptionDetailsQuerySet(django_models.QuerySet):
 
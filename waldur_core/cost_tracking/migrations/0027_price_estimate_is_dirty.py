@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 20:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cost_tracking', '0026_remove_limit_threshold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='priceestimate',
+            name='is_dirty',
+            field=models.BooleanField(default=True, help_text='Consumed price should be recalculated because estimate or its children have changed.'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 21:01
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_price_estimate_links(apps, schema_editor):
+    PriceEstimate = apps.get_model('cost_tracking', 'PriceEstimate')
+    PriceEstimateLink = apps.get_model('cost_tracking', 'PriceEstimateLink')
+
+    parents = defaultdict(set)
+    for child_id, parent_id in PriceEstimate.parents.through.objects.values_list(
+            'from_priceestimate_id', 'to_priceestimate_id'):
+        parents[child_id].add(parent_id)
+
+    links = []
+    for estimate_id in parents:
+        # breadth-first search finds the shortest path to each ancestor
+        depths = {}
+        level, depth = parents[estimate_id], 1
+        while level:
+            next_level = set()
+            for ancestor_id in level:
+                if ancestor_id not in depths:
+                    depths[ancestor_id] = depth
+                    next_level |= parents.get(ancestor_id, set())
+            level, depth = next_level, depth + 1
+        links.extend(PriceEstimateLink(ancestor_id=ancestor_id, descendant_id=estimate_id, depth=depth)
+                     for ancestor_id, depth in depths.items())
+    PriceEstimateLink.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cost_tracking', '0027_price_estimate_is_dirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceEstimateLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='cost_tracking.PriceEstimate')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='cost_tracking.PriceEstimate')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='priceestimatelink',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='priceestimatelink',
+            index_together=set([('ancestor', 'depth')]),
+        ),
+        migrations.RunPython(fill_price_estimate_links),
+    ]
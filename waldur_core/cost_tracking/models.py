@@ -20,7 +20,7 @@ from model_utils.models import TimeStampedModel
 
 from waldur_core.core import models as core_models, utils as core_utils
 from waldur_core.core.fields import JSONField
-from waldur_core.cost_tracking import managers, ConsumableItem
+from waldur_core.cost_tracking import consumption, managers, price_list, ConsumableItem
 from waldur_core.logging.loggers import LoggableMixin
 from waldur_core.structure import models as structure_models, SupportedServices
 
@@ -55,6 +55,8 @@ class PriceEstimate(LoggableMixin, core_models.UuidMixin, core_models.Descendant
 
     month = models.PositiveSmallIntegerField(validators=[MaxValueValidator(12), MinValueValidator(1)])
     year = models.PositiveSmallIntegerField()
+    is_dirty = models.BooleanField(
+        default=True, help_text=_('Consumed price should be recalculated because estimate or its children have changed.'))
 
     objects = managers.PriceEstimateManager('scope')
 
@@ -106,6 +108,12 @@ class PriceEstimate(LoggableMixin, core_models.UuidMixin, core_models.Descendant
             if created:
                 parent.create_ancestors()
 
+    def get_ancestors(self):  # Overrides DescendantMixin, ancestors are fetched from closure table
+        return list(PriceEstimate.objects.filter(descendant_links__descendant=self))
+
+    def get_descendants(self):  # Overrides DescendantMixin, descendants are fetched from closure table
+        return list(PriceEstimate.objects.filter(ancestor_links__ancestor=self))
+
     def init_details(self):
         """ Initialize price estimate details based on its scope """
         self.details = {
@@ -125,17 +133,16 @@ class PriceEstimate(LoggableMixin, core_models.UuidMixin, core_models.Descendant
         """
         self._check_is_updatable()
         new_total = self._get_price(self.consumption_details.consumed_in_month)
-        diff = new_total - self.total
         with transaction.atomic():
             self.total = new_total
             self.save(update_fields=['total'])
             if update_ancestors:
-                self.update_ancestors_total(diff, raise_exception=raise_exception)
+                self.update_ancestors_total(raise_exception=raise_exception)
 
-    def update_ancestors_total(self, diff, raise_exception=False):
-        for ancestor in self.get_ancestors():
-            ancestor.total += diff
-            ancestor.save(update_fields=['total'])
+    def update_ancestors_total(self, raise_exception=False):
+        """ Re-aggregate total of all estimate ancestors with one UPDATE query. """
+        PriceEstimate.objects.update_total_from_descendants(
+            PriceEstimate.objects.filter(descendant_links__descendant=self))
 
     def update_consumed(self):
         """ Re-calculate price of resource until now. Does not update ancestors. """
@@ -167,15 +174,7 @@ class PriceEstimate(LoggableMixin, core_models.UuidMixin, core_models.Descendant
         """ Calculate price estimate for scope depends on consumed data and price list items.
             Map each consumable to price list item and multiply price its price by time of usage.
         """
-        price_list_items = PriceListItem.get_for_resource(self.scope)
-        consumables_prices = {(item.item_type, item.key): item.minute_rate for item in price_list_items}
-        total = 0
-        for consumable_item, usage in consumed.items():
-            try:
-                total += consumables_prices[(consumable_item.item_type, consumable_item.key)] * usage
-            except KeyError:
-                logger.error('Price list item for consumable "%s" does not exist.' % consumable_item)
-        return total
+        return consumption.get_price(consumed, price_list.get_resource_prices(self.scope))
 
     def _check_is_updatable(self):
         """ Raise error if price estimate does not have consumption details or
@@ -218,6 +217,24 @@ class PriceEstimate(LoggableMixin, core_models.UuidMixin, core_models.Descendant
         return price_estimate
 
 
+class PriceEstimateLink(models.Model):
+    """ Closure table of price estimates hierarchy.
+
+        Each estimate is linked to all its ancestors, depth is a length of the shortest
+        path between them. So ancestors, descendants or a depth-limited subtree of
+        estimate are fetched with one indexed query.
+    """
+    ancestor = models.ForeignKey(PriceEstimate, related_name='descendant_links')
+    descendant = models.ForeignKey(PriceEstimate, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
+
+    objects = managers.PriceEstimateLinkManager()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        index_together = ('ancestor', 'depth')
+
+
 class ConsumptionDetailUpdateError(Exception):
     pass
 
@@ -296,13 +313,12 @@ class ConsumptionDetails(core_models.UuidMixin, TimeStampedModel):
         if now.month != self.price_estimate.month:
             raise ConsumptionDetailUpdateError('It is possible to update consumption details only for current month.')
         minutes_from_last_update = self._get_minutes_from_last_update(now)
-        for consumable_item, usage in self.configuration.items():
-            consumed_after_modification = usage * minutes_from_last_update
-            self.consumed_before_update[consumable_item] = (
-                self.consumed_before_update.get(consumable_item, 0) + consumed_after_modification)
+        batch = consumption.ConsumptionBatch([self])
+        self.consumed_before_update = batch.get_consumed_items([minutes_from_last_update])[0]
         self.configuration = new_configuration
         self.last_update_time = now
         self.save()
+        PriceEstimate.objects.filter(pk=self.price_estimate_id).update(is_dirty=True)
         return True
 
     @property
@@ -321,17 +337,11 @@ class ConsumptionDetails(core_models.UuidMixin, TimeStampedModel):
         minutes_from_last_update = self._get_minutes_from_last_update(time)
         if minutes_from_last_update < 0:
             raise ConsumptionDetailCalculateError('Cannot calculate consumption if time < last modification date.')
-        _consumed = {}
-        for consumable_item in set(self.configuration.keys() + self.consumed_before_update.keys()):
-            after_update = self.configuration.get(consumable_item, 0) * minutes_from_last_update
-            before_update = self.consumed_before_update.get(consumable_item, 0)
-            _consumed[consumable_item] = after_update + before_update
-        return _consumed
+        return consumption.ConsumptionBatch([self]).get_consumed_items([minutes_from_last_update])[0]
 
     def _get_minutes_from_last_update(self, time):
         """ How much minutes passed from last update to given time """
-        time_from_last_update = time - self.last_update_time
-        return int(time_from_last_update.total_seconds() / 60)
+        return consumption.get_minutes_from_last_update(time, self.last_update_time)
 
 
 class AbstractPriceListItem(models.Model):
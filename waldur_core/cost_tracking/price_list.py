@@ -0,0 +1,103 @@
+""" Resolution of price list items for resources.
+
+Instead of querying default and service price list items for each resource, all items
+are loaded once and cached as an index of minute rates:
+
+    {
+        'defaults': {resource content type id: {(item type, key): minute rate}},
+        'services': {(resource content type id, service key): {(item type, key): minute rate}},
+    }
+
+Service key is a pair (service content type id, service id). Service price list item
+overrides default item with the same resource content type, item type and key.
+
+Index is invalidated when default or service price list items are changed.
+Long running jobs could keep index in memory, so cache is not queried for each resource:
+
+    with price_list_run():
+        for price_estimate in estimates:
+            price_estimate.update_consumed()
+"""
+from __future__ import unicode_literals
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+
+PRICE_LIST_CACHE_KEY = 'cost_tracking_price_list_index'
+PRICE_LIST_CACHE_TIMEOUT = 60 * 60
+
+_locals = threading.local()
+
+
+def build_price_list_index():
+    from waldur_core.cost_tracking.models import DefaultPriceListItem, PriceListItem
+
+    defaults = defaultdict(dict)
+    for item in DefaultPriceListItem.objects.only('resource_content_type', 'item_type', 'key', 'value'):
+        defaults[item.resource_content_type_id][(item.item_type, item.key)] = item.minute_rate
+
+    services = defaultdict(dict)
+    for item in PriceListItem.objects.select_related('default_price_list_item').only(
+            'content_type', 'object_id', 'value', 'default_price_list_item__resource_content_type',
+            'default_price_list_item__item_type', 'default_price_list_item__key'):
+        default_item = item.default_price_list_item
+        service_key = (item.content_type_id, item.object_id)
+        services[(default_item.resource_content_type_id, service_key)][
+            (default_item.item_type, default_item.key)] = item.minute_rate
+
+    return {
+        'defaults': dict(defaults),
+        'services': dict(services),
+    }
+
+
+def get_price_list_index():
+    index = getattr(_locals, 'index', None)
+    if index is not None:
+        return index
+    index = cache.get(PRICE_LIST_CACHE_KEY)
+    if index is None:
+        index = build_price_list_index()
+        cache.set(PRICE_LIST_CACHE_KEY, index, PRICE_LIST_CACHE_TIMEOUT)
+    return index
+
+
+def clean_price_list_index():
+    cache.delete(PRICE_LIST_CACHE_KEY)
+    # Concurrent task could cache index before transaction is committed.
+    transaction.on_commit(lambda: cache.delete(PRICE_LIST_CACHE_KEY))
+
+
+def get_service_key(resource):
+    """ Return (service content type id, service id) without fetching service itself. """
+    spl = resource.service_project_link
+    service_model = spl._meta.get_field('service').related_model
+    return ContentType.objects.get_for_model(service_model).id, spl.service_id
+
+
+def get_resource_prices(resource, index=None):
+    """ Return dictionary {(item type, key): minute rate} of price list items that should be used for resource. """
+    if index is None:
+        index = get_price_list_index()
+    content_type_id = ContentType.objects.get_for_model(resource).id
+    prices = dict(index['defaults'].get(content_type_id, {}))
+    prices.update(index['services'].get((content_type_id, get_service_key(resource)), {}))
+    return prices
+
+
+@contextmanager
+def price_list_run():
+    """ Load price list index once and use it inside the block. Nested calls reuse loaded index. """
+    if getattr(_locals, 'index', None) is not None:
+        yield
+        return
+    _locals.index = get_price_list_index()
+    try:
+        yield
+    finally:
+        _locals.index = None
@@ -0,0 +1,280 @@
+""" Change-driven recalculation of current month price estimates.
+
+Estimate is marked dirty when it is created, when configuration of its resource is
+changed or when one of its children is removed. Consumed price of resource with
+non-empty configuration grows with time, so such estimates are recalculated on each
+run too, while estimates of idle resources are skipped until they are marked dirty again.
+
+Consumed prices of resources are computed in batches of consumption details.
+Ancestors are re-aggregated only if they are dirty or consumed price of at least one of
+their resource descendants has changed. Ancestor chains are fetched from closure table,
+consumed price of ancestor is a sum of consumed prices of its resource descendants
+computed with GROUP BY query. Changed values are written with bulk UPDATE queries.
+
+Full recalculation of all estimates stays available as a periodic reconciliation.
+
+Resources of each model could be split into shards by ranges of ids, so shards are
+recalculated in parallel and ancestors are re-aggregated once all shards are finished.
+"""
+from __future__ import unicode_literals
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Case, FloatField, Q, Sum, Value, When
+from django.utils import timezone
+
+from waldur_core.cost_tracking import CostTrackingRegister, consumption, models, price_list
+
+BATCH_SIZE = 500
+SHARD_SIZE = 5000
+
+
+def _chunks(items, size=None):
+    size = size or BATCH_SIZE
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_resource_models():
+    """ Return dictionary {content type id: model} of registered resources. """
+    return {ContentType.objects.get_for_model(model).id: model
+            for model in CostTrackingRegister.registered_resources}
+
+
+def create_missing_estimates(resource_model, resources=None):
+    """ Create current estimates for resources that do not have them yet. """
+    if resources is None:
+        resources = resource_model.objects.all()
+    content_type = ContentType.objects.get_for_model(resource_model)
+    existing = models.PriceEstimate.objects.filter_current().filter(content_type=content_type)
+    for resource in resources.exclude(pk__in=existing.values('object_id')):
+        price_estimate, created = models.PriceEstimate.objects.get_or_create_current(scope=resource)
+        if created:
+            models.ConsumptionDetails.objects.create(price_estimate=price_estimate)
+            price_estimate.create_ancestors()
+            price_estimate.update_total()
+
+
+def pop_dirty_estimates(queryset=None):
+    """ Return ids of dirty current estimates and reset their flag.
+
+        Flag is reset before recalculation, so estimates that are marked dirty
+        concurrently will be processed by the next run.
+    """
+    if queryset is None:
+        queryset = models.PriceEstimate.objects.filter_current()
+    dirty_ids = set(queryset.filter(is_dirty=True).values_list('pk', flat=True))
+    for chunk in _chunks(dirty_ids):
+        models.PriceEstimate.objects.filter(pk__in=chunk).update(is_dirty=False)
+    return dirty_ids
+
+
+def mark_dirty(estimates_ids):
+    """ Return dirty flag to estimates which recalculation has failed. """
+    for chunk in _chunks(estimates_ids):
+        models.PriceEstimate.objects.filter(pk__in=chunk).update(is_dirty=True)
+
+
+def mark_ancestors_dirty(estimates_ids):
+    """ Mark ancestors of given estimates dirty, so they are re-aggregated by the next run. """
+    for chunk in _chunks(estimates_ids):
+        ancestors_ids = models.PriceEstimateLink.objects.filter(descendant_id__in=chunk).values('ancestor_id')
+        models.PriceEstimate.objects.filter(pk__in=ancestors_ids).update(is_dirty=True)
+
+
+def get_ancestors(resource_models):
+    """ Return current estimates that are not estimates of existing registered resources. """
+    return models.PriceEstimate.objects.filter_current().exclude(get_leaves_query(resource_models))
+
+
+def get_leaves_query(resource_models, prefix=''):
+    """ Filter estimates of existing registered resources. """
+    query = Q()
+    for content_type_id, model in resource_models.items():
+        query |= Q(**{prefix + 'content_type_id': content_type_id,
+                      prefix + 'object_id__in': model.objects.values('pk')})
+    return query
+
+
+def recalculate_leaves(resource_models, dirty_ids, leaves=None, full=False, progress=None):
+    """ Recalculate consumed price of dirty and consuming resources estimates.
+
+        leaves - current resources estimates that should be processed, by default all of them.
+        full - recalculate all leaves, not only dirty and consuming ones.
+        progress - function that is called with numbers of processed and all leaves after each batch.
+
+        Return ids of estimates which consumed price has changed.
+    """
+    if leaves is None:
+        if not resource_models:
+            return set()
+        leaves = models.PriceEstimate.objects.filter_current().filter(get_leaves_query(resource_models))
+    leaves = leaves.filter(consumption_details__isnull=False)
+    if full:
+        leaves_ids = set(leaves.values_list('pk', flat=True))
+    else:
+        leaves_ids = set(leaves.exclude(consumption_details__configuration={}).values_list('pk', flat=True))
+        for chunk in _chunks(dirty_ids):
+            leaves_ids.update(leaves.filter(pk__in=chunk).values_list('pk', flat=True))
+
+    now = timezone.now()
+    changed_ids = set()
+    done = 0
+    for chunk in _chunks(leaves_ids):
+        values = compute_consumed(models.PriceEstimate.objects.filter(pk__in=chunk), now)
+        changed_ids |= write_consumed(values)
+        changed_ids |= set(chunk) & dirty_ids
+        done += len(chunk)
+        if progress is not None:
+            progress(done, len(leaves_ids))
+    return changed_ids
+
+
+def compute_consumed(estimates, time):
+    """ Return dictionary {estimate id: consumed price until given time} for resources estimates.
+
+        Consumption details of all estimates are processed as one batch, result is the same
+        as if PriceEstimate.update_consumed is called for each estimate.
+    """
+    estimates = list(estimates.select_related('consumption_details').prefetch_related(
+        'scope__service_project_link'))
+    batch = consumption.ConsumptionBatch([estimate.consumption_details for estimate in estimates])
+    minutes = batch.get_minutes(time)
+    if any(value < 0 for value in minutes):
+        raise models.ConsumptionDetailCalculateError(
+            'Cannot calculate consumption if time < last modification date.')
+    prices = [price_list.get_resource_prices(estimate.scope) for estimate in estimates]
+    totals = batch.get_prices(minutes, prices)
+    return {estimate.pk: total for estimate, total in zip(estimates, totals)}
+
+
+def recalculate_ancestors(resource_models, changed_ids, dirty_ids):
+    """ Re-aggregate consumed price of ancestors of changed estimates and dirty ancestors.
+
+        Return ids of ancestors which consumed price has changed.
+    """
+    ancestors_ids = set()
+    for chunk in _chunks(changed_ids | dirty_ids):
+        ancestors_ids.update(models.PriceEstimateLink.objects.filter(
+            descendant_id__in=chunk).values_list('ancestor_id', flat=True))
+        dirty_ancestors = models.PriceEstimate.objects.filter(pk__in=set(chunk) & dirty_ids)
+        if resource_models:
+            dirty_ancestors = dirty_ancestors.exclude(content_type_id__in=resource_models.keys())
+        ancestors_ids.update(dirty_ancestors.values_list('pk', flat=True))
+    return aggregate_ancestors(resource_models, ancestors_ids)
+
+
+def aggregate_ancestors(resource_models, ancestors_ids):
+    """ Set consumed price of ancestors to the sum of their resources descendants consumed prices.
+
+        Return ids of ancestors which consumed price has changed.
+    """
+    if not ancestors_ids:
+        return set()
+
+    new_values = dict.fromkeys(ancestors_ids, 0)
+    if resource_models:
+        for chunk in _chunks(ancestors_ids):
+            rows = (models.PriceEstimateLink.objects
+                    .filter(get_leaves_query(resource_models, prefix='descendant__'), ancestor_id__in=chunk)
+                    .order_by()
+                    .values('ancestor_id')
+                    .annotate(consumed=Sum('descendant__consumed'))
+                    .values_list('ancestor_id', 'consumed'))
+            new_values.update(rows)
+    return write_consumed(new_values)
+
+
+def write_consumed(values):
+    """ Write changed consumed prices with bulk UPDATE queries. Return ids of changed estimates. """
+    changed = {}
+    for chunk in _chunks(values):
+        for pk, consumed in models.PriceEstimate.objects.filter(pk__in=chunk).values_list('pk', 'consumed'):
+            if consumed != values[pk]:
+                changed[pk] = values[pk]
+
+    if changed:
+        with transaction.atomic():
+            for chunk in _chunks(changed):
+                whens = [When(pk=pk, then=Value(changed[pk])) for pk in chunk]
+                models.PriceEstimate.objects.filter(pk__in=chunk).update(
+                    consumed=Case(*whens, output_field=FloatField()))
+    return set(changed)
+
+
+def recalculate_dirty():
+    """ Recalculate dirty and consuming resources estimates and their ancestor chains.
+
+        Dirty flags are reset in the same transaction as recalculation, so if it fails
+        nothing is written and flags stay set for the next run.
+    """
+    resource_models = get_resource_models()
+    for model in resource_models.values():
+        create_missing_estimates(model)
+    with transaction.atomic():
+        dirty_ids = pop_dirty_estimates()
+        changed_ids = recalculate_leaves(resource_models, dirty_ids)
+        recalculate_ancestors(resource_models, changed_ids, dirty_ids)
+    return changed_ids
+
+
+def get_shards(resource_model, size=None):
+    """ Split resources of given model to ranges of ids [(min id, max id), ...] with given size. """
+    size = size or SHARD_SIZE
+    ids = resource_model.objects.order_by('pk').values_list('pk', flat=True)
+    return [(chunk[0], chunk[-1]) for chunk in _chunks(ids, size)]
+
+
+def recalculate_shard(resource_model, min_id, max_id, full=False, recalculate_total=False, progress=None):
+    """ Recalculate estimates of resources with ids in given range. Return ids of changed estimates.
+
+        Shard is recalculated in one transaction, so if it fails nothing is written and
+        dirty flags of its estimates stay set. Retry computes all values from scratch
+        and returns all estimates that were changed since the last successful run.
+        Ancestors of changed estimates are marked dirty in the same transaction, so they
+        are re-aggregated even if result of committed shard is lost and it is run again.
+    """
+    content_type = ContentType.objects.get_for_model(resource_model)
+    resources = resource_model.objects.filter(pk__gte=min_id, pk__lte=max_id)
+    # Missing estimates are created outside of transaction, as their ancestors totals are updated.
+    create_missing_estimates(resource_model, resources)
+    leaves = models.PriceEstimate.objects.filter_current().filter(
+        content_type=content_type, object_id__in=resources.values('pk'))
+    with transaction.atomic():
+        dirty_ids = pop_dirty_estimates(leaves)
+        if recalculate_total:
+            for price_estimate in leaves.filter(consumption_details__isnull=False):
+                price_estimate.update_total(update_ancestors=False)
+        changed_ids = recalculate_leaves({content_type.id: resource_model}, dirty_ids, leaves,
+                                         full=full or recalculate_total, progress=progress)
+        mark_ancestors_dirty(changed_ids)
+    return changed_ids
+
+
+def recalculate_shards_ancestors(resource_models, changed_ids, full=False, recalculate_total=False):
+    """ Re-aggregate ancestors once all shards are recalculated. Return ids of changed ancestors.
+
+        Dirty flags of ancestors are reset here and not before shards are started,
+        so they are kept if any shard fails. If aggregation fails, flags are restored
+        and ancestors of changed leaves are marked dirty for the next run.
+    """
+    dirty_ids = pop_dirty_estimates(get_ancestors(resource_models))
+    try:
+        if full or recalculate_total:
+            return recalculate_all_ancestors(resource_models, recalculate_total=recalculate_total)
+        return recalculate_ancestors(resource_models, changed_ids, dirty_ids)
+    except Exception:
+        mark_dirty(dirty_ids)
+        mark_ancestors_dirty(changed_ids)
+        raise
+
+
+def recalculate_all_ancestors(resource_models, recalculate_total=False):
+    """ Re-aggregate consumed price and total of all current ancestors estimates. """
+    ancestors = models.PriceEstimate.objects.filter_current()
+    if resource_models:
+        ancestors = ancestors.exclude(content_type_id__in=resource_models.keys())
+    if recalculate_total:
+        models.PriceEstimate.objects.update_total_from_descendants(ancestors)
+    return aggregate_ancestors(resource_models, set(ancestors.values_list('pk', flat=True)))
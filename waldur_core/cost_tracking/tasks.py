@@ -1,21 +1,42 @@
-from celery import shared_task
+import logging
 
-from waldur_core.cost_tracking import CostTrackingRegister, models
+from celery import chord, shared_task
+from django.apps import apps
+from django.db import DatabaseError
+from django.db.models import Sum
+
+from waldur_core.cost_tracking import CostTrackingRegister, models, price_list, recalculation
 from waldur_core.structure import models as structure_models
 
+logger = logging.getLogger(__name__)
+
 
 @shared_task(name='waldur_core.cost_tracking.recalculate_estimate')
-def recalculate_estimate(recalculate_total=False):
+def recalculate_estimate(recalculate_total=False, full=False):
     """ Recalculate price of consumables that were used by resource until now.
 
         Regular task. It is too expensive to calculate consumed price on each
         request, so we store cached price each hour.
+        By default only dirty and consuming resources estimates are recalculated
+        and only their ancestors are re-aggregated.
+        If full is True - task recalculates all resources and ancestors estimates.
         If recalculate_total is True - task also recalculates total estimate
-        for current month.
+        for current month, it implies full recalculation.
     """
     # Celery does not import server.urls and does not discover cost tracking modules.
     # So they should be discovered implicitly.
     CostTrackingRegister.autodiscover()
+    # Price list items are resolved for each resource, so they are loaded once per run.
+    with price_list.price_list_run():
+        if not full and not recalculate_total:
+            recalculation.recalculate_dirty()
+        else:
+            _recalculate_all(recalculate_total)
+
+
+def _recalculate_all(recalculate_total):
+    # Full recalculation processes all estimates, so their dirty flags are reset beforehand.
+    recalculation.pop_dirty_estimates()
     # Step 1. Recalculate resources estimates.
     for resource_model in CostTrackingRegister.registered_resources:
         for resource in resource_model.objects.all():
@@ -24,9 +45,10 @@ def recalculate_estimate(recalculate_total=False):
     #         object based on its children.
     ancestors_models = [m for m in models.PriceEstimate.get_estimated_models()
                         if not issubclass(m, structure_models.ResourceMixin)]
+    resource_models = recalculation.get_resource_models()
     for model in ancestors_models:
         for ancestor in model.objects.all():
-            _update_ancestor_consumed(ancestor)
+            _update_ancestor_consumed(ancestor, resource_models)
 
 
 def _update_resource_consumed(resource, recalculate_total):
@@ -40,9 +62,86 @@ def _update_resource_consumed(resource, recalculate_total):
     price_estimate.update_consumed()
 
 
-def _update_ancestor_consumed(ancestor):
+def _update_ancestor_consumed(ancestor, resource_models):
     price_estimate, _ = models.PriceEstimate.objects.get_or_create_current(scope=ancestor)
-    resource_descendants = [descendant for descendant in price_estimate.get_descendants()
-                            if isinstance(descendant.scope, structure_models.ResourceMixin)]
-    price_estimate.consumed = sum([descendant.consumed for descendant in resource_descendants])
+    consumed = 0
+    if resource_models:
+        resource_descendants = models.PriceEstimate.objects.filter(
+            recalculation.get_leaves_query(resource_models), ancestor_links__ancestor=price_estimate)
+        consumed = resource_descendants.aggregate(consumed=Sum('consumed'))['consumed'] or 0
+    price_estimate.consumed = consumed
     price_estimate.save(update_fields=['consumed'])
+
+
+@shared_task(name='waldur_core.cost_tracking.schedule_estimate_recalculation')
+def schedule_estimate_recalculation(full=False, recalculate_total=False):
+    """ Recalculate estimates in parallel: resources are split into shards by model and ids range.
+
+        Shards are recalculated by separate tasks in heavy queue, ancestors are
+        re-aggregated by chord callback when all shards are finished. If some shard
+        fails, callback is not executed and all ancestors are marked dirty instead.
+    """
+    CostTrackingRegister.autodiscover()
+    resource_models = recalculation.get_resource_models()
+
+    header = []
+    for model in resource_models.values():
+        for min_id, max_id in recalculation.get_shards(model):
+            header.append(recalculate_estimate_shard.si(model._meta.label, min_id, max_id, full, recalculate_total))
+    callback = aggregate_estimate_ancestors.s(full, recalculate_total)
+    if header:
+        callback.link_error(mark_estimate_ancestors_dirty.si())
+        chord(header)(callback)
+    else:
+        callback.delay([])
+
+
+@shared_task(name='waldur_core.cost_tracking.recalculate_estimate_shard', bind=True, is_heavy_task=True,
+             acks_late=True, max_retries=3, default_retry_delay=60)
+def recalculate_estimate_shard(self, model_label, min_id, max_id, full=False, recalculate_total=False):
+    """ Recalculate estimates of resources of given model with ids in given range.
+
+        Return ids of estimates which consumed price has changed. Task reports
+        progress as PROGRESS state and is retried on database errors.
+    """
+    CostTrackingRegister.autodiscover()
+    resource_model = apps.get_model(model_label)
+
+    def progress(done, total):
+        logger.debug('Recalculated %s of %s %s estimates with ids from %s to %s.',
+                     done, total, model_label, min_id, max_id)
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta={
+                'model': model_label, 'min_id': min_id, 'max_id': max_id, 'done': done, 'total': total})
+
+    try:
+        with price_list.price_list_run():
+            changed_ids = recalculation.recalculate_shard(
+                resource_model, min_id, max_id, full=full, recalculate_total=recalculate_total, progress=progress)
+    except DatabaseError as e:
+        raise self.retry(exc=e)
+    return sorted(changed_ids)
+
+
+@shared_task(name='waldur_core.cost_tracking.aggregate_estimate_ancestors', is_heavy_task=True)
+def aggregate_estimate_ancestors(shards_results, full=False, recalculate_total=False):
+    """ Re-aggregate ancestors estimates after all shards are recalculated. """
+    CostTrackingRegister.autodiscover()
+    resource_models = recalculation.get_resource_models()
+    changed_ids = set()
+    for shard_changed_ids in shards_results:
+        changed_ids.update(shard_changed_ids)
+    recalculation.recalculate_shards_ancestors(
+        resource_models, changed_ids, full=full, recalculate_total=recalculate_total)
+
+
+@shared_task(name='waldur_core.cost_tracking.mark_estimate_ancestors_dirty')
+def mark_estimate_ancestors_dirty():
+    """ Mark all ancestors estimates dirty if sharded recalculation has failed.
+
+        Leaves of successful shards are already written, but their ancestors
+        are not re-aggregated, so they are processed by the next run.
+    """
+    CostTrackingRegister.autodiscover()
+    resource_models = recalculation.get_resource_models()
+    recalculation.get_ancestors(resource_models).update(is_dirty=True)
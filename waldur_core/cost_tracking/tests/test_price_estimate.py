@@ -95,6 +95,26 @@ class PriceEstimateListTest(BaseCostTrackingTest):
         # with visibility depth 1 we do not want to see grandchildren
         self.assertNotIn('children', project_estimate_data)
 
+    def test_estimates_tree_is_fetched_with_one_query_per_level(self):
+        customer_price_estimate = factories.PriceEstimateFactory(scope=self.customer, year=2015, month=7)
+        customer_price_estimate.children.add(self.project_price_estimate)
+        spl_price_estimate = factories.PriceEstimateFactory(scope=self.service_project_link, year=2015, month=7)
+        self.project_price_estimate.children.add(spl_price_estimate)
+
+        with self.assertNumQueries(2):
+            models.PriceEstimateLink.objects.prefetch_children([customer_price_estimate], depth=2)
+        project_estimates = list(customer_price_estimate.children.all())
+        self.assertEqual(project_estimates, [self.project_price_estimate])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(project_estimates[0].children.all()), [spl_price_estimate])
+
+        self.client.force_authenticate(self.users['owner'])
+        response = self.client.get(factories.PriceEstimateFactory.get_url(customer_price_estimate), data={'depth': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        spl_estimate_data = response.data['children'][0]['children'][0]
+        self.assertEqual(spl_estimate_data['uuid'], spl_price_estimate.uuid.hex)
+
 
 class PriceEstimateUpdateTest(BaseCostTrackingTest):
     def setUp(self):
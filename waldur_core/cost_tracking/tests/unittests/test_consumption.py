@@ -0,0 +1,52 @@
+import datetime
+
+from django.test import TestCase
+
+from waldur_core.cost_tracking import consumption, models, ConsumableItem
+
+
+class ConsumptionBatchTest(TestCase):
+
+    def setUp(self):
+        self.time = datetime.datetime(2016, 8, 20, 13, 17, 45)
+        storage = ConsumableItem('storage', '1 MB')
+        ram = ConsumableItem('ram', '1 MB')
+        cores = ConsumableItem('cores', '1 core')
+        flavor = ConsumableItem('flavor', 'small')
+        self.details = [
+            models.ConsumptionDetails(
+                configuration={storage: 10240, ram: 2048, cores: 2},
+                consumed_before_update={storage: 0.1 * 7, flavor: 1.0 / 3},
+                last_update_time=datetime.datetime(2016, 8, 1, 0, 0)),
+            models.ConsumptionDetails(
+                configuration={flavor: 1, storage: 0.3},
+                consumed_before_update={},
+                last_update_time=datetime.datetime(2016, 8, 10, 9, 31, 12)),
+            models.ConsumptionDetails(
+                configuration={},
+                consumed_before_update={ram: 1024 * 60 * 13.7, cores: 2 * 60 * 13.7},
+                last_update_time=datetime.datetime(2016, 8, 15, 7, 0)),
+        ]
+        self.prices = [
+            {('storage', '1 MB'): 0.1 / 60, ('ram', '1 MB'): 0.7 / 60,
+             ('cores', '1 core'): 1.3 / 60, ('flavor', 'small'): 2.9 / 60},
+            {('storage', '1 MB'): 0.2 / 60, ('flavor', 'small'): 3.1 / 60},
+            {('ram', '1 MB'): 0.3 / 60, ('cores', '1 core'): 1.1 / 60},
+        ]
+        self.batch = consumption.ConsumptionBatch(self.details)
+
+    def test_consumed_items_are_equal_to_per_object_computation(self):
+        minutes = self.batch.get_minutes(self.time)
+        expected = [details._get_consumed(self.time) for details in self.details]
+        self.assertEqual(self.batch.get_consumed_items(minutes), expected)
+
+    def test_prices_are_identical_to_per_object_computation(self):
+        minutes = self.batch.get_minutes(self.time)
+        expected = [consumption.get_price(details._get_consumed(self.time), prices)
+                    for details, prices in zip(self.details, self.prices)]
+        self.assertEqual(self.batch.get_prices(minutes, self.prices), expected)
+
+    def test_consumable_without_price_is_skipped(self):
+        prices = [{}, {('flavor', 'small'): 1.0}, {}]
+        minutes = self.batch.get_minutes(self.time)
+        self.assertEqual(self.batch.get_prices(minutes, prices), [0, minutes[1], 0])
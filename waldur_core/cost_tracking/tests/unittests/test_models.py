@@ -108,3 +108,62 @@ class DefaultPriceListItemTest(TransactionTestCase):
         actual = models.DefaultPriceListItem.get_consumable_items_pretty_names(
             price_list_item.resource_content_type, [consumable_item])
         self.assertDictEqual(actual, expected)
+
+
+class PriceEstimateLinkTest(TransactionTestCase):
+
+    def setUp(self):
+        resource = structure_factories.TestNewInstanceFactory()
+        self.spl = resource.service_project_link
+        self.resource_estimate = factories.PriceEstimateFactory(scope=resource, year=2016, month=8)
+        self.resource_estimate.create_ancestors()
+
+    def get_estimate(self, scope):
+        return models.PriceEstimate.objects.get(scope=scope, year=2016, month=8)
+
+    def test_estimate_is_linked_to_all_ancestors(self):
+        links = models.PriceEstimateLink.objects.filter(descendant=self.resource_estimate)
+        depths = {link.ancestor.scope: link.depth for link in links}
+        self.assertEqual(depths, {
+            self.spl: 1,
+            self.spl.project: 2,
+            self.spl.service: 2,
+            self.spl.service.settings: 3,
+            self.spl.project.customer: 3,
+        })
+
+    def test_descendants_are_fetched_with_one_query(self):
+        customer_estimate = self.get_estimate(self.spl.project.customer)
+        with self.assertNumQueries(1):
+            descendants = customer_estimate.get_descendants()
+        self.assertEqual({estimate.scope for estimate in descendants},
+                         {self.spl.project, self.spl.service, self.spl, self.resource_estimate.scope})
+
+    def test_existing_subtree_is_linked_to_new_parent(self):
+        project_estimate = self.get_estimate(self.spl.project)
+        new_parent = factories.PriceEstimateFactory(scope=structure_factories.CustomerFactory(), year=2016, month=8)
+        project_estimate.parents.add(new_parent)
+        self.assertEqual(models.PriceEstimateLink.objects.get(
+            ancestor=new_parent, descendant=self.resource_estimate).depth, 3)
+
+    def get_ancestors_scopes(self, estimate):
+        links = models.PriceEstimateLink.objects.filter(descendant=estimate)
+        return {link.ancestor.scope for link in links}
+
+    def test_subtree_is_unlinked_from_removed_parent(self):
+        spl_estimate = self.get_estimate(self.spl)
+        spl_estimate.parents.remove(self.get_estimate(self.spl.project))
+
+        self.assertEqual(self.get_ancestors_scopes(self.resource_estimate),
+                         {self.spl, self.spl.service, self.spl.service.settings})
+        self.assertEqual(models.PriceEstimateLink.objects.get(
+            ancestor=self.get_estimate(self.spl.service.settings), descendant=self.resource_estimate).depth, 3)
+
+    def test_children_subtrees_are_unlinked_on_children_clear(self):
+        project_estimate = self.get_estimate(self.spl.project)
+        project_estimate.children.clear()
+
+        self.assertFalse(models.PriceEstimateLink.objects.filter(ancestor=project_estimate).exists())
+        self.assertEqual(self.get_ancestors_scopes(self.resource_estimate),
+                         {self.spl, self.spl.service, self.spl.service.settings})
+        self.assertEqual(self.get_ancestors_scopes(project_estimate), {self.spl.project.customer})
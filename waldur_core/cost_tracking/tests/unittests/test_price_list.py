@@ -0,0 +1,53 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import TransactionTestCase
+
+from waldur_core.cost_tracking import models, price_list
+from waldur_core.structure.tests import factories as structure_factories
+
+
+class PriceListIndexTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.resource = structure_factories.TestNewInstanceFactory()
+        resource_content_type = ContentType.objects.get_for_model(self.resource)
+        self.service = self.resource.service_project_link.service
+        self.default_item1 = models.DefaultPriceListItem.objects.create(
+            resource_content_type=resource_content_type, item_type='flavor', key='small', value=10)
+        self.default_item2 = models.DefaultPriceListItem.objects.create(
+            resource_content_type=resource_content_type, item_type='storage', key='1 GB', value=0.5)
+
+    def test_service_price_list_item_overrides_default_one(self):
+        item = models.PriceListItem.objects.create(
+            default_price_list_item=self.default_item2, service=self.service, value=2)
+
+        expected = {
+            ('flavor', 'small'): self.default_item1.minute_rate,
+            ('storage', '1 GB'): item.minute_rate,
+        }
+        self.assertEqual(price_list.get_resource_prices(self.resource), expected)
+
+    def test_service_price_list_item_does_not_affect_other_services(self):
+        other_service = structure_factories.TestServiceFactory(customer=self.service.customer)
+        models.PriceListItem.objects.create(
+            default_price_list_item=self.default_item2, service=other_service, value=2)
+
+        prices = price_list.get_resource_prices(self.resource)
+        self.assertEqual(prices[('storage', '1 GB')], self.default_item2.minute_rate)
+
+    def test_index_is_invalidated_when_price_list_item_is_changed(self):
+        price_list.get_resource_prices(self.resource)
+        self.default_item1.value = 20
+        self.default_item1.save()
+
+        prices = price_list.get_resource_prices(self.resource)
+        self.assertEqual(prices[('flavor', 'small')], self.default_item1.minute_rate)
+
+    def test_index_is_loaded_once_per_run(self):
+        resource = structure_factories.TestNewInstanceFactory(service_project_link=self.resource.service_project_link)
+        with price_list.price_list_run():
+            with self.assertNumQueries(0):
+                for _ in range(3):
+                    price_list.get_resource_prices(self.resource)
+                    price_list.get_resource_prices(resource)
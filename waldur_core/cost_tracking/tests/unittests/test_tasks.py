@@ -1,10 +1,13 @@
 import datetime
 
+import mock
 from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError
 from django.test import TransactionTestCase
+from django.utils import timezone
 from freezegun import freeze_time
 
-from waldur_core.cost_tracking import models, CostTrackingRegister, tasks
+from waldur_core.cost_tracking import models, recalculation, CostTrackingRegister, tasks
 from waldur_core.cost_tracking.tests import factories
 from waldur_core.structure.tests import factories as structure_factories
 from waldur_core.structure.tests.models import TestNewInstance
@@ -76,3 +79,237 @@ class RecalculateEstimateTest(TransactionTestCase):
             message = 'Price estimate "consumed" is calculated wrongly for "%s". Real value: %s, expected: %s.' % (
                 price_estimate.scope, price_estimate.consumed, expected_consumed)
             self.assertAlmostEqual(price_estimate.consumed, expected_consumed, msg=message)
+
+
+class DirtyRecalculationTest(TransactionTestCase):
+
+    def setUp(self):
+        resource_content_type = ContentType.objects.get_for_model(TestNewInstance)
+        self.price_list_item = models.DefaultPriceListItem.objects.create(
+            item_type='storage', key='1 MB', resource_content_type=resource_content_type, value=2)
+        CostTrackingRegister.register_strategy(factories.TestNewInstanceCostTrackingStrategy)
+        self.start_time = datetime.datetime(2016, 8, 8, 11, 0)
+        with freeze_time(self.start_time):
+            self.resource = structure_factories.TestNewInstanceFactory(disk=20 * 1024)
+        self.spl = self.resource.service_project_link
+        self.project = self.spl.project
+        self.calculation_time = datetime.datetime(2016, 8, 8, 15, 0)
+
+    def get_estimate(self, scope):
+        return models.PriceEstimate.objects.get_current(scope=scope)
+
+    def test_dirty_flags_are_reset_after_recalculation(self):
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate()
+            self.assertFalse(models.PriceEstimate.objects.filter(is_dirty=True).exists())
+
+    def test_ancestors_are_not_recalculated_if_resources_consumed_is_not_changed(self):
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate()
+            models.PriceEstimate.objects.filter(pk=self.get_estimate(self.project).pk).update(consumed=0)
+
+            tasks.recalculate_estimate()
+            self.assertEqual(self.get_estimate(self.project).consumed, 0)
+
+            tasks.recalculate_estimate(full=True)
+            self.assertEqual(self.get_estimate(self.project).consumed, self.get_estimate(self.resource).consumed)
+
+    def test_ancestors_are_recalculated_if_resource_consumed_is_changed(self):
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate()
+
+        later = datetime.datetime(2016, 8, 8, 16, 0)
+        with freeze_time(later):
+            tasks.recalculate_estimate()
+            resource_consumed = self.get_estimate(self.resource).consumed
+            for scope in (self.spl, self.project, self.project.customer):
+                self.assertAlmostEqual(self.get_estimate(scope).consumed, resource_consumed)
+
+    def test_idle_resource_estimate_is_recalculated_only_if_it_is_dirty(self):
+        with freeze_time(self.calculation_time):
+            self.resource.state = TestNewInstance.States.ERRED
+            self.resource.save()
+            tasks.recalculate_estimate()
+            expected = self.get_estimate(self.resource).consumed
+            self.assertGreater(expected, 0)
+            models.PriceEstimate.objects.filter(pk=self.get_estimate(self.resource).pk).update(consumed=0)
+
+            tasks.recalculate_estimate()
+            self.assertEqual(self.get_estimate(self.resource).consumed, 0)
+
+            models.PriceEstimate.objects.filter(pk=self.get_estimate(self.resource).pk).update(is_dirty=True)
+            tasks.recalculate_estimate()
+            self.assertAlmostEqual(self.get_estimate(self.resource).consumed, expected)
+
+    def test_dirty_flags_are_kept_if_recalculation_has_failed(self):
+        with freeze_time(self.calculation_time):
+            with mock.patch('waldur_core.cost_tracking.recalculation.aggregate_ancestors') as aggregate_ancestors:
+                aggregate_ancestors.side_effect = DatabaseError()
+                with self.assertRaises(DatabaseError):
+                    tasks.recalculate_estimate()
+
+            for scope in (self.resource, self.spl, self.project):
+                self.assertTrue(self.get_estimate(scope).is_dirty)
+
+    def test_resource_configuration_change_marks_estimate_dirty(self):
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate()
+            self.resource.disk = 10 * 1024
+            self.resource.save()
+            self.assertTrue(self.get_estimate(self.resource).is_dirty)
+
+    def test_ancestors_are_recalculated_if_resource_is_unlinked(self):
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate()
+            self.resource.PERFORM_UNLINK = True
+            self.resource.delete()
+            tasks.recalculate_estimate()
+            for scope in (self.spl, self.project, self.project.customer):
+                self.assertEqual(self.get_estimate(scope).consumed, 0)
+
+    def test_batch_consumed_is_identical_to_per_object_computation(self):
+        with freeze_time(self.start_time):
+            second_resource = structure_factories.TestNewInstanceFactory(
+                disk=10 * 1024, service_project_link=self.spl)
+        with freeze_time(self.calculation_time):
+            estimates = models.PriceEstimate.objects.filter(scope__in=[self.resource, second_resource])
+            values = recalculation.compute_consumed(estimates, timezone.now())
+            for price_estimate in estimates:
+                price_estimate.update_consumed()
+                self.assertEqual(values[price_estimate.pk], price_estimate.consumed)
+
+
+class ShardedRecalculationTest(TransactionTestCase):
+
+    def setUp(self):
+        resource_content_type = ContentType.objects.get_for_model(TestNewInstance)
+        models.DefaultPriceListItem.objects.create(
+            item_type='storage', key='1 MB', resource_content_type=resource_content_type, value=2)
+        CostTrackingRegister.register_strategy(factories.TestNewInstanceCostTrackingStrategy)
+        self.start_time = datetime.datetime(2016, 8, 8, 11, 0)
+        with freeze_time(self.start_time):
+            self.resource = structure_factories.TestNewInstanceFactory(disk=20 * 1024)
+            self.spl = self.resource.service_project_link
+            self.resources = [self.resource] + [
+                structure_factories.TestNewInstanceFactory(disk=(i + 1) * 1024, service_project_link=self.spl)
+                for i in range(4)]
+        self.calculation_time = datetime.datetime(2016, 8, 8, 15, 0)
+        self.model_label = TestNewInstance._meta.label
+
+    def run_workflow(self, **kwargs):
+        """ Execute coordinator, shards and callback synchronously """
+        with mock.patch('waldur_core.cost_tracking.tasks.chord') as mocked_chord:
+            tasks.schedule_estimate_recalculation(**kwargs)
+        header = mocked_chord.call_args[0][0]
+        callback = mocked_chord.return_value.call_args[0][0]
+        results = [tasks.recalculate_estimate_shard(*shard.args) for shard in header]
+        tasks.aggregate_estimate_ancestors(results, *callback.args)
+        return header
+
+    def get_consumed(self, scope):
+        return models.PriceEstimate.objects.get_current(scope=scope).consumed
+
+    @mock.patch('waldur_core.cost_tracking.recalculation.SHARD_SIZE', 2)
+    def test_resources_are_split_into_shards_by_ids_range(self):
+        with freeze_time(self.calculation_time):
+            header = self.run_workflow()
+
+        ids = sorted(resource.pk for resource in self.resources)
+        expected = [(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[4])]
+        self.assertEqual([tuple(shard.args[1:3]) for shard in header], expected)
+        self.assertTrue(all(shard.args[0] == self.model_label for shard in header))
+
+    @mock.patch('waldur_core.cost_tracking.recalculation.SHARD_SIZE', 2)
+    def test_sharded_recalculation_matches_monolithic_one(self):
+        with freeze_time(self.calculation_time):
+            self.run_workflow()
+            sharded = [self.get_consumed(scope) for scope in self.resources + [self.spl, self.spl.project]]
+            tasks.recalculate_estimate(full=True)
+            monolithic = [self.get_consumed(scope) for scope in self.resources + [self.spl, self.spl.project]]
+
+        self.assertEqual(sharded, monolithic)
+        self.assertGreater(sharded[-1], 0)
+
+    def test_shard_restores_dirty_flags_on_error(self):
+        with freeze_time(self.calculation_time):
+            with mock.patch('waldur_core.cost_tracking.recalculation.compute_consumed') as compute_consumed:
+                compute_consumed.side_effect = DatabaseError()
+                with self.assertRaises(DatabaseError):
+                    tasks.recalculate_estimate_shard(self.model_label, self.resource.pk, self.resource.pk)
+
+            price_estimate = models.PriceEstimate.objects.get_current(scope=self.resource)
+            self.assertTrue(price_estimate.is_dirty)
+
+            # retry recalculates shard from scratch
+            tasks.recalculate_estimate_shard(self.model_label, self.resource.pk, self.resource.pk)
+            price_estimate = models.PriceEstimate.objects.get_current(scope=self.resource)
+            self.assertFalse(price_estimate.is_dirty)
+            self.assertGreater(price_estimate.consumed, 0)
+
+    @mock.patch('waldur_core.cost_tracking.recalculation.BATCH_SIZE', 2)
+    def test_shard_retry_after_partial_failure_returns_all_changed_estimates(self):
+        ids = sorted(resource.pk for resource in self.resources)
+        compute_consumed = recalculation.compute_consumed
+        calls = []
+
+        def fail_after_first_chunk(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise DatabaseError()
+            return compute_consumed(*args)
+
+        initial = [self.get_consumed(resource) for resource in self.resources]
+        with freeze_time(self.calculation_time):
+            with mock.patch('waldur_core.cost_tracking.recalculation.compute_consumed',
+                            side_effect=fail_after_first_chunk):
+                with self.assertRaises(DatabaseError):
+                    tasks.recalculate_estimate_shard(self.model_label, ids[0], ids[-1])
+            # consumed price of the first chunk is not written
+            self.assertEqual([self.get_consumed(resource) for resource in self.resources], initial)
+
+            changed_ids = tasks.recalculate_estimate_shard(self.model_label, ids[0], ids[-1])
+            tasks.aggregate_estimate_ancestors([changed_ids])
+
+        self.assertEqual(len(changed_ids), len(self.resources))
+        expected = sum(self.get_consumed(resource) for resource in self.resources)
+        self.assertGreater(expected, 0)
+        self.assertAlmostEqual(self.get_consumed(self.spl), expected)
+
+    def test_ancestors_are_aggregated_if_result_of_committed_shard_is_lost(self):
+        ids = sorted(resource.pk for resource in self.resources)
+        with freeze_time(self.calculation_time):
+            tasks.recalculate_estimate_shard(self.model_label, ids[0], ids[-1])
+            # shard is redelivered after commit and has nothing to change
+            changed_ids = tasks.recalculate_estimate_shard(self.model_label, ids[0], ids[-1])
+            self.assertEqual(changed_ids, [])
+            self.assertTrue(models.PriceEstimate.objects.get_current(scope=self.spl).is_dirty)
+            tasks.aggregate_estimate_ancestors([changed_ids])
+
+        expected = sum(self.get_consumed(resource) for resource in self.resources)
+        self.assertGreater(expected, 0)
+        self.assertAlmostEqual(self.get_consumed(self.spl), expected)
+        self.assertFalse(models.PriceEstimate.objects.get_current(scope=self.spl).is_dirty)
+
+    def test_dirty_flags_of_ancestors_are_reset_by_callback(self):
+        recalculation.mark_dirty([models.PriceEstimate.objects.get_current(scope=self.spl).pk])
+
+        with mock.patch('waldur_core.cost_tracking.tasks.chord'):
+            tasks.schedule_estimate_recalculation()
+        self.assertTrue(models.PriceEstimate.objects.get_current(scope=self.spl).is_dirty)
+
+        with freeze_time(self.calculation_time):
+            tasks.aggregate_estimate_ancestors([])
+        self.assertFalse(models.PriceEstimate.objects.get_current(scope=self.spl).is_dirty)
+
+    def test_ancestors_are_marked_dirty_if_shard_has_failed(self):
+        with mock.patch('waldur_core.cost_tracking.tasks.chord') as mocked_chord:
+            tasks.schedule_estimate_recalculation()
+        callback = mocked_chord.return_value.call_args[0][0]
+        errback = callback.options['link_error'][0]
+        recalculation.pop_dirty_estimates()
+
+        tasks.mark_estimate_ancestors_dirty(*errback.args)
+
+        for scope in (self.spl, self.spl.project, self.spl.project.customer):
+            self.assertTrue(models.PriceEstimate.objects.get_current(scope=scope).is_dirty)
+        self.assertFalse(models.PriceEstimate.objects.get_current(scope=self.resource).is_dirty)
@@ -24,16 +24,28 @@ class PriceEstimateViewSet(core_views.ReadOnlyActionsViewSet):
         ScopeTypeFilterBackend,
     )
 
-    def get_serializer_context(self):
-        context = super(PriceEstimateViewSet, self).get_serializer_context()
+    def get_depth(self):
         try:
             depth = int(self.request.query_params['depth'])
-        except (TypeError, KeyError):
-            pass  # use default depth if it is not defined or defined wrongly.
-        else:
-            context['depth'] = min(depth, 10)  # DRF restriction - serializer depth cannot be > 10
+        except (TypeError, KeyError, ValueError):
+            return None  # use default depth if it is not defined or defined wrongly.
+        return min(depth, 10)  # DRF restriction - serializer depth cannot be > 10
+
+    def get_serializer_context(self):
+        context = super(PriceEstimateViewSet, self).get_serializer_context()
+        depth = self.get_depth()
+        if depth is not None:
+            context['depth'] = depth
         return context
 
+    def get_serializer(self, *args, **kwargs):
+        depth = self.get_depth()
+        if depth and args:
+            # Children of the whole tree are prefetched with one query per level.
+            estimates = args[0] if kwargs.get('many') else [args[0]]
+            models.PriceEstimateLink.objects.prefetch_children(estimates, depth)
+        return super(PriceEstimateViewSet, self).get_serializer(*args, **kwargs)
+
     def get_queryset(self):
         return models.PriceEstimate.objects.filtered_for_user(self.request.user).order_by(
             '-year', '-month')
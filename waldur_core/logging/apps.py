@@ -10,6 +10,7 @@ class EventsConfig(AppConfig):
 
     def ready(self):
         from waldur_core.logging import handlers, utils
+        from waldur_core.logging.models import BaseHook, SystemNotification
 
         for index, model in enumerate(utils.get_loggable_models()):
             signals.post_delete.connect(
@@ -17,3 +18,18 @@ class EventsConfig(AppConfig):
                 sender=model,
                 dispatch_uid='waldur_core.logging.handlers.remove_{}_{}_related_alerts'.format(model.__name__, index),
             )
+
+        for model in BaseHook.get_all_models() + [SystemNotification]:
+            signals.post_save.connect(
+                handlers.clean_hooks_routing_index,
+                sender=model,
+                dispatch_uid='waldur_core.logging.handlers.clean_hooks_routing_index_on_{}_save'.format(
+                    model.__name__),
+            )
+
+            signals.post_delete.connect(
+                handlers.clean_hooks_routing_index,
+                sender=model,
+                dispatch_uid='waldur_core.logging.handlers.clean_hooks_routing_index_on_{}_delete'.format(
+                    model.__name__),
+            )
@@ -1,15 +1,30 @@
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
-from elasticsearch import Elasticsearch
+from django.core.cache import cache
+from elasticsearch import Elasticsearch, helpers
 
-from waldur_core.core.utils import datetime_to_timestamp
+from waldur_core.core.utils import datetime_to_timestamp, timestamp_to_datetime
 
 
 logger = logging.getLogger(__name__)
 
+EVENTS_COUNT_CACHE_TIMEOUT = 60
+# Count of range that has ended is not changed by new events, so it is fresh longer.
+EVENTS_COUNT_CLOSED_RANGE_TIMEOUT = 10 * 60
+# Stale counts are kept in cache to be returned while they are refreshed.
+EVENTS_COUNT_STALE_TIMEOUT = 60 * 60
+# Timestamp filters and ranges are aligned to buckets of given size in seconds.
+EVENTS_COUNT_BUCKET_SIZE = 60
+
 
 class ElasticsearchError(Exception):
     pass
@@ -30,9 +45,18 @@ class EmptyQueryset(object):
     def count(self):
         return 0
 
+    def cached_count(self):
+        return 0
+
     def __getitem__(self, key):
         return []
 
+    def get_page_after(self, search_after=None, size=10):
+        return {'events': [], 'search_after': None}
+
+    def scan(self, size=1000):
+        return iter([])
+
 
 class ElasticsearchResultList(object):
     """ List of results acceptable by django pagination """
@@ -59,8 +83,11 @@ class ElasticsearchResultList(object):
     def count(self):
         return self.client.get_count()
 
+    def cached_count(self):
+        return EventsCountCache(self.client).get_count()
+
     def aggregated_count(self, ranges):
-        return self.client.get_aggregated_by_timestamp_count(ranges)
+        return EventsCountCache(self.client).get_aggregated_count(ranges)
 
     def _get_events(self, from_, size):
         return self.client.get_events(
@@ -85,6 +112,132 @@ class ElasticsearchResultList(object):
         self.total = events_and_total['total']
         return events_and_total['events']
 
+    def get_page_after(self, search_after=None, size=10):
+        """ Return page of events that follow event with given sort values.
+
+            Unlike slicing, page is selected with search_after parameter, so deep pages
+            are as cheap as the first one and are not limited by max result window of index.
+            Total is not calculated.
+        """
+        return self.client.get_events_after(
+            search_after=search_after,
+            size=size,
+            sort=getattr(self, 'sort', '-@timestamp'),
+        )
+
+    def scan(self, size=1000):
+        """ Iterate over all events with scroll API, loading them by batches of given size. """
+        return self.client.scan_events(size=size)
+
+
+class EventsCountCache(object):
+    """ Short-term cache of events counts for dashboards that poll them.
+
+        Counts are cached by normalized query: permission terms, filters and time range
+        rounded to buckets. Stale counts are returned immediately and are refreshed in background.
+        Timestamp ranges of aggregated count are aligned to buckets, so repeated and
+        overlapping histograms reuse counts of already computed ranges.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.query_key = client.body.get_cache_key()
+
+    def get_count(self):
+        # Count of all events is cached as range without bounds.
+        key = self._get_range_key(None, None)
+        entry = cache.get(key)
+        if entry is None:
+            count = self.client.get_count()
+            self._set(key, count, EVENTS_COUNT_CACHE_TIMEOUT)
+            return count
+        if entry['fresh_until'] < time.time():
+            self._schedule_refresh(OrderedDict([(key, (None, None))]))
+        return entry['value']
+
+    def get_aggregated_count(self, ranges):
+        bounds = [self._align(r) for r in ranges]
+        keys = OrderedDict((self._get_range_key(*b), b) for b in bounds)
+        entries = cache.get_many(list(keys.keys()))
+
+        missing = OrderedDict((key, b) for key, b in keys.items() if key not in entries)
+        if missing:
+            results = self.client.get_aggregated_by_timestamp_count(
+                [self._to_range(*b) for b in missing.values()])
+            counts = {(result.get('start'), result.get('end')): result['count'] for result in results}
+            for key, (start, end) in missing.items():
+                entries[key] = self._set(key, counts.get((start, end), 0), self._get_timeout(end))
+
+        now = time.time()
+        stale = OrderedDict((key, b) for key, b in keys.items()
+                            if key not in missing and entries[key]['fresh_until'] < now)
+        if stale:
+            self._schedule_refresh(stale)
+
+        results = []
+        for start, end in bounds:
+            result = {'count': entries[self._get_range_key(start, end)]['value']}
+            if start is not None:
+                result['start'] = start
+            if end is not None:
+                result['end'] = end
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _align(timestamp_range):
+        def align(dt):
+            timestamp = datetime_to_timestamp(dt)
+            return timestamp - timestamp % EVENTS_COUNT_BUCKET_SIZE
+        return (align(timestamp_range['start']) if 'start' in timestamp_range else None,
+                align(timestamp_range['end']) if 'end' in timestamp_range else None)
+
+    @staticmethod
+    def _to_range(start, end):
+        timestamp_range = {}
+        if start is not None:
+            timestamp_range['start'] = timestamp_to_datetime(start)
+        if end is not None:
+            timestamp_range['end'] = timestamp_to_datetime(end)
+        return timestamp_range
+
+    @staticmethod
+    def _get_timeout(end):
+        if end is not None and end < time.time() - EVENTS_COUNT_BUCKET_SIZE:
+            return EVENTS_COUNT_CLOSED_RANGE_TIMEOUT
+        return EVENTS_COUNT_CACHE_TIMEOUT
+
+    def _get_range_key(self, start, end):
+        return 'events_count:%s:%s:%s' % (self.query_key, start, end)
+
+    @staticmethod
+    def _set(key, value, timeout):
+        entry = {'value': value, 'fresh_until': time.time() + timeout}
+        cache.set(key, entry, EVENTS_COUNT_STALE_TIMEOUT)
+        return entry
+
+    def _schedule_refresh(self, keys):
+        # Only one refresh of stale count is scheduled at a time.
+        keys = OrderedDict((key, b) for key, b in keys.items()
+                           if cache.add(key + ':refresh', True, EVENTS_COUNT_CACHE_TIMEOUT))
+        if not keys:
+            return
+        self.client.body.set_timestamp_ranges([self._to_range(*b) for b in keys.values()])
+        self.client.body.prepare()
+        # XXX: This import provides circular dependencies between core and
+        #      logging applications.
+        from waldur_core.core.tasks import send_task
+        send_task('logging', 'refresh_events_counts')(dict(self.client.body), list(keys.items()))
+
+    @classmethod
+    def refresh(cls, body, keys):
+        """ Recalculate counts of given ranges with one aggregation query and update cache. """
+        results = ElasticsearchClient().search_aggregated_count(body)
+        counts = {(result.get('start'), result.get('end')): result['count'] for result in results}
+        for key, (start, end) in keys:
+            cls._set(key, counts.get((start, end), 0), cls._get_timeout(end))
+            cache.delete(key + ':refresh')
+
 
 def _execute_if_not_empty(func):
     """ Execute function only if one of input parameters is not empty """
@@ -95,6 +248,10 @@ def _execute_if_not_empty(func):
 
 
 class ElasticsearchClient(object):
+    # Events with the same timestamp are ordered by document uid, so search_after values are unique.
+    # Elasticsearch 5 does not allow sorting by _id field, _uid is used instead.
+    TIEBREAKER_FIELD = '_uid'
+    SCROLL_TIMEOUT = '5m'
 
     class SearchBody(dict):
         FTS_FIELDS = (
@@ -194,6 +351,17 @@ class ElasticsearchClient(object):
                     }
                 }
 
+        def get_cache_key(self):
+            """ Return hash of normalized search parameters. Timestamp filter is rounded to minutes. """
+            params = {
+                'queries': self.queries,
+                'should': self.should_terms_filter,
+                'must': self.must_terms_filter,
+                'must_not': self.must_not_terms_filter,
+                'timestamp': {key: value[:len('YYYY-MM-DDTHH:MM')] for key, value in self.timestamp_filter.items()},
+            }
+            return hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
         def datetime_to_elasticsearch_timestamp(self, dt):
             """ Elasticsearch calculates timestamp in milliseconds """
             return datetime_to_timestamp(dt) * 1000
@@ -250,6 +418,28 @@ class ElasticsearchClient(object):
             'total': search_results['hits']['total'],
         }
 
+    def get_events_after(self, sort='-@timestamp', search_after=None, index='_all', size=10):
+        order = 'desc' if sort.startswith('-') else 'asc'
+        body = dict(self.body)
+        body['sort'] = [
+            {sort.lstrip('-'): {'order': order}},
+            {self.TIEBREAKER_FIELD: {'order': order}},
+        ]
+        if search_after:
+            body['search_after'] = search_after
+        search_results = self.client.search(index=index, body=body, size=size)
+        hits = search_results['hits']['hits']
+        return {
+            'events': [r['_source'] for r in hits],
+            # There are no more events if page is not full.
+            'search_after': hits[-1]['sort'] if hits and len(hits) == size else None,
+        }
+
+    def scan_events(self, index='_all', size=1000):
+        """ Iterate over events with scroll API. Events are returned in index order. """
+        hits = helpers.scan(self.client, query=dict(self.body), index=index, size=size, scroll=self.SCROLL_TIMEOUT)
+        return (hit['_source'] for hit in hits)
+
     def get_count(self, index='_all'):
         count_results = self.client.count(index=index, body=self.body)
         return count_results['count']
@@ -257,16 +447,19 @@ class ElasticsearchClient(object):
     def get_aggregated_by_timestamp_count(self, ranges, index='_all'):
         self.body.set_timestamp_ranges(ranges)
         self.body.prepare()
-        search_results = self.client.search(index=index, body=self.body, search_type='count')
+        return self.search_aggregated_count(self.body, index=index)
+
+    def search_aggregated_count(self, body, index='_all'):
+        search_results = self.client.search(index=index, body=body, search_type='count')
         formatted_results = []
         for result in search_results['aggregations']['timestamp_ranges']['buckets']:
             formatted = {'count': result['doc_count']}
             if 'from' in result:
                 # Divide by 1000 - because elasticsearch return return timestamp in microseconds
-                formatted['start'] = result['from'] / 1000
+                formatted['start'] = int(result['from'] / 1000)
             if 'to' in result:
                 # Divide by 1000 - because elasticsearch return return timestamp in microseconds
-                formatted['end'] = result['to'] / 1000
+                formatted['end'] = int(result['to'] / 1000)
             formatted_results.append(formatted)
         return formatted_results
 
@@ -292,15 +485,84 @@ class ElasticsearchClient(object):
         return elasticsearch_settings
 
     def _get_client(self):
-        elasticsearch_settings = self._get_elastisearch_settings()
+        return client_registry.get_client(self._get_elastisearch_settings())
+
+
+class ElasticsearchClientRegistry(object):
+    """ Process-wide registry of Elasticsearch clients.
+
+        Client and its connection pool are created lazily on first request and are shared by
+        all threads of the process, so connections to Elasticsearch are kept alive between requests.
+        Clients are created again in forked process (uWSGI and Celery prefork workers), because
+        sockets could not be shared with parent process.
+
+        Optional items of ELASTICSEARCH section of settings.WALDUR_CORE configure client:
+        maxsize - number of connections kept in pool per node;
+        timeout - request timeout in seconds;
+        max_retries, retry_on_timeout - retry policy of failed requests;
+        sniff_on_start, sniff_on_connection_fail, sniffer_timeout - discovery of cluster nodes.
+    """
+    CLIENT_OPTIONS = ('maxsize', 'timeout', 'max_retries', 'retry_on_timeout',
+                      'sniff_on_start', 'sniff_on_connection_fail', 'sniffer_timeout')
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get_client(self, elasticsearch_settings):
+        self._check_pid()
+        key = tuple(sorted(elasticsearch_settings.items()))
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = self._create_client(elasticsearch_settings)
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+    def get_stats(self):
+        """ Return usage of connection pools of all nodes: number of opened connections,
+            number of performed requests, number of idle connections and size of pool.
+        """
+        stats = []
+        for client in list(self._clients.values()):
+            for connection in client.transport.connection_pool.connections:
+                pool = connection.pool
+                # Queue of closed pool is None, empty slots of queue are filled with None.
+                queue = list(pool.pool.queue) if pool.pool is not None else []
+                stats.append({
+                    'host': connection.host,
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': len([conn for conn in queue if conn is not None]),
+                    'maxsize': pool.pool.maxsize if pool.pool is not None else 0,
+                })
+        return stats
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Lock could be held by thread of parent process that does not exist in child process.
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._clients = {}
+
+    def _create_client(self, elasticsearch_settings):
         if elasticsearch_settings.get('username') and elasticsearch_settings.get('password'):
             path = '%(protocol)s://%(username)s:%(password)s@%(host)s:%(port)s' % elasticsearch_settings
         else:
             path = '%(protocol)s://%(host)s:%(port)s' % elasticsearch_settings
+        options = {option: elasticsearch_settings[option]
+                   for option in self.CLIENT_OPTIONS if option in elasticsearch_settings}
         client = Elasticsearch(
             [str(path)],
             verify_certs=elasticsearch_settings.get('verify_certs', False),
             ca_certs=elasticsearch_settings.get('ca_certs', ''),
+            **options
         )
         # XXX Workaround for Python Elasticsearch client bugs
         if not elasticsearch_settings.get('verify_certs'):
@@ -322,3 +584,6 @@ class ElasticsearchClient(object):
             connection_pool.cert_reqs = 0  # ssl.CERT_NONE
         # XXX End of workaround
         return client
+
+
+client_registry = ElasticsearchClientRegistry()
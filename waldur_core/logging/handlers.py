@@ -1,10 +1,12 @@
 from django.contrib.contenttypes import models as ct_models
 
-from waldur_core.logging import models
+from waldur_core.logging import models, routing
 
 
 def remove_related_alerts(sender, instance, **kwargs):
     content_type = ct_models.ContentType.objects.get_for_model(instance)
-    for alert in models.Alert.objects.filter(
-            object_id=instance.id, content_type=content_type, closed__isnull=True).iterator():
-        alert.close()
+    models.Alert.objects.filter(object_id=instance.id, content_type=content_type).close()
+
+
+def clean_hooks_routing_index(sender, **kwargs):
+    routing.clean_routing_index()
@@ -3,6 +3,7 @@
 import json
 import datetime
 import logging
+import threading
 
 from celery import current_app
 
@@ -99,6 +100,20 @@ class TCPEventHandler(logging.handlers.SocketHandler, object):
 
 
 class HookHandler(logging.Handler):
+    """ Collects events and sends them to hooks processing in batches.
+
+        Batch is sent to background task when it reaches batch_size events or when
+        batch_window seconds are passed since the first event of batch was emitted.
+        Remaining events are sent on handler flush or close.
+    """
+
+    def __init__(self, batch_size=50, batch_window=2, *args, **kwargs):
+        super(HookHandler, self).__init__(*args, **kwargs)
+        self.batch_size = int(batch_size)
+        self.batch_window = float(batch_window)
+        self.buffer = []
+        self.timer = None
+
     def emit(self, record):
         # Check that record contains event
         if hasattr(record, 'event_type') and hasattr(record, 'event_context'):
@@ -111,8 +126,35 @@ class HookHandler(logging.Handler):
                 'type': record.event_type,
                 'context': record.event_context
             }
-            # XXX: This import provides circular dependencies between core and
-            #      logging applications.
-            from waldur_core.core.tasks import send_task
-            # Perform hook processing in background thread
-            send_task('logging', 'process_event')(event)
+            # Handler lock is already acquired by handle()
+            self.buffer.append(event)
+            if len(self.buffer) >= self.batch_size:
+                self._send_buffer()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._send_buffer()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        super(HookHandler, self).close()
+
+    def _send_buffer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+        events, self.buffer = self.buffer, []
+        # XXX: This import provides circular dependencies between core and
+        #      logging applications.
+        from waldur_core.core.tasks import send_task
+        # Perform hook processing in background thread
+        send_task('logging', 'process_events')(events)
@@ -1,17 +1,23 @@
 """ Custom loggers that allows to store logs in DB and Elastic """
 
+import os
 import uuid
 import types
 import decimal
 import datetime
 import importlib
 import logging
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 
 from django.apps import apps
+from django.conf import settings
 from django.contrib.contenttypes import models as ct_models
-from django.db import transaction, IntegrityError
-from django.utils import six
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import connection, models as django_models, transaction, IntegrityError
+from django.db.models import Case, Q, Value, When, prefetch_related_objects
+from django.utils import six, timezone
 
 from waldur_core.logging import models
 from waldur_core.logging.log import EventLoggerAdapter
@@ -47,6 +53,23 @@ class BaseLogger(object):
     def get_nullable_fields(self):
         return getattr(self._meta, 'nullable_fields', [])
 
+    def get_select_related(self, entity_name):
+        """ Return lookups of objects related to context entity that are needed to compile context.
+
+            Logger may declare lookups explicitly in Meta, for example:
+                select_related = {'resource': ('service_project_link__project__customer',)}
+            By default lookups are derived from log fields of entity model.
+        """
+        declared = getattr(self._meta, 'select_related', {})
+        if entity_name in declared:
+            return tuple(declared[entity_name])
+        model = self.fields.get(entity_name) if hasattr(self, 'fields') else None
+        if model is None:
+            model = self.get_field_model(self.__class__.__dict__.get(entity_name))
+        if isinstance(model, type) and issubclass(model, LoggableMixin):
+            return model.get_log_select_related()
+        return ()
+
     def get_field_model(self, model):
         if not isinstance(model, basestring):
             return model
@@ -77,6 +100,11 @@ class BaseLogger(object):
                     logging_type, ', '.join(self.supported_types)))
 
     def compile_context(self, **kwargs):
+        entities = self._get_context_entities(kwargs)
+        return self._build_context(entities, get_event_context())
+
+    def _get_context_entities(self, kwargs):
+        """ Validate context entities and return list of (entity name, entity) pairs. """
         # Get a list of fields here in order to be sure all models already loaded.
         if not hasattr(self, 'fields'):
             self.fields = {
@@ -88,16 +116,7 @@ class BaseLogger(object):
         if missed:
             raise LoggerError("Missed fields in event context: %s" % ', '.join(missed))
 
-        context = {}
-
-        event_context = get_event_context()
-        if event_context:
-            context.update(event_context)
-            username = event_context.get('user_username')
-            if 'user' in self.fields and username:
-                logger.warning("User is passed directly to event context. "
-                               "Currently authenticated user %s is ignored.", username)
-
+        entities = []
         for entity_name, entity in six.iteritems(kwargs):
             if entity_name in self.fields:
                 entity_class = self.fields[entity_name]
@@ -112,7 +131,20 @@ class BaseLogger(object):
                     "Field '%s' cannot be used in logging context for %s",
                     entity_name, self.__class__.__name__)
                 continue
+            entities.append((entity_name, entity))
+        return entities
+
+    def _build_context(self, entities, event_context):
+        context = {}
 
+        if event_context:
+            context.update(event_context)
+            username = event_context.get('user_username')
+            if 'user' in self.fields and username:
+                logger.warning("User is passed directly to event context. "
+                               "Currently authenticated user %s is ignored.", username)
+
+        for entity_name, entity in entities:
             if isinstance(entity, LoggableMixin):
                 context.update(entity._get_log_context(entity_name))
             elif isinstance(entity, (int, float, basestring, dict, tuple, list, bool)):
@@ -128,6 +160,160 @@ class BaseLogger(object):
         return context
 
 
+class CapturedInstance(object):
+    """ Values of model instance concrete fields that allow to restore instance in another thread.
+
+        Related objects are not captured, only values of foreign keys.
+    """
+
+    def __init__(self, instance):
+        self.model = instance.__class__
+        self.db = instance._state.db
+        fields = [f for f in self.model._meta.concrete_fields if f.attname in instance.__dict__]
+        self.field_names = [f.attname for f in fields]
+        self.values = [getattr(instance, name) for name in self.field_names]
+
+    def restore(self):
+        return self.model.from_db(self.db, self.field_names, self.values)
+
+
+class AsyncEventEmitter(object):
+    """ Emits events from background writer thread.
+
+        Request thread only validates event and captures its context as primitive values,
+        then context is put to bounded in-process queue. Writer thread compiles context
+        and message and passes events to logging handlers in batches, so request is not
+        blocked by lazy loading of related objects and handlers I/O.
+
+        Event is enqueued when current transaction is committed, so writer thread is able
+        to load objects that were created in this transaction. If queue is full, event is
+        dropped after put_timeout seconds. Emitter counts queued, dropped, written and
+        failed events.
+    """
+
+    def __init__(self, queue_size=10000, batch_size=100, put_timeout=0):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.queue = six.moves.queue.Queue(queue_size)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def enqueue(self, event_logger, level, message_template, event_type, captured_context):
+        item = (event_logger, level, message_template, event_type, captured_context)
+        transaction.on_commit(lambda: self.put(item))
+
+    def put(self, item):
+        self._ensure_writer()
+        try:
+            if self.put_timeout:
+                self.queue.put(item, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except six.moves.queue.Full:
+            self._count('dropped')
+            logger.debug('Events queue is full, event %s is dropped.', item[3])
+        else:
+            self._count('queued')
+
+    def write(self, items):
+        restored = []
+        for event_logger, level, message_template, event_type, captured_context in items:
+            try:
+                entities = event_logger.restore_entities(captured_context)
+            except Exception:
+                self._count('failed')
+                logger.exception('Unable to restore context of event %s.', event_type)
+            else:
+                restored.append((event_logger, level, message_template, event_type, captured_context, entities))
+
+        self._load_related_objects(restored)
+
+        for event_logger, level, message_template, event_type, captured_context, entities in restored:
+            try:
+                context = event_logger._build_context(entities, captured_context['event_context'])
+                event_logger.emit(level, message_template, event_type, context)
+            except Exception:
+                self._count('failed')
+                logger.exception('Unable to emit event %s.', event_type)
+            else:
+                self._count('written')
+
+    def _load_related_objects(self, restored):
+        """ Load related objects of all restored instances of batch with one query per lookup level. """
+        instances = defaultdict(list)
+        for event_logger, _, _, _, captured_context, entities in restored:
+            captured_names = set(name for name, entity in captured_context['entities']
+                                 if isinstance(entity, CapturedInstance))
+            for entity_name, entity in entities:
+                if entity_name in captured_names:
+                    lookups = event_logger.get_select_related(entity_name)
+                    if lookups:
+                        instances[(entity.__class__, lookups)].append(entity)
+
+        for (model, lookups), objects in instances.items():
+            try:
+                prefetch_related_objects(objects, *lookups)
+            except Exception:
+                # Related objects are loaded lazily on context compilation.
+                logger.exception('Unable to load related objects of %s for events.', model.__name__)
+
+    def flush(self):
+        """ Wait until all queued events are written. """
+        self.queue.join()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Queue and thread are not inherited by forked worker process.
+                self.queue = six.moves.queue.Queue(self.queue_size)
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='events-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except six.moves.queue.Empty:
+                    break
+            try:
+                self.write(items)
+            finally:
+                # Writer thread has its own database connection.
+                connection.close()
+                for _ in items:
+                    self.queue.task_done()
+
+
+_async_emitter = None
+
+
+def get_async_emitter():
+    """ Return events emitter if asynchronous emission is enabled in settings. """
+    global _async_emitter
+    if not getattr(settings, 'ASYNC_EVENTS_EMISSION', False):
+        return None
+    if _async_emitter is None:
+        _async_emitter = AsyncEventEmitter()
+    return _async_emitter
+
+
 class EventLogger(BaseLogger):
     """ Base event logger API.
         Fields which must be passed during event log emitting (event context)
@@ -194,12 +380,52 @@ class EventLogger(BaseLogger):
         if not event_context:
             event_context = {}
 
+        emitter = get_async_emitter()
+        if emitter is not None:
+            emitter.enqueue(self, level, message_template, event_type, self.capture_context(**event_context))
+            return
+
         context = self.compile_context(**event_context)
+        self.emit(level, message_template, event_type, context)
+
+    def emit(self, level, message_template, event_type, context):
         msg = self.compile_message(message_template, context)
 
         log = getattr(self.logger, level)
         log(msg, extra={'event_type': event_type, 'event_context': context})
 
+    def capture_context(self, **kwargs):
+        """ Validate event context and capture it without access to related objects. """
+        entities = []
+        for entity_name, entity in self._get_context_entities(kwargs):
+            if isinstance(entity, LoggableMixin) and isinstance(entity, django_models.Model):
+                entity = CapturedInstance(entity)
+            entities.append((entity_name, entity))
+        return {
+            'entities': entities,
+            'event_context': dict(get_event_context() or {}),
+        }
+
+    def restore_context(self, captured_context):
+        """ Compile event context that was captured in another thread. """
+        entities = self.restore_entities(captured_context)
+        return self._build_context(entities, captured_context['event_context'])
+
+    def restore_entities(self, captured_context):
+        entities = []
+        for entity_name, entity in captured_context['entities']:
+            if isinstance(entity, CapturedInstance):
+                entity = entity.restore()
+            entities.append((entity_name, entity))
+        return entities
+
+
+ALERTS_BATCH_SIZE = 500
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 
 class AlertLogger(BaseLogger):
     """ Base alert logger API.
@@ -263,6 +489,9 @@ class AlertLogger(BaseLogger):
 
         context = self.compile_context(**alert_context)
         msg = self.compile_message(message_template, context)
+        return self._save_alert(severity, msg, context, scope, alert_type, fail_silently)
+
+    def _save_alert(self, severity, msg, context, scope, alert_type, fail_silently=True):
         content_type = ct_models.ContentType.objects.get_for_model(scope)
 
         try:
@@ -316,6 +545,228 @@ class AlertLogger(BaseLogger):
         except models.Alert.DoesNotExist:
             pass
 
+    def process_batch(self, alerts):
+        """ Create or update alerts in bulk.
+
+            alerts - iterable of (scope, alert_type, severity, message_template, alert_context) tuples.
+            Open alerts are loaded with one query per content type of scopes, new alerts are
+            created with bulk_create and changed alerts are updated with bulk UPDATE.
+            Return numbers of created and updated alerts.
+        """
+        pending = OrderedDict()
+        for scope, alert_type, severity, message_template, alert_context in alerts:
+            self.validate_logging_type(alert_type)
+            context = self.compile_context(**(alert_context or {}))
+            message = self.compile_message(message_template, context)
+            content_type = ct_models.ContentType.objects.get_for_model(scope)
+            pending[(content_type.id, scope.id, alert_type)] = (scope, severity, message, context)
+
+        open_alerts = {}
+        for content_type_id, object_ids in self._group_object_ids(pending.keys()).items():
+            alert_types = set(key[2] for key in pending if key[0] == content_type_id)
+            for chunk in _chunks(object_ids, ALERTS_BATCH_SIZE):
+                for alert in models.Alert.objects.filter(
+                        content_type_id=content_type_id, object_id__in=chunk,
+                        alert_type__in=alert_types, closed__isnull=True):
+                    open_alerts[(content_type_id, alert.object_id, alert.alert_type)] = alert
+
+        new_alerts = []
+        changes = {}
+        for key, (scope, severity, message, context) in pending.items():
+            alert = open_alerts.get(key)
+            if alert is None:
+                new_alerts.append(models.Alert(
+                    content_type_id=key[0], object_id=key[1], alert_type=key[2],
+                    severity=severity, message=message, context=context))
+            elif alert.severity != severity or alert.message != message:
+                changes[alert.pk] = (severity, message)
+
+        created = self._create_alerts(new_alerts, pending)
+        now = timezone.now()
+        for chunk in _chunks(list(changes.keys()), ALERTS_BATCH_SIZE):
+            models.Alert.objects.filter(pk__in=chunk).update(
+                severity=Case(*[When(pk=pk, then=Value(changes[pk][0])) for pk in chunk],
+                              output_field=django_models.SmallIntegerField()),
+                message=Case(*[When(pk=pk, then=Value(changes[pk][1])) for pk in chunk],
+                             output_field=django_models.CharField()),
+                modified=now,
+            )
+        if new_alerts or changes:
+            logger.info('Created %s and updated %s alerts.', created, len(changes))
+        return created, len(changes)
+
+    def close_batch(self, scopes, alert_type):
+        """ Close open alerts of given scopes with one UPDATE query per content type. """
+        keys = [(ct_models.ContentType.objects.get_for_model(scope).id, scope.id) for scope in scopes]
+        closed = 0
+        for content_type_id, object_ids in self._group_object_ids(keys).items():
+            for chunk in _chunks(object_ids, ALERTS_BATCH_SIZE):
+                closed += models.Alert.objects.filter(
+                    content_type_id=content_type_id, object_id__in=chunk, alert_type=alert_type).close()
+        return closed
+
+    def reconcile(self, alert_type, alerts, checked_scopes=None):
+        """ Make given alerts the only open alerts of given type for checked scopes.
+
+            Alerts are created or updated with process_batch, other open alerts of this type
+            are closed with one UPDATE query per content type.
+            checked_scopes - dictionary {content type id: [object ids or values querysets]} of scopes
+            which alerts could be closed. By default open alerts of all scopes could be closed.
+            Return numbers of created, updated and closed alerts.
+        """
+        alerts = list(alerts)
+        created, updated = self.process_batch(alerts)
+        alerted = self._group_object_ids(set((ct_models.ContentType.objects.get_for_model(scope).id, scope.id)
+                                             for scope, _, _, _, _ in alerts))
+        open_alerts = models.Alert.objects.filter(alert_type=alert_type, closed__isnull=True)
+        if checked_scopes is None:
+            content_type_ids = open_alerts.order_by().values_list('content_type_id', flat=True).distinct()
+            checked_scopes = {content_type_id: None for content_type_id in content_type_ids}
+        closed = 0
+        for content_type_id, object_ids in checked_scopes.items():
+            stale = open_alerts.filter(content_type_id=content_type_id)
+            if object_ids is not None:
+                query = Q()
+                for ids in object_ids:
+                    query |= Q(object_id__in=ids)
+                if not query:
+                    continue
+                stale = stale.filter(query)
+            if alerted.get(content_type_id):
+                stale = stale.exclude(object_id__in=alerted[content_type_id])
+            closed += stale.close()
+        return created, updated, closed
+
+    def _group_object_ids(self, keys):
+        object_ids = defaultdict(list)
+        for key in keys:
+            object_ids[key[0]].append(key[1])
+        return object_ids
+
+    def _create_alerts(self, new_alerts, pending):
+        if not new_alerts:
+            return 0
+        try:
+            with transaction.atomic():
+                models.Alert.objects.bulk_create(new_alerts, batch_size=ALERTS_BATCH_SIZE)
+        except IntegrityError:
+            # Some alerts were created concurrently, so they are processed one by one.
+            logger.warning('Could not create alerts in bulk due to concurrent update.')
+            created = 0
+            for alert in new_alerts:
+                scope = pending[(alert.content_type_id, alert.object_id, alert.alert_type)][0]
+                _, is_created = self._save_alert(
+                    alert.severity, alert.message, alert.context, scope, alert.alert_type)
+                created += is_created
+            return created
+        return len(new_alerts)
+
+
+def _write_log_value(context, entity_name, field, value):
+    name = "{}_{}".format(entity_name, field)
+    if isinstance(value, uuid.UUID):
+        context[name] = value.hex
+    elif isinstance(value, LoggableMixin):
+        context.update(value._get_log_context(field))
+    elif isinstance(value, datetime.date):
+        context[name] = value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        context[name] = float(value)
+    elif isinstance(value, dict):
+        context[name] = value
+    else:
+        context[name] = six.text_type(value)
+
+
+def _write_log_uuid(context, entity_name, field, value):
+    if isinstance(value, uuid.UUID):
+        context["{}_{}".format(entity_name, field)] = value.hex
+    else:
+        _write_log_value(context, entity_name, field, value)
+
+
+def _write_log_text(context, entity_name, field, value):
+    context["{}_{}".format(entity_name, field)] = six.text_type(value)
+
+
+def _write_log_related(context, entity_name, field, value):
+    if value is None:
+        _write_log_text(context, entity_name, field, value)
+    else:
+        context.update(value._get_log_context(field))
+
+
+# Fields which values are serialized as text in log context. Subclasses are not
+# included, as they could return values of other types (for example, JSON field).
+_LOG_TEXT_FIELDS = (
+    django_models.CharField, django_models.TextField, django_models.IntegerField,
+    django_models.FloatField, django_models.BooleanField, django_models.NullBooleanField,
+)
+
+_log_context_extractors = {}
+_log_select_related = {}
+
+
+def _get_log_model_field(model, field_name):
+    if not issubclass(model, django_models.Model):
+        return None
+    try:
+        return model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return None
+
+
+def _get_log_fields(model):
+    # Log fields are defined by model and do not depend on instance state,
+    # so they are read from instance that is not initialized.
+    return model.get_log_fields(model.__new__(model))
+
+
+def _get_log_context_extractor(model):
+    """ Return list of (log field, context writer) pairs that is compiled once for each model.
+
+        Writer is chosen by type of model field, so value type is not checked for each event.
+        Generic writer is used for properties and fields with unknown type.
+    """
+    try:
+        return _log_context_extractors[model]
+    except KeyError:
+        pass
+
+    extractor = []
+    for field_name in _get_log_fields(model):
+        field = _get_log_model_field(model, field_name)
+        if isinstance(field, django_models.UUIDField):
+            writer = _write_log_uuid
+        elif (isinstance(field, django_models.ForeignKey) and
+              issubclass(field.related_model, LoggableMixin)):
+            writer = _write_log_related
+        elif type(field) in _LOG_TEXT_FIELDS:
+            writer = _write_log_text
+        else:
+            writer = _write_log_value
+        extractor.append((field_name, writer))
+    _log_context_extractors[model] = extractor = tuple(extractor)
+    return extractor
+
+
+def _get_log_related_paths(model, visited):
+    paths = []
+    visited = visited | {model}
+    for field_name in _get_log_fields(model):
+        field = _get_log_model_field(model, field_name)
+        if not isinstance(field, django_models.ForeignKey):
+            continue
+        related_model = field.related_model
+        if not issubclass(related_model, LoggableMixin) or related_model in visited:
+            continue
+        nested = _get_log_related_paths(related_model, visited)
+        if nested:
+            paths.extend('%s__%s' % (field_name, path) for path in nested)
+        else:
+            paths.append(field_name)
+    return paths
+
 
 class LoggableMixin(object):
     """ Mixin to serialize model in logs.
@@ -335,34 +786,40 @@ class LoggableMixin(object):
         }
 
     def _get_log_context(self, entity_name):
-
         context = {}
-        for field in self.get_log_fields():
-            if not hasattr(self, field):
+        for field, writer in _get_log_context_extractor(self.__class__):
+            try:
+                value = getattr(self, field)
+            except (AttributeError, ObjectDoesNotExist):
                 continue
+            writer(context, entity_name, field, value)
+        return context
 
-            value = getattr(self, field)
-
-            name = "{}_{}".format(entity_name, field)
-            if isinstance(value, uuid.UUID):
-                context[name] = value.hex
-            elif isinstance(value, LoggableMixin):
-                context.update(value._get_log_context(field))
-            elif isinstance(value, datetime.date):
-                context[name] = value.isoformat()
-            elif isinstance(value, decimal.Decimal):
-                context[name] = float(value)
-            elif isinstance(value, dict):
-                context[name] = value
-            else:
-                context[name] = six.text_type(value)
+    @classmethod
+    def get_log_select_related(cls):
+        """ Return lookups of related objects that are used in log context.
 
-        return context
+            They could be used to load objects for logging without extra queries:
+                Project.objects.select_related(*Project.get_log_select_related())
+        """
+        try:
+            return _log_select_related[cls]
+        except KeyError:
+            _log_select_related[cls] = lookups = tuple(_get_log_related_paths(cls, set()))
+            return lookups
 
     @classmethod
     def get_permitted_objects_uuids(cls, user):
         return {}
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        """ Return query dictionary to search events of objects available to user.
+
+            Models whose events are found by context of other objects could return less terms.
+        """
+        return cls.get_permitted_objects_uuids(user)
+
 
 class BaseLoggerRegistry(object):
 
@@ -398,17 +855,44 @@ class BaseLoggerRegistry(object):
         return sorted(items)
 
 
+PERMITTED_EVENTS_UUIDS_CACHE_TIMEOUT = 10 * 60
+
+
+def _get_permitted_events_uuids_cache_key(user):
+    return 'permitted_events_uuids:%s' % user.uuid.hex
+
+
+def clean_permitted_events_uuids_cache(user):
+    key = _get_permitted_events_uuids_cache_key(user)
+    cache.delete(key)
+    # Concurrent request could cache terms before transaction is committed.
+    transaction.on_commit(lambda: cache.delete(key))
+
+
 class EventLoggerRegistry(BaseLoggerRegistry):
 
     def get_loggers(self):
         return [l for l in self.__dict__.values() if isinstance(l, EventLogger)]
 
     def get_permitted_objects_uuids(self, user):
-        from waldur_core.logging.utils import get_loggable_models
-        permitted_objects_uuids = {}
-        for model in get_loggable_models():
-            for field, uuids in model.get_permitted_objects_uuids(user).items():
-                permitted_objects_uuids[field] = [uuid.hex for uuid in uuids]
+        """ Return terms of events that are visible to user.
+
+            Staff and support users can see all events, so they do not have terms.
+            Terms are cached per user and are cleaned when user permissions are changed.
+        """
+        if user.is_staff or user.is_support:
+            return {}
+
+        key = _get_permitted_events_uuids_cache_key(user)
+        permitted_objects_uuids = cache.get(key)
+        if permitted_objects_uuids is None:
+            from waldur_core.logging.utils import get_loggable_models
+            permitted_objects_uuids = defaultdict(set)
+            for model in get_loggable_models():
+                for field, uuids in model.get_permitted_events_uuids(user).items():
+                    permitted_objects_uuids[field].update(uuid.hex for uuid in uuids)
+            permitted_objects_uuids = {field: sorted(uuids) for field, uuids in permitted_objects_uuids.items()}
+            cache.set(key, permitted_objects_uuids, PERMITTED_EVENTS_UUIDS_CACHE_TIMEOUT)
         return permitted_objects_uuids
 
 
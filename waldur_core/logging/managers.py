@@ -1,27 +1,33 @@
 from django.contrib.contenttypes import models as ct_models
 from django.db import models
-from django.db.models import Q
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+
+class AlertQuerySet(models.QuerySet):
+
+    def close(self):
+        """ Close open alerts with one UPDATE query.
+
+            Closed alert gets unique is_closed value to avoid unique together constraint break,
+            alert primary key is used for it.
+        """
+        return self.filter(closed__isnull=True).update(
+            closed=timezone.now(), modified=timezone.now(), is_closed=Cast('pk', models.CharField(max_length=32)))
 
 
 # XXX: This manager are very similar with quotas manager
-class AlertManager(models.Manager):
+class AlertManager(models.Manager.from_queryset(AlertQuerySet)):
 
     def filtered_for_user(self, user, queryset=None):
         from waldur_core.logging import utils
 
         if queryset is None:
             queryset = self.get_queryset()
-        # XXX: This circular dependency will be removed then filter_queryset_for_user
-        # will be moved to model manager method
-        from waldur_core.structure.managers import filter_queryset_for_user
-
-        query = Q()
-        for model in utils.get_loggable_models():
-            user_object_ids = filter_queryset_for_user(model.objects.all(), user).values_list('id', flat=True)
-            content_type_id = ct_models.ContentType.objects.get_for_model(model).id
-            query |= Q(object_id__in=user_object_ids, content_type_id=content_type_id)
+        # Structure models depend on this application, so they are imported lazily
+        from waldur_core.structure.models import ScopeVisibility
 
-        return queryset.filter(query)
+        return ScopeVisibility.objects.filter_for_user(queryset, user, utils.get_loggable_models())
 
     def for_objects(self, qs):
         kwargs = dict(
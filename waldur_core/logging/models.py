@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 import uuid
 import logging
+import threading
+import time
 
 from django.apps import apps
 from django.conf import settings
@@ -13,6 +15,7 @@ from django.db import models
 from django.template.loader import render_to_string
 from django.utils.lru_cache import lru_cache
 from django.utils import timezone
+from django.utils.six.moves.urllib.parse import urlparse
 from model_utils.models import TimeStampedModel
 import requests
 
@@ -23,6 +26,45 @@ from waldur_core.logging import managers
 
 logger = logging.getLogger(__name__)
 
+HOOK_REQUEST_TIMEOUT = 30
+HOOK_REQUEST_ATTEMPTS = 3
+HOOK_REQUEST_BACKOFF = 1  # delay before the second attempt in seconds, it is doubled after each attempt
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session(url):
+    """ Return HTTP session that is shared by all requests to the same destination host,
+        so connections are kept alive and reused by subsequent events.
+    """
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    with _http_sessions_lock:
+        if key not in _http_sessions:
+            _http_sessions[key] = requests.Session()
+        return _http_sessions[key]
+
+
+def post_with_retry(url, **kwargs):
+    """ Send POST request via shared session, retry it with exponential backoff
+        if connection fails or server responds with error.
+    """
+    kwargs.setdefault('timeout', HOOK_REQUEST_TIMEOUT)
+    delay = HOOK_REQUEST_BACKOFF
+    for attempt in range(1, HOOK_REQUEST_ATTEMPTS + 1):
+        try:
+            response = get_http_session(url).post(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == HOOK_REQUEST_ATTEMPTS:
+                raise
+        else:
+            if response.status_code < 500 or attempt == HOOK_REQUEST_ATTEMPTS:
+                return response
+        logger.debug('Request to %s has failed, attempt %s of %s.', url, attempt, HOOK_REQUEST_ATTEMPTS)
+        time.sleep(delay)
+        delay *= 2
+
 
 class UuidMixin(models.Model):
     # There is circular dependency between logging and core applications.
@@ -104,6 +146,26 @@ class AlertThresholdMixin(models.Model):
         """
         return cls.objects.all()
 
+    @classmethod
+    def get_checked_scopes(cls):
+        """
+        Return dictionary {content type id: object ids queryset} of scopes of checkable objects with threshold.
+        Threshold alerts of other scopes are not closed by threshold check.
+        """
+        objects = cls.get_checkable_objects().filter(threshold__gt=0, content_type__isnull=False)
+        content_type_ids = objects.order_by().values_list('content_type_id', flat=True).distinct()
+        return {content_type_id: objects.filter(content_type_id=content_type_id).values('object_id')
+                for content_type_id in content_type_ids}
+
+    @classmethod
+    def get_over_threshold_objects(cls):
+        """
+        Return checkable objects with threshold that is exceeded.
+        Models could override it to check threshold in database.
+        """
+        return [obj for obj in cls.get_checkable_objects().filter(threshold__gt=0).iterator()
+                if obj.is_over_threshold()]
+
 
 class EventTypesMixin(models.Model):
     """
@@ -142,6 +204,14 @@ class BaseHook(EventTypesMixin, UuidMixin, TimeStampedModel):
         else:
             return self_types | set(base_types.event_types)
 
+    def process(self, event):
+        raise NotImplementedError()
+
+    def process_batch(self, events):
+        """ Send several events. By default events are sent one by one. """
+        for event in events:
+            self.process(event)
+
     @classmethod
     def get_active_hooks(cls):
         return [obj for hook in cls.__subclasses__() for obj in hook.objects.filter(is_active=True)]
@@ -175,11 +245,11 @@ class WebHook(BaseHook):
 
         # encode event as JSON
         if self.content_type == WebHook.ContentTypeChoices.JSON:
-            requests.post(self.destination_url, json=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+            post_with_retry(self.destination_url, json=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
 
         # encode event as form
         elif self.content_type == WebHook.ContentTypeChoices.FORM:
-            requests.post(self.destination_url, data=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+            post_with_retry(self.destination_url, data=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
 
 
 class PushHook(BaseHook):
@@ -239,23 +309,30 @@ class PushHook(BaseHook):
         if self.type == self.Type.IOS:
             payload['content-available'] = '1'
         logger.debug('Submitting GCM push notification with headers %s, payload: %s' % (headers, payload))
-        requests.post(endpoint, json=payload, headers=headers)
+        post_with_retry(endpoint, json=payload, headers=headers)
 
 
 class EmailHook(BaseHook):
     email = models.EmailField(max_length=75)
 
     def process(self, event):
+        self.process_batch([event])
+
+    def process_batch(self, events):
+        """ Send all events with one digest email. """
         if not self.email:
             logger.debug('Skipping processing of email hook (PK=%s) because email is not defined' % self.pk)
             return
-        # Prevent mutations of event because otherwise subsequent hook processors would fail
-        context = event.copy()
+        # Prevent mutations of events because otherwise subsequent hook processors would fail
+        contexts = []
+        for event in events:
+            context = event.copy()
+            context['timestamp'] = timestamp_to_datetime(event['timestamp'])
+            contexts.append(context)
         subject = 'Notifications from Waldur'
-        context['timestamp'] = timestamp_to_datetime(event['timestamp'])
-        text_message = context['message']
-        html_message = render_to_string('logging/email.html', {'events': [context]})
-        logger.debug('Submitting email hook to %s, payload: %s', self.email, context)
+        text_message = '\n'.join(context['message'] for context in contexts)
+        html_message = render_to_string('logging/email.html', {'events': contexts})
+        logger.debug('Submitting email hook to %s, payload: %s', self.email, contexts)
         send_mail(subject, text_message, settings.DEFAULT_FROM_EMAIL, [self.email], html_message=html_message)
 
 
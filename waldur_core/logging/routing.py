@@ -0,0 +1,139 @@
+""" Routing of events to hooks.
+
+Event is sent via hook if event type is subscribed by hook and hook owner is permitted
+to see the event. Instead of checking each active hook for each event, routing index
+of active hooks is built once and cached:
+
+    {
+        'types': {event type: [hook key]},
+        'owners': {hook key: owner id},
+    }
+
+Hook key is a pair (hook content type id, hook id). Index does not depend on users
+permissions, so it stays small and is invalidated only when hooks or system notifications
+are changed.
+
+Visibility of event for hook owner is checked with the same compact terms that are used
+for events search, see EventLoggerRegistry.get_permitted_objects_uuids. Terms are cached
+per user and are cleaned only for users whose permissions are changed. Staff and support
+users do not have terms, as they are permitted to see all events.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import six
+
+ROUTING_INDEX_CACHE_KEY = 'logging_hooks_routing_index'
+ROUTING_INDEX_CACHE_TIMEOUT = 60 * 60
+
+
+def build_routing_index():
+    from waldur_core.logging.models import BaseHook, SystemNotification
+
+    system_types = {notification.hook_content_type_id: set(notification.event_types)
+                    for notification in SystemNotification.objects.all()}
+
+    types = defaultdict(list)
+    owners = {}
+    for model in BaseHook.get_all_models():
+        content_type = ContentType.objects.get_for_model(model)
+        for hook in model.objects.filter(is_active=True).only('pk', 'user', 'event_types'):
+            key = (content_type.id, hook.pk)
+            owners[key] = hook.user_id
+            for event_type in set(hook.event_types) | system_types.get(content_type.id, set()):
+                types[event_type].append(key)
+
+    return {
+        'types': dict(types),
+        'owners': owners,
+    }
+
+
+def get_owners_terms(owner_ids):
+    """ Return {owner id: {context key: set of values}} of events that are visible to hooks owners.
+
+        Terms are None for owners that are permitted to see all events.
+    """
+    from waldur_core.logging.loggers import event_logger
+
+    owners_terms = {}
+    for user in get_user_model().objects.filter(id__in=set(owner_ids)):
+        if user.is_staff or user.is_support:
+            owners_terms[user.id] = None
+        else:
+            terms = event_logger.get_permitted_objects_uuids(user)
+            owners_terms[user.id] = {key: set(values) for key, values in terms.items()}
+    return owners_terms
+
+
+def get_routing_index():
+    index = cache.get(ROUTING_INDEX_CACHE_KEY)
+    if index is None:
+        index = build_routing_index()
+        cache.set(ROUTING_INDEX_CACHE_KEY, index, ROUTING_INDEX_CACHE_TIMEOUT)
+    return index
+
+
+def clean_routing_index():
+    cache.delete(ROUTING_INDEX_CACHE_KEY)
+    # Concurrent task could cache index before transaction is committed.
+    transaction.on_commit(lambda: cache.delete(ROUTING_INDEX_CACHE_KEY))
+
+
+def _is_visible(event, terms):
+    if terms is None:
+        return True
+    for context_key, value in event.get('context', {}).items():
+        if isinstance(value, six.string_types) and value in terms.get(context_key, ()):
+            return True
+    return False
+
+
+def get_event_hook_keys(event, index=None, owners_terms=None):
+    """ Return keys of hooks that should process given event. """
+    if index is None:
+        index = get_routing_index()
+    hook_keys = index['types'].get(event['type'])
+    if not hook_keys:
+        return []
+
+    if owners_terms is None:
+        owners_terms = get_owners_terms(index['owners'][key] for key in hook_keys)
+    # owner could be deleted after index was built, such owner does not have terms
+    return [key for key in hook_keys if _is_visible(event, owners_terms.get(index['owners'][key], {}))]
+
+
+def get_event_hooks(event):
+    """ Return hooks that should process given event with one query per hook model. """
+    return [hook for hook, _ in get_events_hooks([event])]
+
+
+def get_events_hooks(events):
+    """ Group events by hooks that should process them.
+
+        Return list of pairs (hook, events), hooks are loaded with one query per hook model.
+    """
+    index = get_routing_index()
+    owner_ids = set(index['owners'][key] for event in events for key in index['types'].get(event['type'], []))
+    owners_terms = get_owners_terms(owner_ids)
+    hook_events = defaultdict(list)
+    for event in events:
+        for key in get_event_hook_keys(event, index, owners_terms):
+            hook_events[key].append(event)
+
+    hook_ids = defaultdict(list)
+    for content_type_id, hook_id in hook_events:
+        hook_ids[content_type_id].append(hook_id)
+
+    result = []
+    for content_type_id, ids in hook_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        # hook could be deactivated or deleted after index was built
+        for hook in model.objects.filter(pk__in=ids, is_active=True):
+            result.append((hook, hook_events[(content_type_id, hook.pk)]))
+    return result
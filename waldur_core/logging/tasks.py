@@ -1,39 +1,75 @@
 import logging
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from celery import shared_task
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
 from django.utils import timezone
 
-from waldur_core.logging.loggers import alert_logger, event_logger
-from waldur_core.logging.models import BaseHook, Alert, AlertThresholdMixin
+from waldur_core.logging import elasticsearch_client, routing
+from waldur_core.logging.loggers import alert_logger
+from waldur_core.logging.models import Alert, AlertThresholdMixin
 
 
 logger = logging.getLogger(__name__)
 
 
+HOOKS_DELIVERY_CONCURRENCY = 4
+
+
 @shared_task(name='waldur_core.logging.process_event')
 def process_event(event):
-    for hook in BaseHook.get_active_hooks():
-        if check_event(event, hook):
-            hook.process(event)
+    process_events([event])
+
+
+@shared_task(name='waldur_core.logging.process_events')
+def process_events(events):
+    """ Send events batch via hooks. Each hook receives all its events at once,
+        hooks are processed concurrently by bounded pool of threads.
+    """
+    batches = routing.get_events_hooks(events)
+    if len(batches) > 1 and HOOKS_DELIVERY_CONCURRENCY > 1:
+        pool = ThreadPool(min(HOOKS_DELIVERY_CONCURRENCY, len(batches)))
+        try:
+            pool.map(_process_hook_events, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for batch in batches:
+            _process_hook_events(batch)
 
 
-def check_event(event, hook):
-    # Check that event matches with hook
-    if event['type'] not in hook.all_event_types:
-        return False
-    for key, uuids in event_logger.get_permitted_objects_uuids(hook.user).items():
-        if key in event['context'] and event['context'][key] in uuids:
-            return True
-    return False
+def _process_hook_events(batch):
+    hook, events = batch
+    try:
+        hook.process_batch(events)
+    except Exception:
+        # Failure of one hook should not prevent delivery of events via other hooks.
+        logger.exception('Unable to send %s events via %s hook %s.', len(events), hook.__class__.__name__, hook.pk)
 
 
 @shared_task(name='waldur_core.logging.close_alerts_without_scope')
 def close_alerts_without_scope():
-    for alert in Alert.objects.filter(closed__isnull=True).iterator():
-        if alert.scope is None:
-            logger.error('Alert without scope was not closed. Alert id: %s.', alert.id)
-            alert.close()
+    """ Close open alerts whose scope does not exist anymore with one UPDATE query per content type. """
+    open_alerts = Alert.objects.filter(closed__isnull=True)
+    # Scope is lost if its content type or object id was cleared.
+    dangling = {None: open_alerts.filter(Q(content_type__isnull=True) | Q(object_id__isnull=True))}
+    content_type_ids = open_alerts.exclude(content_type__isnull=True).values_list(
+        'content_type_id', flat=True).order_by().distinct()
+    for content_type_id in content_type_ids:
+        alerts = open_alerts.filter(content_type_id=content_type_id)
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is not None:
+            alerts = alerts.exclude(object_id__in=model._base_manager.values('pk'))
+        dangling[content_type_id] = alerts
+
+    for content_type_id, alerts in dangling.items():
+        count = alerts.close()
+        if count:
+            logger.error('%s alerts without scope were not closed. Content type id: %s.', count, content_type_id)
 
 
 @shared_task(name='waldur_core.logging.alerts_cleanup')
@@ -45,17 +81,22 @@ def alerts_cleanup():
 
 @shared_task(name='waldur_core.logging.check_threshold')
 def check_threshold():
+    """ Open alerts for scopes of objects with exceeded threshold.
+
+        Threshold alerts of other scopes of checkable objects with threshold are closed.
+    """
+    alerts = []
+    checked_scopes = defaultdict(list)
     for model in AlertThresholdMixin.get_all_models():
-        for obj in model.get_checkable_objects().filter(threshold__gt=0).iterator():
-            if obj.is_over_threshold() and obj.scope:
-                alert_logger.threshold.warning(
-                    'Threshold for {scope_name} is exceeded.',
-                    scope=obj.scope,
-                    alert_type='threshold_exceeded',
-                    alert_context={
-                        'object': obj
-                    })
-            else:
-                alert_logger.threshold.close(
-                    scope=obj.scope,
-                    alert_type='threshold_exceeded')
+        for obj in model.get_over_threshold_objects():
+            if obj.scope:
+                alerts.append((obj.scope, 'threshold_exceeded', Alert.SeverityChoices.WARNING,
+                               'Threshold for {scope_name} is exceeded.', {'object': obj}))
+        for content_type_id, object_ids in model.get_checked_scopes().items():
+            checked_scopes[content_type_id].append(object_ids)
+    alert_logger.threshold.reconcile('threshold_exceeded', alerts, checked_scopes)
+
+
+@shared_task(name='waldur_core.logging.refresh_events_counts')
+def refresh_events_counts(body, keys):
+    elasticsearch_client.EventsCountCache.refresh(body, keys)
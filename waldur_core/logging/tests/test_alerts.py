@@ -3,7 +3,8 @@ import mock
 
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework import test, status
 
@@ -277,3 +278,110 @@ class AlertUniquenessTest(test.APITransactionTestCase):
 
             alert, created = self.log_alert()
             self.assertEqual(created, False)
+
+
+class AlertBatchTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        self.projects = structure_factories.ProjectFactory.create_batch(3)
+        self.logger = loggers.alert_logger.threshold
+        self.quota = self.projects[0].quotas.first()
+
+    def get_alerts(self, severity=models.Alert.SeverityChoices.WARNING, message='Threshold for {scope_name}.'):
+        return [(project, 'threshold_exceeded', severity, message, {'object': self.quota})
+                for project in self.projects]
+
+    def get_open_alerts(self):
+        return models.Alert.objects.filter(alert_type='threshold_exceeded', closed__isnull=True)
+
+    def test_alerts_are_created_in_bulk(self):
+        self.assertEqual(self.logger.process_batch(self.get_alerts()), (3, 0))
+
+        alert = self.get_open_alerts().get(object_id=self.projects[1].id)
+        self.assertEqual(alert.scope, self.projects[1])
+        self.assertEqual(alert.message, 'Threshold for %s.' % self.projects[0].name)
+        self.assertEqual(alert.context['object_uuid'], self.quota.uuid.hex)
+
+    def test_only_changed_alerts_are_updated(self):
+        self.logger.process_batch(self.get_alerts())
+        alerts = self.get_alerts()
+        alerts[0] = alerts[0][:2] + (models.Alert.SeverityChoices.ERROR,) + alerts[0][3:]
+
+        self.assertEqual(self.logger.process_batch(alerts), (0, 1))
+        self.assertEqual(self.get_open_alerts().get(object_id=self.projects[0].id).severity,
+                         models.Alert.SeverityChoices.ERROR)
+        self.assertEqual(self.get_open_alerts().count(), 3)
+
+    def test_open_alerts_are_loaded_with_one_query_per_content_type(self):
+        self.logger.process_batch(self.get_alerts())
+        alerts = self.get_alerts()
+
+        with self.assertNumQueries(1):
+            self.logger.process_batch(alerts)
+
+    def test_alerts_are_closed_in_bulk(self):
+        self.logger.process_batch(self.get_alerts())
+
+        self.assertEqual(self.logger.close_batch(self.projects[:2], 'threshold_exceeded'), 2)
+        self.assertEqual(list(self.get_open_alerts().values_list('object_id', flat=True)), [self.projects[2].id])
+        closed = models.Alert.objects.filter(closed__isnull=False)
+        self.assertEqual(len(set(closed.values_list('is_closed', flat=True))), 2)
+
+    def test_reconcile_closes_alerts_that_are_not_reported(self):
+        self.logger.process_batch(self.get_alerts())
+
+        result = self.logger.reconcile('threshold_exceeded', self.get_alerts()[1:])
+        self.assertEqual(result, (0, 0, 1))
+        self.assertFalse(self.get_open_alerts().filter(object_id=self.projects[0].id).exists())
+
+    def test_reconcile_closes_alerts_of_checked_scopes_only(self):
+        self.logger.process_batch(self.get_alerts())
+        content_type = ContentType.objects.get_for_model(self.projects[0])
+        checked_scopes = {content_type.id: [[self.projects[0].id, self.projects[1].id]]}
+
+        with self.assertNumQueries(1):
+            result = self.logger.reconcile('threshold_exceeded', [], checked_scopes)
+        self.assertEqual(result, (0, 0, 2))
+        self.assertEqual(list(self.get_open_alerts().values_list('object_id', flat=True)), [self.projects[2].id])
+
+    def test_alerts_are_created_one_by_one_if_concurrent_alert_exists(self):
+        alerts = self.get_alerts()
+        with mock.patch.object(models.Alert.objects, 'bulk_create', side_effect=IntegrityError):
+            self.assertEqual(self.logger.process_batch(alerts), (3, 0))
+        self.assertEqual(self.get_open_alerts().count(), 3)
+
+
+class AlertsWithoutScopeTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        self.project = structure_factories.ProjectFactory()
+        self.alert = factories.AlertFactory(scope=self.project)
+
+    def test_alerts_are_closed_when_scope_is_deleted(self):
+        self.project.delete()
+
+        self.alert.refresh_from_db()
+        self.assertIsNotNone(self.alert.closed)
+        self.assertEqual(self.alert.is_closed, str(self.alert.pk))
+
+    def test_alerts_of_missing_scopes_are_closed_with_one_query_per_content_type(self):
+        from waldur_core.logging.tasks import close_alerts_without_scope
+
+        content_type = ContentType.objects.get_for_model(self.project)
+        dangling_alerts = [models.Alert.objects.create(
+            content_type=content_type, object_id=10 ** 6, alert_type=alert_type,
+            severity=models.Alert.SeverityChoices.INFO, context={}) for alert_type in ('first', 'second', 'third')]
+        customer_alert = factories.AlertFactory(scope=self.project.customer)
+
+        with CaptureQueriesContext(connection) as context:
+            close_alerts_without_scope()
+        # distinct content types, alerts without content type, one close query per content type
+        queries = [query['sql'] for query in context.captured_queries if query['sql'] != 'BEGIN']
+        self.assertEqual(len(queries), 4)
+
+        for alert in dangling_alerts:
+            alert.refresh_from_db()
+            self.assertIsNotNone(alert.closed)
+        for alert in (self.alert, customer_alert):
+            alert.refresh_from_db()
+            self.assertIsNone(alert.closed)
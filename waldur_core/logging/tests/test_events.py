@@ -1,8 +1,10 @@
+import json
 import unittest
 
 import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
 from rest_framework import test
 from rest_framework import status
@@ -11,7 +13,7 @@ from waldur_core.structure import models as structure_models
 from waldur_core.structure.tests import factories as structure_factories
 
 from . import factories
-from .. import utils
+from .. import elasticsearch_client, tasks, utils
 from ..loggers import EventLogger, event_logger
 
 
@@ -30,6 +32,7 @@ def override_elasticsearch_settings(**kwargs):
 @override_elasticsearch_settings()
 class BaseEventsApiTest(test.APITransactionTestCase):
     def setUp(self):
+        elasticsearch_client.client_registry.clear()
         self.es_patcher = mock.patch('waldur_core.logging.elasticsearch_client.Elasticsearch')
         self.mocked_es = self.es_patcher.start()
         self.mocked_es().search.return_value = {'hits': {'total': 0, 'hits': []}}
@@ -225,3 +228,275 @@ class ScopeTest(BaseEventsApiTest):
         self.client.force_authenticate(user=owner)
         self._get_events_by_scope(structure_factories.CustomerFactory.get_url(customer))
         self.assertEqual(self.must_terms, {'customer_uuid.keyword': [customer.uuid.hex]})
+
+
+class EventCursorPaginationTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventCursorPaginationTest, self).setUp()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = factories.EventFactory.get_list_url()
+
+    def set_hits(self, count):
+        self.mocked_es().search.return_value = {'hits': {'total': 100, 'hits': [
+            {'_source': {'message': 'event %s' % i}, 'sort': [1500000000000 - i, 'event#%s' % i]}
+            for i in range(count)
+        ]}}
+
+    def get_search_body(self):
+        return self.mocked_es().search.call_args[1]['body']
+
+    def test_events_are_sorted_by_timestamp_and_uid(self):
+        self.set_hits(2)
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(self.get_search_body()['sort'], [
+            {'@timestamp': {'order': 'desc'}},
+            {'_uid': {'order': 'desc'}},
+        ])
+        self.assertNotIn('search_after', self.get_search_body())
+        self.assertNotIn('X-Result-Count', response)
+        self.assertFalse(self.mocked_es().count.called)
+
+    def test_next_link_contains_cursor_of_the_last_event(self):
+        self.set_hits(2)
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 2})
+        next_url = response['Link'][1:response['Link'].index('>')]
+
+        self.client.get(next_url)
+        self.assertEqual(self.get_search_body()['search_after'], [1500000000000 - 1, 'event#1'])
+
+    def test_next_link_is_not_provided_for_the_last_page(self):
+        self.set_hits(1)
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 2})
+        self.assertEqual(response['Link'], '')
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class EventExportTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventExportTest, self).setUp()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = factories.EventFactory.get_list_url() + 'export/'
+
+    def test_events_are_streamed_with_scroll_api(self):
+        self.mocked_es().search.return_value = {
+            '_scroll_id': 'scroll-1',
+            '_shards': {'failed': 0, 'total': 1},
+            'hits': {'total': 3, 'hits': [{'_source': {'message': 'first'}}, {'_source': {'message': 'second'}}]},
+        }
+        self.mocked_es().scroll.side_effect = [
+            {'_scroll_id': 'scroll-1', '_shards': {'failed': 0, 'total': 1},
+             'hits': {'total': 3, 'hits': [{'_source': {'message': 'third'}}]}},
+            {'_scroll_id': 'scroll-1', '_shards': {'failed': 0, 'total': 1},
+             'hits': {'total': 3, 'hits': []}},
+        ]
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['first', 'second', 'third'])
+        self.assertEqual(self.mocked_es().search.call_args[1]['scroll'], '5m')
+        self.assertTrue(self.mocked_es().clear_scroll.called)
+
+
+class EventPermissionTermsTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventPermissionTermsTest, self).setUp()
+        self.customer = structure_factories.CustomerFactory()
+        self.project = structure_factories.ProjectFactory(customer=self.customer)
+        structure_factories.TestNewInstanceFactory.create_batch(
+            3, service_project_link__project=self.project)
+        self.user = structure_factories.UserFactory()
+        self.client.force_authenticate(user=self.user)
+
+    def get_should_terms(self):
+        self.client.get(factories.EventFactory.get_list_url())
+        query = self.mocked_es().search.call_args[1]['body']['query']['bool']
+        terms = {}
+        for term in query.get('should', []):
+            terms.update(term['terms'])
+        return terms
+
+    def test_customer_owner_events_are_found_by_customer_uuid(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.OWNER)
+
+        terms = self.get_should_terms()
+        self.assertEqual(terms['customer_uuid'], [self.customer.uuid.hex])
+        self.assertEqual(terms['project_uuid'], [])
+        self.assertEqual(terms['user_uuid'], [self.user.uuid.hex])
+        self.assertNotIn('test_new_instance_uuid', terms)
+
+    def test_project_administrator_events_are_found_by_project_uuid(self):
+        self.project.add_user(self.user, structure_models.ProjectRole.ADMINISTRATOR)
+
+        terms = self.get_should_terms()
+        self.assertEqual(terms['customer_uuid'], [])
+        self.assertEqual(terms['project_uuid'], [self.project.uuid.hex])
+
+    def test_customer_support_events_are_found_by_projects_of_customer(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.SUPPORT)
+
+        terms = self.get_should_terms()
+        self.assertEqual(terms['customer_uuid'], [])
+        self.assertEqual(terms['project_uuid'], [self.project.uuid.hex])
+
+    def test_staff_events_are_not_filtered_by_permitted_objects(self):
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.assertEqual(self.get_should_terms(), {})
+
+    def test_terms_are_cached_until_permissions_are_changed(self):
+        self.get_should_terms()
+        with self.assertNumQueries(0):
+            event_logger.get_permitted_objects_uuids(self.user)
+
+        self.project.add_user(self.user, structure_models.ProjectRole.MANAGER)
+        self.assertEqual(self.get_should_terms()['project_uuid'], [self.project.uuid.hex])
+
+
+class EventsCountCacheTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventsCountCacheTest, self).setUp()
+        cache.clear()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = factories.EventFactory.get_list_url()
+        self.mocked_es().count.return_value = {'count': 10}
+        self.mocked_es().search.side_effect = self.aggregate
+
+    def aggregate(self, **kwargs):
+        # Count of events before point is the last two digits of point, count of all events is 20.
+        ranges = kwargs['body']['aggs']['timestamp_ranges']['date_range']['ranges']
+        return {'aggregations': {'timestamp_ranges': {'buckets': [
+            dict(r, doc_count=r['to'] // 1000 % 100 if 'to' in r else 20) for r in ranges
+        ]}}}
+
+    def get_count_history(self, points):
+        return self.client.get(self.url + 'count_history/', {'point': points})
+
+    def test_count_is_cached_by_query(self):
+        response = self.client.get(self.url + 'count/')
+        self.client.get(self.url + 'count/')
+        self.assertEqual(response.data, {'count': 10})
+        self.assertEqual(self.mocked_es().count.call_count, 1)
+
+        self.client.get(self.url + 'count/', {'search': 'text'})
+        self.assertEqual(self.mocked_es().count.call_count, 2)
+
+    @mock.patch('waldur_core.core.tasks.send_task')
+    def test_stale_count_is_returned_and_refreshed_in_background(self, mocked_send_task):
+        with mock.patch('waldur_core.logging.elasticsearch_client.EVENTS_COUNT_CACHE_TIMEOUT', -1):
+            self.client.get(self.url + 'count/')
+            self.mocked_es().count.return_value = {'count': 20}
+            response = self.client.get(self.url + 'count/')
+
+        self.assertEqual(response.data, {'count': 10})
+        self.assertEqual(self.mocked_es().count.call_count, 1)
+        mocked_send_task.assert_called_once_with('logging', 'refresh_events_counts')
+        body, keys = mocked_send_task.return_value.call_args[0]
+
+        tasks.refresh_events_counts(body, keys)
+        self.assertEqual(self.client.get(self.url + 'count/').data, {'count': 20})
+
+    def test_count_history_points_are_aligned_to_buckets(self):
+        response = self.get_count_history([1500000030, 1500000075])
+        self.assertEqual([item['point'] for item in response.data], [1500000000, 1500000060])
+
+    def test_overlapping_count_history_reuses_computed_buckets(self):
+        first_response = self.get_count_history([1500000000, 1500000060])
+        second_response = self.get_count_history([1500000060, 1500000120])
+
+        self.assertEqual(self.mocked_es().search.call_count, 2)
+        ranges = self.mocked_es().search.call_args[1]['body']['aggs']['timestamp_ranges']['date_range']['ranges']
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(first_response.data[1], second_response.data[0])
+
+
+class ElasticsearchClientRegistryTest(test.APISimpleTestCase):
+    def setUp(self):
+        self.registry = elasticsearch_client.ElasticsearchClientRegistry()
+        self.settings = {
+            'host': 'example.com',
+            'port': '9999',
+            'protocol': 'http',
+            'maxsize': 5,
+            'timeout': 30,
+        }
+
+    def test_client_is_shared_and_configured(self):
+        client = self.registry.get_client(self.settings)
+        self.assertIs(self.registry.get_client(dict(self.settings)), client)
+
+        connection = client.transport.get_connection()
+        self.assertEqual(connection.pool.pool.maxsize, 5)
+        self.assertEqual(connection.timeout, 30)
+
+    def test_client_is_created_again_if_settings_are_changed(self):
+        client = self.registry.get_client(self.settings)
+        self.settings['port'] = '9200'
+        self.assertIsNot(self.registry.get_client(self.settings), client)
+
+    def test_client_is_created_again_in_forked_process(self):
+        client = self.registry.get_client(self.settings)
+        with mock.patch('waldur_core.logging.elasticsearch_client.os.getpid', return_value=-1):
+            self.assertIsNot(self.registry.get_client(self.settings), client)
+
+    def test_pool_usage_stats(self):
+        self.registry.get_client(self.settings)
+        self.assertEqual(self.registry.get_stats(), [{
+            'host': 'http://example.com:9999',
+            'connections': 0,
+            'requests': 0,
+            'idle': 0,
+            'maxsize': 5,
+        }])
+
+    def test_project_member_events_are_found_by_uuids_of_linked_services(self):
+        self.project.add_user(self.user, structure_models.ProjectRole.ADMINISTRATOR)
+        link = structure_factories.TestServiceProjectLinkFactory(project=self.project)
+
+        terms = self.get_should_terms()
+        self.assertIn(link.service.uuid.hex, terms['service_uuid'])
+
+    def test_customer_support_events_are_found_by_uuids_of_customer_services(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.SUPPORT)
+        service = structure_factories.TestServiceFactory(customer=self.customer)
+
+        terms = self.get_should_terms()
+        self.assertIn(service.uuid.hex, terms['service_uuid'])
+
+    def test_services_of_owned_customer_are_found_by_customer_uuid(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.OWNER)
+        service = structure_factories.TestServiceFactory(customer=self.customer)
+
+        terms = self.get_should_terms()
+        self.assertNotIn(service.uuid.hex, terms['service_uuid'])
+
+    def test_shared_service_settings_events_are_visible_to_non_staff_user(self):
+        shared_settings = structure_factories.ServiceSettingsFactory(shared=True)
+        private_settings = structure_factories.ServiceSettingsFactory(shared=False)
+
+        terms = self.get_should_terms()
+        self.assertIn(shared_settings.uuid.hex, terms['service_settings_uuid'])
+        self.assertNotIn(private_settings.uuid.hex, terms['service_settings_uuid'])
+
+    def test_terms_are_cleaned_when_project_is_created_for_customer_support(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.SUPPORT)
+        self.get_should_terms()
+
+        project = structure_factories.ProjectFactory(customer=self.customer)
+        self.assertIn(project.uuid.hex, self.get_should_terms()['project_uuid'])
+
+    def test_terms_are_cleaned_when_project_is_deleted(self):
+        self.customer.add_user(self.user, structure_models.CustomerRole.SUPPORT)
+        project = structure_factories.ProjectFactory(customer=self.customer)
+        self.get_should_terms()
+
+        project_uuid = project.uuid.hex
+        project.delete()
+        self.assertNotIn(project_uuid, self.get_should_terms()['project_uuid'])
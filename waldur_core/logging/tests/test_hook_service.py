@@ -1,14 +1,17 @@
 import logging
 import mock
+import requests
 import time
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core import mail
+from django.core.cache import cache
 from rest_framework import test
 
-from waldur_core.logging import models as logging_models
+from waldur_core.logging import models as logging_models, routing
 from waldur_core.logging.log import HookHandler
-from waldur_core.logging.tasks import process_event
+from waldur_core.logging.tasks import process_event, process_events
 from waldur_core.structure import models as structure_models
 from waldur_core.structure.log import event_logger
 from waldur_core.structure.tests import factories as structure_factories
@@ -49,8 +52,9 @@ class TestHookService(test.APITransactionTestCase):
         event_logger.customer.warning(self.message,
                                       event_type=self.event_type,
                                       event_context={'customer': self.customer})
+        handler.flush()
 
-        mocked_task.assert_called_once_with('waldur_core.logging.process_event', mock.ANY, {}, countdown=2)
+        mocked_task.assert_called_once_with('waldur_core.logging.process_events', mock.ANY, {}, countdown=2)
         mocked_task.reset_mock()
 
         # Remove hook handler so that other tests won't depend on it
@@ -79,8 +83,9 @@ class TestHookService(test.APITransactionTestCase):
         # Verify that destination address of message is correct
         self.assertEqual(mail.outbox[0].to, [email_hook.email])
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_webhook_makes_post_request_against_destination_url(self, requests_post):
+        requests_post.return_value.status_code = 200
 
         # Create web hook for customer owner
         self.web_hook = logging_models.WebHook.objects.create(user=self.owner,
@@ -92,7 +97,63 @@ class TestHookService(test.APITransactionTestCase):
 
         # Event is captured and POST request is triggered because event_type and user_uuid match
         requests_post.assert_called_once_with(
-            self.web_hook.destination_url, json=mock.ANY, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+            self.web_hook.destination_url, json=mock.ANY, verify=settings.VERIFY_WEBHOOK_REQUESTS, timeout=mock.ANY)
+
+    @mock.patch('celery.app.base.Celery.send_task')
+    def test_logger_handler_sends_events_in_batches(self, mocked_task):
+        handler = HookHandler(batch_size=2, batch_window=60)
+        logger = logging.getLogger('waldur_core.test_hooks')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        try:
+            for _ in range(3):
+                logger.info(self.message, extra={'event_type': self.event_type, 'event_context': {}})
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        self.assertEqual(mocked_task.call_count, 2)
+        events = mocked_task.call_args_list[0][0][1][0]
+        self.assertEqual(len(events), 2)
+
+    def test_email_hook_sends_digest_of_events_batch(self):
+        logging_models.EmailHook.objects.create(user=self.owner,
+                                                email=self.owner.email,
+                                                event_types=[self.event_type])
+        other_event = dict(self.event, message='Customer has been updated again.')
+
+        process_events([self.event, other_event])
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(other_event['message'], mail.outbox[0].body)
+
+    @mock.patch('requests.Session.post')
+    def test_webhook_request_is_retried_on_server_error(self, requests_post):
+        requests_post.return_value.status_code = 503
+        web_hook = logging_models.WebHook.objects.create(user=self.owner,
+                                                         destination_url='http://example.com/',
+                                                         event_types=[self.event_type])
+
+        with mock.patch('waldur_core.logging.models.time.sleep') as sleep:
+            web_hook.process(self.event)
+
+        self.assertEqual(requests_post.call_count, logging_models.HOOK_REQUEST_ATTEMPTS)
+        self.assertEqual(sleep.call_count, logging_models.HOOK_REQUEST_ATTEMPTS - 1)
+
+    @mock.patch('requests.Session.post')
+    def test_failed_hook_does_not_prevent_delivery_via_other_hooks(self, requests_post):
+        requests_post.side_effect = requests.ConnectionError()
+        logging_models.WebHook.objects.create(user=self.owner,
+                                              destination_url='http://example.com/',
+                                              event_types=[self.event_type])
+        logging_models.EmailHook.objects.create(user=self.owner,
+                                                email=self.owner.email,
+                                                event_types=[self.event_type])
+
+        with mock.patch('waldur_core.logging.models.time.sleep'):
+            process_events([self.event])
+
+        self.assertEqual(len(mail.outbox), 1)
 
     def test_email_hook_processor_can_be_called_twice(self):
         # Create email hook for customer owner
@@ -103,3 +164,69 @@ class TestHookService(test.APITransactionTestCase):
         # If event is not mutated, exception is not raised, see also SENTRY-1396
         email_hook.process(self.event)
         email_hook.process(self.event)
+
+
+class HooksRoutingTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.owner = structure_factories.UserFactory()
+        self.customer = structure_factories.CustomerFactory()
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        self.event_type = 'customer_update_succeeded'
+        self.event = {
+            'message': 'Customer has been updated.',
+            'type': self.event_type,
+            'context': event_logger.customer.compile_context(customer=self.customer),
+            'timestamp': time.time()
+        }
+        self.hook = logging_models.EmailHook.objects.create(
+            user=self.owner, email=self.owner.email, event_types=[self.event_type])
+
+    def test_hook_is_matched_by_event_type_and_context(self):
+        self.assertEqual(routing.get_event_hooks(self.event), [self.hook])
+
+    def test_hook_is_not_matched_if_event_type_is_not_subscribed(self):
+        self.event['type'] = 'customer_deletion_succeeded'
+        self.assertEqual(routing.get_event_hooks(self.event), [])
+
+    def test_event_is_matched_with_dictionary_lookups_only(self):
+        index = routing.get_routing_index()
+        owners_terms = routing.get_owners_terms(index['owners'].values())
+        with self.assertNumQueries(0):
+            keys = routing.get_event_hook_keys(self.event, index, owners_terms)
+        self.assertEqual(len(keys), 1)
+
+    def test_owner_terms_are_invalidated_on_role_revocation(self):
+        routing.get_event_hooks(self.event)
+        self.customer.remove_user(self.owner)
+        self.assertEqual(routing.get_event_hooks(self.event), [])
+
+    def test_index_is_not_invalidated_on_permission_change(self):
+        routing.get_routing_index()
+        self.customer.add_user(structure_factories.UserFactory(), structure_models.CustomerRole.OWNER)
+        self.assertIsNotNone(cache.get(routing.ROUTING_INDEX_CACHE_KEY))
+
+    def test_index_does_not_contain_objects_permitted_to_owners(self):
+        index = routing.get_routing_index()
+        self.assertEqual(set(index.keys()), {'types', 'owners'})
+
+    def test_index_is_invalidated_on_hook_change(self):
+        routing.get_routing_index()
+        self.hook.event_types = ['customer_deletion_succeeded']
+        self.hook.save()
+        self.assertEqual(routing.get_event_hooks(self.event), [])
+
+    def test_index_is_invalidated_on_system_notification_creation(self):
+        routing.get_routing_index()
+        self.event['type'] = 'customer_deletion_succeeded'
+        logging_models.SystemNotification.objects.create(
+            hook_content_type=ContentType.objects.get_for_model(logging_models.EmailHook),
+            event_types=['customer_deletion_succeeded'])
+        self.assertEqual(routing.get_event_hooks(self.event), [self.hook])
+
+    def test_staff_hook_is_matched_for_any_context(self):
+        staff = structure_factories.UserFactory(is_staff=True)
+        staff_hook = logging_models.EmailHook.objects.create(
+            user=staff, email=staff.email, event_types=[self.event_type])
+        self.event['context'] = event_logger.customer.compile_context(
+            customer=structure_factories.CustomerFactory())
+        self.assertEqual(routing.get_event_hooks(self.event), [staff_hook])
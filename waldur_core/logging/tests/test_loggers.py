@@ -0,0 +1,130 @@
+import logging
+
+import mock
+from rest_framework import test
+
+from waldur_core.logging import loggers
+from waldur_core.structure import models as structure_models
+from waldur_core.structure.log import event_logger
+from waldur_core.structure.tests import factories as structure_factories, models as test_models
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super(CaptureHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class AmountEventLogger(loggers.EventLogger):
+    amount = int
+
+    class Meta:
+        event_types = ('amount_reached',)
+
+
+class AsyncEventEmissionTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.project = structure_factories.ProjectFactory()
+        # reload project to make sure that its customer is not cached
+        self.project = structure_models.Project.objects.get(pk=self.project.pk)
+        self.logger = event_logger.project
+        self.handler = CaptureHandler()
+        self.logger.logger.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.logger.logger.removeHandler(self.handler)
+
+    def test_context_is_captured_without_queries(self):
+        with self.assertNumQueries(0):
+            self.logger.capture_context(project=self.project)
+
+    def test_restored_context_is_equal_to_compiled_one(self):
+        captured = self.logger.capture_context(project=self.project)
+        self.assertEqual(self.logger.restore_context(captured), self.logger.compile_context(project=self.project))
+
+    def test_context_of_deleted_object_is_restored(self):
+        captured = self.logger.capture_context(project=self.project)
+        project_uuid = self.project.uuid.hex
+        self.project.delete()
+        self.assertEqual(self.logger.restore_context(captured)['project_uuid'], project_uuid)
+
+    def test_event_is_emitted_by_writer_thread(self):
+        # Context of event does not contain models, as test database is not available in writer thread.
+        test_logger = AmountEventLogger('waldur_core.logging.tests.test_loggers')
+        handler = CaptureHandler()
+        test_logger.logger.logger.addHandler(handler)
+        emitter = loggers.AsyncEventEmitter()
+        try:
+            with mock.patch('waldur_core.logging.loggers.get_async_emitter', return_value=emitter):
+                test_logger.warning('Amount {amount} is reached.', event_type='amount_reached',
+                                    event_context={'amount': 10})
+                emitter.flush()
+        finally:
+            test_logger.logger.logger.removeHandler(handler)
+
+        self.assertEqual(len(handler.records), 1)
+        self.assertEqual(handler.records[0].getMessage(), 'Amount 10 is reached.')
+        self.assertEqual(emitter.get_stats(), {'queued': 1, 'written': 1})
+
+    @mock.patch('waldur_core.logging.loggers.AsyncEventEmitter._ensure_writer')
+    def test_event_is_dropped_if_queue_is_full(self, ensure_writer):
+        emitter = loggers.AsyncEventEmitter(queue_size=1)
+        captured = self.logger.capture_context(project=self.project)
+        for _ in range(2):
+            emitter.enqueue(self.logger, 'info', 'Project has been updated.', 'project_update_succeeded', captured)
+
+        self.assertEqual(emitter.get_stats(), {'queued': 1, 'dropped': 1})
+
+    def test_related_objects_of_events_batch_are_loaded_together(self):
+        emitter = loggers.AsyncEventEmitter()
+        projects = [structure_factories.ProjectFactory() for _ in range(3)]
+        items = []
+        for project in structure_models.Project.objects.filter(pk__in=[p.pk for p in projects]):
+            captured = self.logger.capture_context(project=project)
+            items.append((self.logger, 'warning', 'Project {project_name} has been updated.',
+                          'project_update_succeeded', captured))
+
+        with self.assertNumQueries(1):
+            emitter.write(items)
+
+        self.assertEqual(emitter.get_stats(), {'written': 3})
+        self.assertEqual(self.handler.records[0].event_context['customer_uuid'], projects[0].customer.uuid.hex)
+
+
+class LogContextExtractorTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.resource = structure_factories.TestNewInstanceFactory()
+
+    def test_extractor_is_compiled_once_for_model(self):
+        self.assertIs(loggers._get_log_context_extractor(structure_models.Project),
+                      loggers._get_log_context_extractor(structure_models.Project))
+
+    def test_select_related_lookups_are_derived_from_log_fields(self):
+        self.assertEqual(structure_models.Project.get_log_select_related(), ('customer',))
+        self.assertIn('service_project_link__project__customer', test_models.TestNewInstance.get_log_select_related())
+
+    def test_logger_returns_select_related_lookups_of_entity(self):
+        self.assertEqual(event_logger.resource.get_select_related('resource'),
+                         structure_models.ResourceMixin.get_log_select_related())
+
+    def test_context_is_compiled_without_queries_if_related_objects_are_selected(self):
+        model = test_models.TestNewInstance
+        # tags of resource are cached on first access
+        model.objects.get(pk=self.resource.pk)._get_log_context('resource')
+        resource = model.objects.select_related(*model.get_log_select_related()).get(pk=self.resource.pk)
+
+        with self.assertNumQueries(0):
+            context = resource._get_log_context('resource')
+
+        self.assertEqual(context['resource_uuid'], self.resource.uuid.hex)
+        self.assertEqual(context['project_uuid'], self.resource.service_project_link.project.uuid.hex)
+        self.assertEqual(context['customer_uuid'], self.resource.service_project_link.project.customer.uuid.hex)
+        self.assertEqual(context['resource_name'], self.resource.name)
+
+    def test_context_of_resource_with_delivery_model_tag(self):
+        self.resource.tags.add('PaaS')
+        context = test_models.TestNewInstance.objects.get(pk=self.resource.pk)._get_log_context('resource')
+        self.assertEqual(context['resource_delivery_model'], 'PaaS')
@@ -1,12 +1,16 @@
 from __future__ import unicode_literals
 
+import json
+
 from django.core.exceptions import PermissionDenied
 from django.db.models import Count
+from django.http import StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import response, viewsets, permissions, status, decorators, mixins
 
-from waldur_core.core import serializers as core_serializers, filters as core_filters, permissions as core_permissions
+from waldur_core.core import (serializers as core_serializers, filters as core_filters,
+                              permissions as core_permissions, pagination as core_pagination)
 from waldur_core.core.managers import SummaryQuerySet
 from waldur_core.logging import elasticsearch_client, models, serializers, filters, utils
 from waldur_core.logging.loggers import get_event_groups, get_alert_groups, event_logger
@@ -36,6 +40,10 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         - message: string representation of event message
         - scope: optional URL, which points to the loggable instance
 
+        Deep pages of events are slow and are limited by maximum result window of Elasticsearch.
+        To iterate over events with cursor, add **?cursor** parameter to the request. In this case
+        link to the next page is provided in Link header and X-Result-Count header is not returned.
+
         Request example:
 
         .. code-block:: javascript
@@ -54,6 +62,9 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         """
         self.queryset = self.filter_queryset(self.get_queryset())
 
+        if core_pagination.LinkHeaderSearchAfterPagination.cursor_query_param in request.query_params:
+            self.pagination_class = core_pagination.LinkHeaderSearchAfterPagination
+
         page = self.paginate_queryset(self.queryset)
         if page is not None:
             return self.get_paginated_response(page)
@@ -74,11 +85,22 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
             fail_silently=False
         )
 
+    @decorators.list_route()
+    def export(self, request, *args, **kwargs):
+        """
+        To export events - run **GET** against */api/events/export/* as authenticated user.
+        Endpoint support same filters as events list. Events are streamed in newline delimited JSON
+        format, one event per line, and are returned in index order.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        lines = (json.dumps(event) + '\n' for event in queryset.scan())
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
     @decorators.list_route()
     def count(self, request, *args, **kwargs):
         """
         To get a count of events - run **GET** against */api/events/count/* as authenticated user.
-        Endpoint support same filters as events list.
+        Endpoint support same filters as events list. Count is cached for a short time.
 
         Response example:
 
@@ -88,7 +110,7 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         """
 
         self.queryset = self.filter_queryset(self.get_queryset())
-        return response.Response({'count': self.queryset.count()}, status=status.HTTP_200_OK)
+        return response.Response({'count': self.queryset.cached_count()}, status=status.HTTP_200_OK)
 
     @decorators.list_route()
     def count_history(self, request, *args, **kwargs):
@@ -96,6 +118,7 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         To get a historical data of events amount - run **GET** against */api/events/count/history/*.
         Endpoint support same filters as events list.
         More about historical data - read at section *Historical data*.
+        Points are rounded down to minutes, counts of points are cached.
 
         Response example:
 
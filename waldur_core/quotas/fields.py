@@ -2,7 +2,7 @@ from django import VERSION as DJANGO_VERSION
 from django.db import models
 from django.utils import six
 
-from . import exceptions
+from . import exceptions, propagation
 
 
 class QuotaLimitField(models.IntegerField):
@@ -103,26 +103,31 @@ class QuotaField(object):
         except AttributeError:
             return self.default_limit(scope) if six.callable(self.default_limit) else self.default_limit
 
+    def scope_default_usage(self, scope):
+        return self.default_usage(scope) if six.callable(self.default_usage) else self.default_usage
+
     def get_or_create_quota(self, scope):
         if not self.is_connected_to_scope(scope):
             raise exceptions.CreationConditionFailedQuotaError(
                 'Wrong scope: Cannot create quota "%s" for scope "%s".' % (self.name, scope))
         defaults = {
             'limit': self.scope_default_limit(scope),
-            'usage': self.default_usage(scope) if six.callable(self.default_usage) else self.default_usage,
+            'usage': self.scope_default_usage(scope),
         }
 
         return scope.quotas.get_or_create(name=self.name, defaults=defaults)
 
+    def get_aggregator_fields(self, quota):
+        """ Return list of (ancestor, aggregator field) pairs that aggregate given quota.
+
+            Quotas themselves are not fetched.
+        """
+        return get_scope_aggregator_fields(quota.scope, quota.name)
+
     def get_aggregator_quotas(self, quota):
         """ Fetch ancestors quotas that have the same name and are registered as aggregator quotas. """
-        ancestors = quota.scope.get_quota_ancestors()
-        aggregator_quotas = []
-        for ancestor in ancestors:
-            for ancestor_quota_field in ancestor.get_quotas_fields(field_class=AggregatorQuotaField):
-                if ancestor_quota_field.get_child_quota_name() == quota.name:
-                    aggregator_quotas.append(ancestor.quotas.get(name=ancestor_quota_field))
-        return aggregator_quotas
+        return [ancestor.quotas.get(name=ancestor_quota_field)
+                for ancestor, ancestor_quota_field in self.get_aggregator_fields(quota)]
 
     def __str__(self):
         return self.name
@@ -198,24 +203,61 @@ class CounterQuotaField(QuotaField):
         return reduce(getattr, self.path_to_scope.split('.'), target_instance)
 
 
+def get_scope_aggregator_fields(scope, quota_name):
+    """ Return list of (ancestor, aggregator field) pairs that aggregate scope quota with given name. """
+    aggregator_fields = []
+    for ancestor in scope.get_quota_ancestors():
+        for ancestor_quota_field in ancestor.get_quotas_fields(field_class=AggregatorQuotaField):
+            if ancestor_quota_field.get_child_quota_name() == quota_name:
+                aggregator_fields.append((ancestor, ancestor_quota_field))
+    return aggregator_fields
+
+
 class AggregatorQuotaField(QuotaField):
     """ Aggregates sum of quota scope children with the same name.
 
         Automatically increases/decreases usage if corresponding child quota <aggregation_field> changed.
 
-        Example:
+        Children could be declared with model and path from child to scope, in this case
+        recalculation of aggregator quotas is performed with one query for batch of scopes:
             # This quota will store sum of all customer projects resources
+            nc_resource_count = quotas_fields.UsageAggregatorQuotaField(
+                child_model=lambda: Project,  # model or function that return model
+                path_to_scope='customer',
+            )
+
+        It is also possible to define children with custom function. Model of children should be
+        declared anyway, otherwise quota is recalculated after all other aggregator quotas.
+        Example:
             nc_resource_count = quotas_fields.UsageAggregatorQuotaField(
                 get_children=lambda customer: customer.projects.all(),
+                child_model=lambda: Project,
             )
     """
     aggregation_field = NotImplemented
 
-    def __init__(self, get_children, child_quota_name=None, **kwargs):
-        self.get_children = get_children
+    def __init__(self, get_children=None, child_quota_name=None, child_model=None, path_to_scope=None, **kwargs):
+        if get_children is None and (child_model is None or path_to_scope is None):
+            raise exceptions.QuotaError('Aggregator quota field requires get_children or child_model '
+                                        'and path_to_scope to be defined.')
+        self._raw_get_children = get_children
+        self._raw_child_model = child_model
+        self.path_to_scope = path_to_scope
         self._child_quota_name = child_quota_name
         super(AggregatorQuotaField, self).__init__(**kwargs)
 
+    def get_children(self, scope):
+        if self._raw_get_children is not None:
+            return self._raw_get_children(scope)
+        filter_path_to_scope = self.path_to_scope.replace('.', '__')
+        return self.child_model.objects.filter(**{filter_path_to_scope: scope})
+
+    @property
+    def child_model(self):
+        if self._raw_child_model is None or isinstance(self._raw_child_model, type):
+            return self._raw_child_model
+        return self._raw_child_model()
+
     def get_child_quota_name(self):
         return self._child_quota_name if self._child_quota_name is not None else self.name
 
@@ -228,22 +270,18 @@ class AggregatorQuotaField(QuotaField):
         scope.set_quota_usage(self.name, current_usage)
 
     def post_child_quota_save(self, scope, child_quota, created=False):
-        quota = scope.quotas.get(name=self.name)
         current_value = getattr(child_quota, self.aggregation_field)
         if created:
             diff = current_value
         else:
             diff = current_value - child_quota.tracker.previous(self.aggregation_field)
         if diff:
-            quota.usage += diff
-            quota.save()
+            propagation.add_usage_delta(scope, self, diff)
 
     def pre_child_quota_delete(self, scope, child_quota):
-        quota = scope.quotas.get(name=self.name)
         diff = getattr(child_quota, self.aggregation_field)
         if diff:
-            quota.usage -= diff
-            quota.save()
+            propagation.add_usage_delta(scope, self, -diff)
 
 
 class UsageAggregatorQuotaField(AggregatorQuotaField):
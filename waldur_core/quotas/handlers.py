@@ -12,6 +12,12 @@ def create_global_quotas(**kwargs):
             models.Quota.objects.get_or_create(name=getattr(model, 'GLOBAL_COUNT_QUOTA_NAME'))
 
 
+def create_quota_sample(sender, instance, created=False, **kwargs):
+    """ Append quota history sample if quota limit or usage was changed. """
+    if created or instance.has_changed_values():
+        models.QuotaSample.objects.create(quota=instance, limit=instance.limit, usage=instance.usage)
+
+
 def increase_global_quota(sender, instance=None, created=False, **kwargs):
     if created and hasattr(sender, 'GLOBAL_COUNT_QUOTA_NAME'):
         with transaction.atomic():
@@ -67,9 +73,8 @@ def handle_aggregated_quotas(sender, instance, **kwargs):
     if isinstance(quota_field, fields.UsageAggregatorQuotaField) or quota_field is None:
         return
     signal = kwargs['signal']
-    for aggregator_quota in quota_field.get_aggregator_quotas(quota):
-        field = aggregator_quota.get_field()
+    for scope, field in quota_field.get_aggregator_fields(quota):
         if signal == signals.post_save:
-            field.post_child_quota_save(aggregator_quota.scope, child_quota=quota, created=kwargs.get('created'))
+            field.post_child_quota_save(scope, child_quota=quota, created=kwargs.get('created'))
         elif signal == signals.pre_delete:
-            field.pre_child_quota_delete(aggregator_quota.scope, child_quota=quota)
+            field.pre_child_quota_delete(scope, child_quota=quota)
@@ -1,44 +1,57 @@
 from __future__ import unicode_literals
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
-from waldur_core.quotas import models, fields, exceptions
+from waldur_core.quotas import models
+from waldur_core.quotas.recalculation import QuotaRecalculator, get_batches
 from waldur_core.quotas.utils import get_models_with_quotas
 
 
 class Command(BaseCommand):
     """ Recalculate all quotas """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help='Number of processes that recalculate quotas of scopes batches in parallel.',
+        )
+        parser.add_argument(
+            '--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Report counter and aggregator quotas that would be changed without changing them.',
+        )
+
     def handle(self, *args, **options):
         # TODO: implement other quotas recalculation
         # TODO: implement global stale quotas deletion
-        self.delete_stale_quotas()
-        self.init_missing_quotas()
-        self.recalculate_global_quotas()
-        self.recalculate_counter_quotas()
-        self.recalculate_aggregator_quotas()
-        self.stdout.write('XXX: Second time to make sure that aggregators of aggregators where calculated properly.')
-        self.recalculate_aggregator_quotas()
-        self.recalculate_customers_user_count()
+        recalculator = QuotaRecalculator(workers=options['workers'], dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write('Dry run: stale, missing and global quotas are not processed.')
+        else:
+            self.delete_stale_quotas()
+            self.init_missing_quotas()
+            self.recalculate_global_quotas()
+        self.recalculate_counter_quotas(recalculator)
+        self.recalculate_aggregator_quotas(recalculator)
+        if options['dry_run']:
+            self.report_changes(recalculator)
+        else:
+            self.recalculate_customers_user_count()
 
     def delete_stale_quotas(self):
         self.stdout.write('Deleting stale quotas')
         for model in get_models_with_quotas():
-            for obj in model.objects.all():
-                quotas_names = model.get_quotas_names()
-                obj.quotas.exclude(name__in=quotas_names).delete()
+            content_type = ContentType.objects.get_for_model(model)
+            quotas_names = model.get_quotas_names()
+            models.Quota.objects.filter(content_type=content_type).exclude(name__in=quotas_names).delete()
         self.stdout.write('...done')
 
     def init_missing_quotas(self):
         self.stdout.write('Initializing missing quotas')
         for model in get_models_with_quotas():
-            for obj in model.objects.all():
-                for field in obj.get_quotas_fields():
-                    try:
-                        field.get_or_create_quota(scope=obj)
-                    except exceptions.CreationConditionFailedQuotaError:
-                        pass
+            for batch in get_batches(model):
+                model.init_quotas(model.objects.filter(pk__in=batch))
         self.stdout.write('...done')
 
     def recalculate_global_quotas(self):
@@ -51,23 +64,26 @@ class Command(BaseCommand):
                     quota.save()
         self.stdout.write('...done')
 
-    def recalculate_counter_quotas(self):
+    def recalculate_counter_quotas(self, recalculator):
         self.stdout.write('Recalculating counter quotas')
-        for model in get_models_with_quotas():
-            for counter_field in model.get_quotas_fields(field_class=fields.CounterQuotaField):
-                for instance in model.objects.all():
-                    counter_field.recalculate(scope=instance)
+        recalculator.recalculate_counters()
         self.stdout.write('...done')
 
-    def recalculate_aggregator_quotas(self):
-        # TODO: recalculate child quotas first
+    def recalculate_aggregator_quotas(self, recalculator):
+        # Aggregators are recalculated in topological order of aggregation graph,
+        # so children quotas are always recalculated before their aggregators.
         self.stdout.write('Recalculating aggregator quotas')
-        for model in get_models_with_quotas():
-            for aggregator_field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
-                for instance in model.objects.all():
-                    aggregator_field.recalculate(scope=instance)
+        recalculator.recalculate_aggregators()
         self.stdout.write('...done')
 
+    def report_changes(self, recalculator):
+        if not recalculator.changes:
+            self.stdout.write('All counter and aggregator quotas are up to date.')
+            return
+        self.stdout.write('%s quotas would be changed:' % len(recalculator.changes))
+        for change in recalculator.changes:
+            self.stdout.write('  %s' % change)
+
     # XXX: With current permissions structure it easier to handle customer quota separately.
     def recalculate_customers_user_count(self):
         self.stdout.write('Recalculating customers user count')
@@ -1,6 +1,9 @@
-from django.contrib.contenttypes import models as ct_models
-from django.db import models
-from django.db.models import Q
+import bisect
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models, router, transaction
+from django.db.models import F, OuterRef, Q, Subquery
 
 from waldur_core.core.managers import GenericKeyMixin
 
@@ -12,18 +15,93 @@ class QuotaManager(GenericKeyMixin, models.Manager):
 
         if queryset is None:
             queryset = self.get_queryset()
-        # XXX: This circular dependency will be removed then filter_queryset_for_user
-        # will be moved to model manager method
-        from waldur_core.structure.managers import filter_queryset_for_user
+        # Structure models depend on this application, so they are imported lazily
+        from waldur_core.structure.models import ScopeVisibility
+
+        return ScopeVisibility.objects.filter_for_user(queryset, user, utils.get_models_with_quotas())
+
+    def add_usage(self, scope, name, usage_delta, validate=False, pending_usage=0):
+        """ Add delta to usage of scope quota and return updated quota or None if it was not updated.
+
+            Usage is changed with single "UPDATE ... SET usage = usage + delta" query. If validate
+            is True quota limit is checked by the same query, negative delta is never validated.
+            Pending usage is added to the checked usage, but it is not written.
+            On PostgreSQL updated row is returned by the same query with RETURNING clause.
+            On other databases it is re-read in the same transaction, so returned usage
+            is exactly the previous usage plus delta in both cases.
+        """
+        content_type = ContentType.objects.get_for_model(scope)
+        # usage is checked against limit only if it is increased
+        required_delta = usage_delta + pending_usage if validate and usage_delta > 0 else None
+        db = router.db_for_write(self.model)
+        if connections[db].vendor == 'postgresql':
+            return self._add_usage_returning(db, content_type, scope.pk, name, usage_delta, required_delta)
+
+        queryset = self.db_manager(db).filter(content_type=content_type, object_id=scope.pk, name=name)
+        limited_queryset = queryset
+        if required_delta is not None:
+            limited_queryset = queryset.filter(Q(limit=-1) | Q(limit__gte=F('usage') + required_delta))
+        with transaction.atomic(using=db):
+            if not limited_queryset.update(usage=F('usage') + usage_delta):
+                return None
+            return queryset.select_for_update().get()
+
+    def _add_usage_returning(self, db, content_type, object_id, name, usage_delta, required_delta):
+        opts = self.model._meta
+        quote_name = connections[db].ops.quote_name
+        columns = {field: quote_name(opts.get_field(field).column)
+                   for field in ('usage', 'limit', 'content_type', 'object_id', 'name')}
+        sql = ('UPDATE {table} SET {usage} = {usage} + %s '
+               'WHERE {content_type} = %s AND {object_id} = %s AND {name} = %s')
+        params = [usage_delta, content_type.pk, object_id, name]
+        if required_delta is not None:
+            sql += ' AND ({limit} = -1 OR {limit} >= {usage} + %s)'
+            params.append(required_delta)
+        sql += ' RETURNING ' + ', '.join(quote_name(field.column) for field in opts.concrete_fields)
+        sql = sql.format(table=quote_name(opts.db_table), **columns)
+        # Raw queryset applies database converters of model fields to returned row.
+        quotas = list(self.db_manager(db).raw(sql, params))
+        return quotas[0] if quotas else None
+
+
+class QuotaSampleManager(models.Manager):
+    BATCH_SIZE = 500
 
-        if user.is_staff or user.is_support:
-            return queryset
+    def get_values_at(self, quota_ids, points):
+        """ Return quota values at given points of time.
 
-        quota_scope_models = utils.get_models_with_quotas()
-        query = Q()
-        for model in quota_scope_models:
-            user_object_ids = filter_queryset_for_user(model.objects.all(), user).values_list('id', flat=True)
-            content_type_id = ct_models.ContentType.objects.get_for_model(model).id
-            query |= Q(object_id__in=user_object_ids, content_type_id=content_type_id)
+            Result is dictionary {quota id: [(limit, usage) or None for each point]}.
+            Value is None if quota does not have any sample before the point.
+            Samples of each batch of quotas are loaded with one indexed query: samples
+            between the first and the last point and the latest sample before the first point.
+        """
+        if not points:
+            return {quota_id: [] for quota_id in quota_ids}
+        quota_ids = list(quota_ids)
+        start, end = min(points), max(points)
+        samples = defaultdict(list)
+        for i in range(0, len(quota_ids), self.BATCH_SIZE):
+            batch = quota_ids[i:i + self.BATCH_SIZE]
+            previous_timestamp = (self.filter(quota=OuterRef('quota'), timestamp__lt=start)
+                                  .order_by('-timestamp').values('timestamp')[:1])
+            rows = (self.filter(quota_id__in=batch)
+                    .filter(Q(timestamp__gte=start, timestamp__lte=end) | Q(timestamp=Subquery(previous_timestamp)))
+                    .order_by('quota_id', 'timestamp', 'pk')
+                    .values_list('quota_id', 'timestamp', 'limit', 'usage'))
+            for quota_id, timestamp, limit, usage in rows:
+                samples[quota_id].append((timestamp, limit, usage))
 
-        return queryset.filter(query)
+        values = {}
+        for quota_id in quota_ids:
+            quota_samples = samples.get(quota_id, [])
+            timestamps = [timestamp for timestamp, _, _ in quota_samples]
+            quota_values = []
+            for point in points:
+                index = bisect.bisect_right(timestamps, point)
+                if index:
+                    _, limit, usage = quota_samples[index - 1]
+                    quota_values.append((limit, usage))
+                else:
+                    quota_values.append(None)
+            values[quota_id] = quota_values
+        return values
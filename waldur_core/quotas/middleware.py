@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+
+from django.utils.deprecation import MiddlewareMixin
+
+from waldur_core.quotas import propagation
+
+
+class DeferredQuotaPropagationMiddleware(MiddlewareMixin):
+    """ Apply aggregator quotas changes once per request, after view is processed. """
+
+    def process_request(self, request):
+        propagation.open_buffer()
+
+    def process_response(self, request, response):
+        propagation.close_buffer()
+        return response
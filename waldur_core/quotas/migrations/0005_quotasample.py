@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:45
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+BATCH_SIZE = 1000
+
+
+def copy_quota_versions(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Version = apps.get_model('reversion', 'Version')
+    Quota = apps.get_model('quotas', 'Quota')
+    QuotaSample = apps.get_model('quotas', 'QuotaSample')
+
+    try:
+        content_type = ContentType.objects.get(app_label='quotas', model='quota')
+    except ContentType.DoesNotExist:
+        return
+
+    quota_ids = set(Quota.objects.values_list('id', flat=True))
+    versions = (Version.objects
+                .filter(content_type=content_type, format='json')
+                .values_list('object_id', 'revision__date_created', 'serialized_data')
+                .iterator())
+    samples = []
+    for object_id, date_created, serialized_data in versions:
+        quota_id = int(object_id)
+        if quota_id not in quota_ids:
+            continue
+        fields = json.loads(serialized_data)[0]['fields']
+        samples.append(QuotaSample(
+            quota_id=quota_id,
+            timestamp=date_created,
+            limit=fields.get('limit', -1),
+            usage=fields.get('usage', 0),
+        ))
+        if len(samples) >= BATCH_SIZE:
+            QuotaSample.objects.bulk_create(samples)
+            samples = []
+    QuotaSample.objects.bulk_create(samples)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quotas', '0004_quota_threshold'),
+        ('reversion', '0001_squashed_0004_auto_20160611_1202'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('limit', models.FloatField()),
+                ('usage', models.FloatField()),
+                ('quota', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='samples', to='quotas.Quota')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='quotasample',
+            index_together=set([('quota', 'timestamp')]),
+        ),
+        migrations.RunPython(copy_quota_versions, reverse_code=migrations.RunPython.noop),
+    ]
@@ -6,23 +6,21 @@ from collections import defaultdict
 
 from django.contrib.contenttypes import fields as ct_fields
 from django.contrib.contenttypes import models as ct_models
-from django.db import models
-from django.db.models import Sum
-from django.utils import six
+from django.db import models, router, transaction
+from django.db.models import Case, F, Sum, Value, When, signals
+from django.utils import six, timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from model_utils import FieldTracker
-from reversion import revisions as reversion
 
 from waldur_core.logging.loggers import LoggableMixin
 from waldur_core.logging.models import AlertThresholdMixin
-from waldur_core.quotas import exceptions, managers, fields
-from waldur_core.core.models import UuidMixin, ReversionMixin, DescendantMixin
+from waldur_core.quotas import exceptions, managers, fields, propagation
+from waldur_core.core.models import UuidMixin, DescendantMixin
 
 
 @python_2_unicode_compatible
-@reversion.register(fields=['usage', 'limit'])
-class Quota(UuidMixin, AlertThresholdMixin, LoggableMixin, ReversionMixin, models.Model):
+class Quota(UuidMixin, AlertThresholdMixin, LoggableMixin, models.Model):
     """
     Abstract quota for any resource.
 
@@ -84,6 +82,209 @@ class Quota(UuidMixin, AlertThresholdMixin, LoggableMixin, ReversionMixin, model
     def is_over_threshold(self):
         return self.usage >= self.threshold
 
+    @classmethod
+    def get_over_threshold_objects(cls):
+        return (cls.get_checkable_objects()
+                .filter(threshold__gt=0, usage__gte=F('threshold'))
+                .prefetch_related('scope'))
+
+    def send_post_save(self, update_fields):
+        """ Emulate save() side effects for quota that was updated with queryset update().
+
+            Post save signal is sent, so quota history samples and handlers that depend
+            on quota change (aggregator quotas, price estimates) work the same way
+            as on regular save. Field tracker is reset afterwards.
+        """
+        signals.post_save.send(
+            sender=Quota,
+            instance=self,
+            created=False,
+            update_fields=frozenset(update_fields),
+            raw=False,
+            using=router.db_for_write(Quota, instance=self),
+        )
+        self.tracker.set_saved_fields()
+
+    def set_previous_usage(self, usage):
+        """ Define usage value that is considered as saved by field tracker.
+
+            It is needed to report correct usage change to post_save handlers
+            if usage was changed in database directly.
+        """
+        self.tracker.saved_data['usage'] = usage
+
+    def has_changed_values(self):
+        """ Check whether quota limit or usage differs from the saved one. """
+        return self.tracker.has_changed('limit') or self.tracker.has_changed('usage')
+
+
+@python_2_unicode_compatible
+class QuotaSample(models.Model):
+    """
+    Historical value of quota limit and usage.
+
+    Sample is appended each time quota limit or usage is changed, so quota value
+    at some moment is the value of the latest sample created before this moment.
+    """
+    class Meta:
+        index_together = (('quota', 'timestamp'),)
+
+    quota = models.ForeignKey(Quota, related_name='samples')
+    timestamp = models.DateTimeField(default=timezone.now)
+    limit = models.FloatField()
+    usage = models.FloatField()
+
+    objects = managers.QuotaSampleManager()
+
+    def __str__(self):
+        return 'Quota #%s at %s: %s of %s' % (self.quota_id, self.timestamp, self.usage, self.limit)
+
+
+class ScopeQuotas(object):
+    """ Quotas of a single scope loaded with one query.
+
+    Reads are served from the loaded snapshot. Changes are accumulated in memory and
+    written back with a single UPDATE on save(). Usage deltas are applied in database
+    as "usage = usage + delta", so concurrent changes of the same quota are not lost.
+    Post save signal is sent for each changed quota afterwards, so history and aggregator
+    quotas are handled as on regular quota save.
+
+    Example:
+        quotas = project.get_scope_quotas()
+        quotas.add_usage('nc_app_count', 1, validate=True)
+        quotas.set_limit('nc_resource_count', 10)
+        quotas.save()
+    """
+    updatable_fields = ('limit', 'usage')
+
+    def __init__(self, scope, quota_names=None):
+        self.scope = scope
+        queryset = scope.quotas.all()
+        if quota_names is not None:
+            queryset = queryset.filter(name__in=[six.text_type(name) for name in quota_names])
+        self._quotas = {}
+        for quota in queryset:
+            # set scope explicitly to avoid generic foreign key resolution for each quota
+            quota.scope = scope
+            self._quotas[quota.name] = quota
+        self._changed_fields = defaultdict(set)
+        self._usage_deltas = defaultdict(lambda: 0)
+
+    def __contains__(self, quota_name):
+        return six.text_type(quota_name) in self._quotas
+
+    def __iter__(self):
+        return iter(self._quotas.values())
+
+    def get(self, quota_name):
+        try:
+            return self._quotas[six.text_type(quota_name)]
+        except KeyError:
+            raise Quota.DoesNotExist(_('Object %(object)s does not have quota with name %(name)s.') % {
+                'object': self.scope,
+                'name': quota_name,
+            })
+
+    def set_limit(self, quota_name, limit):
+        self._set_value(quota_name, 'limit', limit)
+
+    def set_usage(self, quota_name, usage):
+        self._set_value(quota_name, 'usage', usage)
+        name = self.get(quota_name).name
+        # Pending delta is replaced only if explicit usage is actually written,
+        # otherwise usage already includes the delta and it has to be applied.
+        if 'usage' in self._changed_fields[name]:
+            self._usage_deltas.pop(name, None)
+
+    def add_usage(self, quota_name, usage_delta, validate=False):
+        quota = self.get(quota_name)
+        if validate:
+            required_usage = self._get_required_usage(quota, usage_delta, propagation.get_usage_deltas(self.scope))
+            if required_usage is not None:
+                raise exceptions.QuotaValidationError(
+                    _('%(quota)s "%(name)s" quota is over limit. Required: %(usage)s, limit: %(limit)s.') % dict(
+                        quota=self.scope, name=quota_name, usage=required_usage, limit=quota.limit))
+        if not usage_delta:
+            return
+        quota.usage += usage_delta
+        if 'usage' in self._changed_fields[quota.name]:
+            # usage was set explicitly, so its new value is already known
+            return
+        self._usage_deltas[quota.name] += usage_delta
+
+    def get_exceeded_errors(self, quota_deltas):
+        """ Return error messages for quotas that will be exceeded if deltas are added. """
+        errors = []
+        pending_deltas = propagation.get_usage_deltas(self.scope)
+        for name, delta in quota_deltas.items():
+            quota = self.get(name)
+            required_usage = self._get_required_usage(quota, delta, pending_deltas)
+            if required_usage is not None:
+                errors.append('%s quota limit: %s, requires %s (%s)\n' % (
+                    quota.name, quota.limit, required_usage, self.scope))
+        return errors
+
+    def _get_required_usage(self, quota, usage_delta, pending_deltas):
+        """ Return required usage if quota is exceeded by delta, otherwise return None.
+
+            Aggregator quotas deltas that are collected but not propagated yet are added to usage.
+        """
+        # Allow to decrease quota usage
+        if usage_delta < 0:
+            return None
+        pending_delta = pending_deltas.get(quota.name, 0)
+        if quota.is_exceeded(usage_delta + pending_delta):
+            return quota.usage + pending_delta + usage_delta
+
+    def _set_value(self, quota_name, field, value):
+        quota = self.get(quota_name)
+        if getattr(quota, field) != value:
+            setattr(quota, field, value)
+            self._changed_fields[quota.name].add(field)
+
+    def _get_update_value(self, quota, field):
+        if field in self._changed_fields[quota.name]:
+            return Value(getattr(quota, field))
+        if field == 'usage' and self._usage_deltas.get(quota.name):
+            return F('usage') + Value(self._usage_deltas[quota.name])
+
+    def save(self):
+        """ Write all changed quotas with one UPDATE query. """
+        changed_names = set(name for name, fields in self._changed_fields.items() if fields)
+        changed_names |= set(name for name, delta in self._usage_deltas.items() if delta)
+        if not changed_names:
+            return
+        changed = [self._quotas[name] for name in changed_names]
+        update_kwargs = {}
+        for field in self.updatable_fields:
+            whens = []
+            for quota in changed:
+                value = self._get_update_value(quota, field)
+                if value is not None:
+                    whens.append(When(pk=quota.pk, then=value))
+            if whens:
+                update_kwargs[field] = Case(*whens, default=F(field), output_field=models.FloatField())
+        usage_deltas = {name: delta for name, delta in self._usage_deltas.items() if delta}
+        with transaction.atomic():
+            Quota.objects.filter(pk__in=[quota.pk for quota in changed]).update(**update_kwargs)
+            if usage_deltas:
+                # Refresh usages that were changed in database by delta, as other
+                # transactions could change them after the snapshot was loaded.
+                # Updated rows stay locked until commit, so re-read usage includes only this delta.
+                quotas = [self._quotas[name] for name in usage_deltas]
+                usages = dict(Quota.objects.filter(pk__in=[q.pk for q in quotas]).values_list('pk', 'usage'))
+                for quota in quotas:
+                    quota.usage = usages[quota.pk]
+                    quota.set_previous_usage(quota.usage - usage_deltas[quota.name])
+
+        update_fields = {name: set(self._changed_fields[name]) for name in changed_names}
+        for name in usage_deltas:
+            update_fields[name].add('usage')
+        self._changed_fields.clear()
+        self._usage_deltas.clear()
+        for quota in changed:
+            quota.send_post_save(update_fields=update_fields[quota.name])
+
 
 def _fail_silently(method):
 
@@ -127,6 +328,7 @@ class QuotaModelMixin(models.Model):
 
     Use such methods to change objects quotas:
       set_quota_limit, set_quota_usage, add_quota_usage.
+    Use get_scope_quotas to read or change several quotas of the object with a constant number of queries.
 
     Helper methods validate_quota_change and get_sum_of_quotas_as_dict provide common operations with objects quotas.
     Check methods docstrings for more details.
@@ -141,29 +343,54 @@ class QuotaModelMixin(models.Model):
 
     quotas = ct_fields.GenericRelation('quotas.Quota', related_query_name='quotas')
 
+    def get_scope_quotas(self, quota_names=None):
+        """ Load object quotas with one query. Check ScopeQuotas for details. """
+        return ScopeQuotas(self, quota_names)
+
     @_fail_silently
     def set_quota_limit(self, quota_name, limit, fail_silently=False):
-        quota = self.quotas.get(name=quota_name)
-        if quota.limit != limit:
-            quota.limit = limit
-            quota.save(update_fields=['limit'])
+        quotas = self.get_scope_quotas([quota_name])
+        quotas.set_limit(quota_name, limit)
+        quotas.save()
 
     @_fail_silently
     def set_quota_usage(self, quota_name, usage, fail_silently=False):
-        quota = self.quotas.get(name=quota_name)
-        if quota.usage != usage:
-            quota.usage = usage
-            quota.save(update_fields=['usage'])
+        quotas = self.get_scope_quotas([quota_name])
+        quotas.set_usage(quota_name, usage)
+        quotas.save()
 
     @_fail_silently
     def add_quota_usage(self, quota_name, usage_delta, fail_silently=False, validate=False):
-        quota = self.quotas.get(name=quota_name)
-        if validate and quota.is_exceeded(usage_delta):
+        if self.apply_quota_usage_delta(quota_name, usage_delta, validate=validate):
+            quota = self.quotas.get(name=quota_name)
             raise exceptions.QuotaValidationError(
                 _('%(quota)s "%(name)s" quota is over limit. Required: %(usage)s, limit: %(limit)s.') % dict(
                     quota=self, name=quota_name, usage=quota.usage + usage_delta, limit=quota.limit))
-        quota.usage += usage_delta
-        quota.save(update_fields=['usage'])
+
+    def apply_quota_usage_delta(self, quota_name, usage_delta, validate=False):
+        """
+        Atomically add usage delta to quota without read-modify-write cycle.
+
+        Usage is changed with single "UPDATE ... SET usage = usage + delta" query. If validate is True
+        quota limit is checked by the same query, so validation and increment could not be
+        interleaved with concurrent changes. Negative delta is never validated. Deferred aggregator
+        quota deltas that are not propagated yet are taken into account by validation.
+
+        Return True if quota limit is exceeded, quota usage is not changed in this case.
+        Raise Quota.DoesNotExist if object does not have quota with given name.
+        """
+        pending_usage = propagation.get_usage_deltas(self).get(quota_name, 0) if validate else 0
+        quota = Quota.objects.add_usage(self, quota_name, usage_delta, validate=validate, pending_usage=pending_usage)
+        if quota is None:
+            # distinguish exceeded quota from missing one
+            if not self.quotas.filter(name=quota_name).exists():
+                raise Quota.DoesNotExist
+            return True
+        quota.scope = self
+        # returned row contains usage right after this update, so previous usage is exact
+        quota.set_previous_usage(quota.usage - usage_delta)
+        quota.send_post_save(update_fields=['usage'])
+        return False
 
     def get_quota_ancestors(self):
         if isinstance(self, DescendantMixin):
@@ -185,12 +412,7 @@ class QuotaModelMixin(models.Model):
             ['ram quota limit: 1024, requires: 2048(instance#1)', ...]
 
         """
-        errors = []
-        for name, delta in quota_deltas.iteritems():
-            quota = self.quotas.get(name=name)
-            if quota.is_exceeded(delta):
-                errors.append('%s quota limit: %s, requires %s (%s)\n' % (
-                    quota.name, quota.limit, quota.usage + delta, quota.scope))
+        errors = self.get_scope_quotas(quota_deltas.keys()).get_exceeded_errors(quota_deltas)
         if not raise_exception:
             return errors
         else:
@@ -283,6 +505,88 @@ class QuotaModelMixin(models.Model):
     def get_quotas_names(cls):
         return [f.name for f in cls.get_quotas_fields()]
 
+    @classmethod
+    def init_quotas(cls, scopes, batch_size=500):
+        """
+        Create missing quotas of given scopes in bulk and return list of created quotas.
+
+        It is the bulk version of quotas initialization that is executed on scope creation,
+        so it could be used for scopes that were created with bulk_create or imported
+        without signals. Quotas of fields with failed creation condition are not created.
+        Post save signal is not sent for created quotas, so history samples are created
+        in bulk and initial values are propagated to aggregator quotas explicitly.
+        All `scopes` have to be instances of the same model.
+        """
+        scopes = [scope for scope in scopes if scope.pk is not None]
+        if not scopes:
+            return []
+
+        content_type = ct_models.ContentType.objects.get_for_model(cls)
+        scope_ids = [scope.pk for scope in scopes]
+        existing = set(Quota.objects
+                       .filter(content_type=content_type, object_id__in=scope_ids)
+                       .values_list('object_id', 'name'))
+
+        new_quotas = []
+        for scope in scopes:
+            for field in cls.get_quotas_fields():
+                if (scope.pk, field.name) in existing or not field.is_connected_to_scope(scope):
+                    continue
+                new_quotas.append(Quota(
+                    content_type=content_type,
+                    object_id=scope.pk,
+                    name=field.name,
+                    limit=field.scope_default_limit(scope),
+                    usage=field.scope_default_usage(scope),
+                ))
+        if not new_quotas:
+            return []
+
+        with transaction.atomic():
+            Quota.objects.bulk_create(new_quotas, batch_size=batch_size)
+            # Primary keys of objects created in bulk are not set for all databases, so quotas are reloaded.
+            created = [quota for quota in Quota.objects.filter(content_type=content_type, object_id__in=scope_ids)
+                       if (quota.object_id, quota.name) not in existing]
+            QuotaSample.objects.bulk_create(
+                [QuotaSample(quota=quota, limit=quota.limit, usage=quota.usage) for quota in created],
+                batch_size=batch_size)
+
+        cls._propagate_initial_quotas(scopes, created)
+        return created
+
+    @classmethod
+    def _propagate_initial_quotas(cls, scopes, quotas):
+        """ Add initial values of created quotas to aggregator quotas of scopes ancestors. """
+        from waldur_core.quotas.utils import get_models_with_quotas
+
+        # {child quota name: names of aggregated quota fields}
+        aggregated_fields = defaultdict(set)
+        for model in get_models_with_quotas():
+            for field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
+                aggregated_fields[field.get_child_quota_name()].add(field.aggregation_field)
+
+        scopes = {scope.pk: scope for scope in scopes}
+        quota_fields = {field.name: field for field in cls.get_quotas_fields()}
+        scope_quotas = defaultdict(list)
+        for quota in quotas:
+            # usage aggregator quotas are not aggregated further, zero values do not change aggregators.
+            if isinstance(quota_fields[quota.name], fields.UsageAggregatorQuotaField):
+                continue
+            if not any(getattr(quota, name) for name in aggregated_fields.get(quota.name, [])):
+                continue
+            scope_quotas[quota.object_id].append(quota)
+
+        for scope_id, quotas in scope_quotas.items():
+            scope = scopes[scope_id]
+            ancestors = scope.get_quota_ancestors()
+            if not ancestors:
+                continue
+            for quota in quotas:
+                for ancestor in ancestors:
+                    for aggregator_field in ancestor.get_quotas_fields(field_class=fields.AggregatorQuotaField):
+                        if aggregator_field.get_child_quota_name() == quota.name:
+                            aggregator_field.post_child_quota_save(ancestor, child_quota=quota, created=True)
+
 
 class ExtendableQuotaModelMixin(QuotaModelMixin):
     """ Allows to add quotas to model in runtime.
@@ -0,0 +1,259 @@
+""" Propagation of child quotas changes to aggregator quotas of ancestors.
+
+By default aggregator quota is updated right after its child quota is saved.
+Each update of aggregator quota is a quota save itself, so one resource change
+causes a cascade of quota queries and saves.
+
+Deferred propagation allows to collect child deltas per (ancestor scope, quota name)
+and apply them once, when request or Celery task is finished:
+
+    with deferred_propagation():
+        for item in items:
+            Resource.objects.create(...)
+
+Deltas are registered as transaction commit hooks, so changes that were rolled back
+(for example, in a failed atomic block) are not propagated. Quota limit validation adds
+collected deltas to current usage, so limits are enforced while propagation is deferred.
+
+Import jobs could turn propagation off and recalculate aggregator quotas once at the end:
+
+    with disabled_propagation(recalculate=True):
+        import_resources()
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_locals = threading.local()
+
+
+class _Delta(object):
+    """ Aggregator quota usage change that is applied on buffer flush if related changes were committed.
+
+        Delta is registered as transaction commit hook itself.
+    """
+
+    def __init__(self, scope, quota_name, value, dependent_quotas=()):
+        self.scope = scope
+        self.quota_name = quota_name
+        self.value = value
+        # [(ancestor, quota name)] of aggregator quotas that are changed by the same value
+        # when this delta is applied, as their child aggregator quota is saved on flush.
+        self.dependent_quotas = dependent_quotas
+        self.committed = False
+
+    def __call__(self):
+        self.committed = True
+
+    @property
+    def key(self):
+        content_type = ContentType.objects.get_for_model(self.scope)
+        return content_type.id, self.scope.pk, self.quota_name
+
+    def get_affected_quotas(self):
+        """ Return (scope, quota name) pairs of all aggregator quotas changed by this delta. """
+        return [(self.scope, self.quota_name)] + list(self.dependent_quotas)
+
+
+def _get_dependent_quotas(scope, quota_field):
+    """ Return [(ancestor, quota name)] of aggregator quotas that aggregate usage of scope aggregator quota.
+
+        Usage aggregator quotas are not aggregated further, see handle_aggregated_quotas.
+    """
+    from waldur_core.quotas import fields
+
+    if isinstance(quota_field, fields.UsageAggregatorQuotaField):
+        return []
+    dependent_quotas = []
+    for ancestor, ancestor_field in fields.get_scope_aggregator_fields(scope, quota_field.name):
+        if ancestor_field.aggregation_field == 'usage':
+            dependent_quotas.append((ancestor, ancestor_field.name))
+            dependent_quotas.extend(_get_dependent_quotas(ancestor, ancestor_field))
+    return dependent_quotas
+
+
+class PropagationBuffer(object):
+    """ Collects aggregator quotas usage deltas and applies them in bulk. """
+
+    def __init__(self):
+        self.deltas = []
+
+    def add(self, scope, quota_field, value):
+        delta = _Delta(scope, quota_field.name, value, _get_dependent_quotas(scope, quota_field))
+        self.deltas.append(delta)
+        # Callback is executed immediately in autocommit mode. In atomic block it is executed
+        # on commit and is discarded if savepoint where delta was registered is rolled back.
+        transaction.on_commit(delta)
+
+    def flush(self, committed_only=False):
+        """ Apply collected deltas with one UPDATE per ancestor scope.
+
+            Aggregator quotas changes could be propagated further, so deltas are applied
+            until buffer is empty.
+        """
+        while self.deltas:
+            deltas, self.deltas = self.deltas, []
+            pending = self._get_pending_callbacks()
+            coalesced = OrderedDict()
+            for delta in deltas:
+                if delta.committed or (not committed_only and id(delta) in pending):
+                    scope, value = coalesced.get(delta.key, (delta.scope, 0))
+                    coalesced[delta.key] = (scope, value + delta.value)
+            self._apply(coalesced)
+
+    def get_usage_deltas(self, scope):
+        """ Return {quota name: usage delta} of scope aggregator quotas collected but not applied yet.
+
+            Changes of aggregators of aggregators, that are applied only on flush, are included.
+            Deltas of rolled back changes are skipped.
+        """
+        scope_model = scope._meta.concrete_model
+        pending = self._get_pending_callbacks()
+        usage_deltas = defaultdict(lambda: 0)
+        for delta in self.deltas:
+            if not (delta.committed or id(delta) in pending):
+                continue
+            for affected_scope, quota_name in delta.get_affected_quotas():
+                if affected_scope._meta.concrete_model == scope_model and affected_scope.pk == scope.pk:
+                    usage_deltas[quota_name] += delta.value
+        return usage_deltas
+
+    def _get_pending_callbacks(self):
+        # Callbacks of rolled back savepoints are removed from connection.
+        return set(id(func) for _, func in getattr(connection, 'run_on_commit', []))
+
+    def _apply(self, coalesced):
+        scopes = OrderedDict()
+        scope_deltas = defaultdict(dict)
+        for (content_type_id, object_id, quota_name), (scope, value) in coalesced.items():
+            if value:
+                scopes[(content_type_id, object_id)] = scope
+                scope_deltas[(content_type_id, object_id)][quota_name] = value
+
+        with transaction.atomic():
+            for key, scope in scopes.items():
+                quota_deltas = scope_deltas[key]
+                quotas = scope.get_scope_quotas(quota_deltas.keys())
+                for quota_name, value in quota_deltas.items():
+                    if quota_name not in quotas:
+                        # Aggregator quota or its scope could be deleted after delta was collected.
+                        continue
+                    quotas.add_usage(quota_name, value)
+                quotas.save()
+
+
+class _DisabledPropagation(object):
+    """ Collects aggregator quotas that were affected while propagation is disabled. """
+
+    def __init__(self):
+        self.affected = OrderedDict()
+
+    def add(self, scope, quota_field):
+        content_type = ContentType.objects.get_for_model(scope)
+        self.affected[(content_type.id, scope.pk, quota_field.name)] = (scope, quota_field)
+
+    def recalculate(self):
+        for scope, quota_field in self.affected.values():
+            if scope.__class__.objects.filter(pk=scope.pk).exists():
+                quota_field.recalculate(scope)
+
+
+def get_buffer():
+    return getattr(_locals, 'buffer', None)
+
+
+def get_disabled_propagation():
+    return getattr(_locals, 'disabled', None)
+
+
+def get_usage_deltas(scope):
+    """ Return aggregator quotas usage deltas of scope that are not applied yet.
+
+        Quota usage validation has to take them into account, otherwise several changes
+        made during the same request or task could exceed ancestor quota limit.
+    """
+    buffer = get_buffer()
+    if buffer is None:
+        return {}
+    return buffer.get_usage_deltas(scope)
+
+
+def add_usage_delta(scope, quota_field, value):
+    """ Change usage of scope aggregator quota according to current propagation mode. """
+    disabled = get_disabled_propagation()
+    if disabled is not None:
+        disabled.add(scope, quota_field)
+        return
+
+    buffer = get_buffer()
+    if buffer is not None:
+        buffer.add(scope, quota_field, value)
+    else:
+        scope.apply_quota_usage_delta(quota_field.name, value)
+
+
+def open_buffer():
+    """ Start collecting aggregator quotas deltas. Nested calls reuse already opened buffer. """
+    _locals.buffer_depth = getattr(_locals, 'buffer_depth', 0) + 1
+    if _locals.buffer_depth == 1:
+        _locals.buffer = PropagationBuffer()
+
+
+def close_buffer(failed=False):
+    """ Apply collected deltas if the outermost buffer is closed.
+
+        If buffer is closed because of error only deltas of already committed changes are applied.
+    """
+    depth = getattr(_locals, 'buffer_depth', 0)
+    if depth > 1:
+        _locals.buffer_depth = depth - 1
+        return
+    if depth == 0:
+        return
+    # Buffer stays open during flush to collect changes of aggregators of aggregators.
+    try:
+        _locals.buffer.flush(committed_only=failed)
+    finally:
+        del _locals.buffer
+        _locals.buffer_depth = 0
+
+
+@contextmanager
+def deferred_propagation():
+    open_buffer()
+    try:
+        yield
+    except Exception:
+        close_buffer(failed=True)
+        raise
+    else:
+        close_buffer()
+
+
+@contextmanager
+def disabled_propagation(recalculate=False):
+    """ Do not propagate child quotas changes to aggregator quotas.
+
+        If recalculate is True, aggregator quotas that should have been changed are
+        recalculated on exit.
+    """
+    if get_disabled_propagation() is not None:
+        yield
+        return
+
+    disabled = _locals.disabled = _DisabledPropagation()
+    try:
+        yield
+    finally:
+        del _locals.disabled
+    if recalculate:
+        logger.info('Recalculating %s aggregator quotas after disabled propagation.', len(disabled.affected))
+        disabled.recalculate()
@@ -0,0 +1,337 @@
+""" Set-based recalculation of counter and aggregator quotas usage.
+
+Scopes of each quota model are split into batches. Counter quotas usage of a batch is
+computed with one GROUP BY query per (target model, path to scope), aggregator quotas
+usage is computed with one GROUP BY query over children quotas per (model, field) level by
+level in topological order of aggregation graph declared by fields children models, so
+aggregators of aggregators are calculated from already recalculated children.
+Changed usages are written with bulk UPDATE queries. Batches of the same level are
+independent and could be processed by a pool of worker processes.
+
+Note! Quotas are written directly in database, so post_save signals are not sent.
+History samples of changed quotas are created in bulk.
+"""
+from __future__ import unicode_literals
+
+import multiprocessing
+from collections import defaultdict
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models import Case, Count, FloatField, QuerySet, Sum, Value, When
+
+from waldur_core.quotas import exceptions, fields, models
+from waldur_core.quotas.utils import get_models_with_quotas
+
+BATCH_SIZE = 1000
+UPDATE_CHUNK_SIZE = 500
+
+
+class QuotaChange(object):
+    """ Usage change of a single quota. """
+
+    def __init__(self, content_type_id, object_id, name, old_usage, new_usage):
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.name = name
+        self.old_usage = old_usage
+        self.new_usage = new_usage
+
+    @property
+    def key(self):
+        return self.content_type_id, self.object_id, self.name
+
+    def __str__(self):
+        model = ContentType.objects.get_for_id(self.content_type_id).model_class()
+        return '%s #%s "%s": %s -> %s' % (
+            model.__name__, self.object_id, self.name, self.old_usage, self.new_usage)
+
+
+def get_quota_field(model, name):
+    return next(field for field in model.get_quotas_fields() if field.name == name)
+
+
+def get_aggregator_levels():
+    """ Group aggregator fields by levels of aggregation graph declared by fields children models.
+
+        Aggregators of the first level aggregate only non-aggregator quotas,
+        aggregators of the second level aggregate first level aggregators and so on.
+        Aggregators without declared children model form the last level.
+        Return list of levels, each level is list of (model, field) pairs.
+    """
+    levels = {}
+    undeclared = []
+
+    def get_level(model, field, visiting):
+        key = (model, field.name)
+        if not isinstance(field, fields.AggregatorQuotaField):
+            return 0
+        if key in levels:
+            return levels[key]
+        if key in visiting:
+            raise exceptions.QuotaError('Aggregator quotas graph has a cycle at %s.%s quota.' % (
+                model.__name__, field.name))
+        if field.child_model is None:
+            raise exceptions.QuotaError('Children model of %s.%s quota is not declared, so it could not '
+                                        'be aggregated by other aggregator quotas.' % (model.__name__, field.name))
+        visiting.add(key)
+        child_level = 0
+        if issubclass(field.child_model, models.QuotaModelMixin):
+            child_field_name = field.get_child_quota_name()
+            for child_field in field.child_model.get_quotas_fields():
+                if child_field.name == child_field_name:
+                    child_level = get_level(field.child_model, child_field, visiting)
+        levels[key] = child_level + 1
+        visiting.discard(key)
+        return levels[key]
+
+    result = defaultdict(list)
+    for model in get_models_with_quotas():
+        for field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
+            if field.child_model is None:
+                undeclared.append((model, field))
+            else:
+                result[get_level(model, field, set())].append((model, field))
+    levels = [result[level] for level in sorted(result)]
+    if undeclared:
+        levels.append(undeclared)
+    return levels
+
+
+def get_batches(model, batch_size=BATCH_SIZE):
+    ids = list(model.objects.order_by('pk').values_list('pk', flat=True))
+    return [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+
+def resolve_lookup_path(model, path):
+    """ Translate custom lookups of structure querysets (customer, project) to path of model fields. """
+    queryset = model.objects.all()
+    if hasattr(queryset, '_filter_by_custom_fields'):
+        path = list(queryset._filter_by_custom_fields(**{path: None}).keys())[0]
+    return path
+
+
+def compute_counter_usages(model, field, scope_ids, counts_cache=None):
+    """ Return dictionary {scope id: current usage} for given counter field. """
+    if counts_cache is None:
+        counts_cache = {}
+    if field.creation_condition is not None or field._raw_get_current_usage is not None:
+        # custom conditions and usage calculation could be evaluated only for each scope separately
+        usages = {}
+        for scope in model.objects.filter(pk__in=scope_ids):
+            if field.is_connected_to_scope(scope):
+                usages[scope.pk] = field.get_current_usage(field.target_models, scope)
+        return usages
+
+    usages = {scope_id: 0 for scope_id in scope_ids}
+    for target_model in field.target_models:
+        path = resolve_lookup_path(target_model, field.path_to_scope.replace('.', '__'))
+        cache_key = (target_model, path)
+        if cache_key not in counts_cache:
+            rows = (target_model.objects
+                    .filter(**{path + '__in': scope_ids})
+                    .order_by()
+                    .values(path)
+                    .annotate(count=Count('pk'))
+                    .values_list(path, 'count'))
+            counts_cache[cache_key] = dict(rows)
+        for scope_id, count in counts_cache[cache_key].items():
+            usages[scope_id] += count
+    return usages
+
+
+def compute_aggregator_usages(model, field, scope_ids, overlay=None):
+    """ Return dictionary {scope id: current usage} for given aggregator field.
+
+        Usage of scopes batch is computed with one GROUP BY query over children quotas
+        joined to the path from child to scope.
+
+        overlay - dictionary {(content type id, object id, quota name): QuotaChange} with computed
+                  but not written usages of children quotas (used for dry run).
+    """
+    overlay = overlay or {}
+    if field.path_to_scope is None or field.creation_condition is not None:
+        # custom children and conditions could be evaluated only for each scope separately
+        return compute_custom_aggregator_usages(model, field, scope_ids, overlay)
+
+    child_model = field.child_model
+    child_quota_name = field.get_child_quota_name()
+    path = resolve_lookup_path(child_model, field.path_to_scope.replace('.', '__'))
+    rows = (child_model.objects
+            .filter(**{path + '__in': scope_ids, 'quotas__name': child_quota_name})
+            .order_by()
+            .values(path)
+            .annotate(value=Sum('quotas__' + field.aggregation_field))
+            .values_list(path, 'value'))
+    usages = {scope_id: 0 for scope_id in scope_ids}
+    usages.update(rows)
+
+    if field.aggregation_field == 'usage' and overlay:
+        content_type = ContentType.objects.get_for_model(child_model)
+        changes = {key[1]: change for key, change in overlay.items()
+                   if key[0] == content_type.id and key[2] == child_quota_name}
+        if changes:
+            children = child_model.objects.filter(**{'pk__in': changes.keys(), path + '__in': scope_ids})
+            for child_id, scope_id in children.values_list('pk', path):
+                usages[scope_id] += changes[child_id].new_usage - changes[child_id].old_usage
+    return usages
+
+
+def compute_custom_aggregator_usages(model, field, scope_ids, overlay):
+    """ Return dictionary {scope id: current usage} for aggregator field with custom children.
+
+        Children quotas of all scopes are loaded with one query per children content type.
+    """
+    child_quota_name = field.get_child_quota_name()
+    scope_children = {}
+    for scope in model.objects.filter(pk__in=scope_ids):
+        if not field.is_connected_to_scope(scope):
+            continue
+        children = field.get_children(scope)
+        if isinstance(children, QuerySet):
+            content_type = ContentType.objects.get_for_model(children.model)
+            keys = [(content_type.id, pk) for pk in children.values_list('pk', flat=True)]
+        else:
+            keys = [(ContentType.objects.get_for_model(child).id, child.pk) for child in children]
+        scope_children[scope.pk] = keys
+
+    object_ids = defaultdict(set)
+    for keys in scope_children.values():
+        for content_type_id, object_id in keys:
+            object_ids[content_type_id].add(object_id)
+    values = {}
+    for content_type_id, ids in object_ids.items():
+        ids = list(ids)
+        for i in range(0, len(ids), BATCH_SIZE):
+            rows = models.Quota.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=ids[i:i + BATCH_SIZE],
+                name=child_quota_name,
+            ).values_list('object_id', field.aggregation_field)
+            values.update(((content_type_id, object_id), value) for object_id, value in rows)
+
+    usages = {}
+    for scope_id, keys in scope_children.items():
+        usage = 0
+        for content_type_id, object_id in keys:
+            change = overlay.get((content_type_id, object_id, child_quota_name))
+            if field.aggregation_field == 'usage' and change is not None:
+                usage += change.new_usage
+            else:
+                usage += values.get((content_type_id, object_id), 0)
+        usages[scope_id] = usage
+    return usages
+
+
+def write_usages(model, quota_name, usages, dry_run=False):
+    """ Write changed quotas usages with bulk UPDATE queries. Return list of changes. """
+    content_type = ContentType.objects.get_for_model(model)
+    current = models.Quota.objects.filter(
+        content_type=content_type, name=quota_name, object_id__in=usages.keys()
+    ).values_list('pk', 'object_id', 'usage', 'limit')
+
+    changes = []
+    changed_usages = {}
+    limits = {}
+    for pk, object_id, usage, limit in current:
+        new_usage = usages[object_id]
+        if usage != new_usage:
+            limits[pk] = limit
+            changes.append(QuotaChange(content_type.id, object_id, quota_name, usage, new_usage))
+            changed_usages[pk] = new_usage
+
+    if not dry_run and changed_usages:
+        pks = list(changed_usages.keys())
+        with transaction.atomic():
+            for i in range(0, len(pks), UPDATE_CHUNK_SIZE):
+                chunk = pks[i:i + UPDATE_CHUNK_SIZE]
+                whens = [When(pk=pk, then=Value(changed_usages[pk])) for pk in chunk]
+                models.Quota.objects.filter(pk__in=chunk).update(
+                    usage=Case(*whens, output_field=FloatField()))
+            models.QuotaSample.objects.bulk_create(
+                [models.QuotaSample(quota_id=pk, limit=limits[pk], usage=changed_usages[pk]) for pk in pks],
+                batch_size=UPDATE_CHUNK_SIZE)
+    return changes
+
+
+def recalculate_counters_batch(model_label, scope_ids, dry_run=False):
+    model = apps.get_model(model_label)
+    counts_cache = {}
+    changes = []
+    for field in model.get_quotas_fields(field_class=fields.CounterQuotaField):
+        usages = compute_counter_usages(model, field, scope_ids, counts_cache)
+        changes += write_usages(model, field.name, usages, dry_run=dry_run)
+    return changes
+
+
+def recalculate_aggregators_batch(model_label, field_names, scope_ids, dry_run=False, overlay=None):
+    model = apps.get_model(model_label)
+    changes = []
+    for field_name in field_names:
+        field = get_quota_field(model, field_name)
+        usages = compute_aggregator_usages(model, field, scope_ids, overlay)
+        changes += write_usages(model, field.name, usages, dry_run=dry_run)
+    return changes
+
+
+def _run_job(job):
+    function, args = job
+    return function(*args)
+
+
+class QuotaRecalculator(object):
+    """ Recalculate counter and aggregator quotas of all quota models.
+
+        workers - number of processes that handle scopes batches in parallel.
+        dry_run - compute new usages and report changes without writing them.
+    """
+
+    def __init__(self, workers=1, dry_run=False, batch_size=BATCH_SIZE):
+        self.workers = workers
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.changes = []
+        self.overlay = {}
+
+    def recalculate_counters(self):
+        jobs = []
+        for model in get_models_with_quotas():
+            if not model.get_quotas_fields(field_class=fields.CounterQuotaField):
+                continue
+            for batch in get_batches(model, self.batch_size):
+                jobs.append((recalculate_counters_batch, (model._meta.label, batch, self.dry_run)))
+        self._run(jobs)
+
+    def recalculate_aggregators(self):
+        for level in get_aggregator_levels():
+            field_names = defaultdict(list)
+            for model, field in level:
+                field_names[model].append(field.name)
+            jobs = []
+            # overlay is needed only if computed usages are not written to database
+            overlay = self.overlay if self.dry_run else None
+            for model, names in field_names.items():
+                for batch in get_batches(model, self.batch_size):
+                    jobs.append((recalculate_aggregators_batch,
+                                 (model._meta.label, names, batch, self.dry_run, overlay)))
+            self._run(jobs)
+
+    def _run(self, jobs):
+        if self.workers > 1 and len(jobs) > 1:
+            # Forked processes should not share database connections with parent process.
+            connections.close_all()
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                results = pool.map(_run_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_run_job(job) for job in jobs]
+
+        for changes in results:
+            self.changes += changes
+            if self.dry_run:
+                for change in changes:
+                    self.overlay[change.key] = change
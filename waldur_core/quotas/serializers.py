@@ -1,9 +1,51 @@
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
 
 from waldur_core.quotas import models, utils
 from waldur_core.core.serializers import GenericRelatedField
 
 
+class QuotaListSerializer(serializers.ListSerializer):
+    """
+    Loads scopes of quotas with one query per content type.
+    Only fields that are needed for scope URL are loaded.
+    """
+
+    def to_representation(self, data):
+        quotas = list(data.all() if hasattr(data, 'all') else data)
+        self.prefetch_scopes(quotas)
+        return super(QuotaListSerializer, self).to_representation(quotas)
+
+    def prefetch_scopes(self, quotas):
+        object_ids = defaultdict(set)
+        for quota in quotas:
+            # global quotas do not have scope
+            if quota.content_type_id is not None:
+                object_ids[quota.content_type_id].add(quota.object_id)
+
+        scopes = {}
+        for content_type_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                continue
+            try:
+                model._meta.get_field('uuid')
+            except FieldDoesNotExist:
+                fields = ('pk',)
+            else:
+                fields = ('pk', 'uuid')
+            for scope in model._base_manager.filter(pk__in=ids).only(*fields):
+                scopes[(content_type_id, scope.pk)] = scope
+
+        for quota in quotas:
+            scope = scopes.get((quota.content_type_id, quota.object_id))
+            if scope is not None:
+                quota.scope = scope
+
+
 class QuotaSerializer(serializers.HyperlinkedModelSerializer):
     scope = GenericRelatedField(related_models=utils.get_models_with_quotas(), read_only=True)
 
@@ -14,6 +56,7 @@ class QuotaSerializer(serializers.HyperlinkedModelSerializer):
         extra_kwargs = {
             'url': {'lookup_field': 'uuid'},
         }
+        list_serializer_class = QuotaListSerializer
 
 
 class BasicQuotaSerializer(serializers.HyperlinkedModelSerializer):
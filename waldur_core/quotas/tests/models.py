@@ -9,10 +9,17 @@ class GrandparentModel(core_models.UuidMixin, quotas_models.QuotaModelMixin, cor
         regular_quota = fields.QuotaField()
         quota_with_default_limit = fields.QuotaField(default_limit=100)
         usage_aggregator_quota = fields.UsageAggregatorQuotaField(
-            get_children=lambda scope: ChildModel.objects.filter(parent__parent=scope),
+            child_model=lambda: ChildModel,
+            path_to_scope='parent.parent',
         )
         limit_aggregator_quota = fields.LimitAggregatorQuotaField(
-            get_children=lambda scope: ChildModel.objects.filter(parent__parent=scope),
+            child_model=lambda: ChildModel,
+            path_to_scope='parent.parent',
+        )
+        # aggregates usage of parents limit aggregator quota
+        children_limit_quota = fields.UsageAggregatorQuotaField(
+            child_model=lambda: ParentModel,
+            path_to_scope='parent',
         )
 
     regular_quota = fields.QuotaLimitField(quota_field=Quotas.regular_quota)
@@ -36,16 +43,25 @@ class ParentModel(core_models.UuidMixin, quotas_models.QuotaModelMixin, core_mod
             get_delta=lambda scope: 10
         )
         usage_aggregator_quota = fields.UsageAggregatorQuotaField(
-            get_children=lambda scope: scope.children.all(),
+            child_model=lambda: ChildModel,
+            path_to_scope='parent',
         )
         limit_aggregator_quota = fields.LimitAggregatorQuotaField(
-            get_children=lambda scope: scope.children.all(),
+            child_model=lambda: ChildModel,
+            path_to_scope='parent',
             default_limit=0,
         )
+        # children are defined with custom function
         second_usage_aggregator_quota = fields.UsageAggregatorQuotaField(
-            get_children=lambda scope: scope.children.all(),
+            get_children=lambda scope: list(scope.children.all()),
+            child_model=lambda: ChildModel,
             child_quota_name='usage_aggregator_quota',
         )
+        children_limit_quota = fields.LimitAggregatorQuotaField(
+            child_model=lambda: ChildModel,
+            path_to_scope='parent',
+            child_quota_name='limit_aggregator_quota',
+        )
 
     def get_parents(self):
         return [self.parent]
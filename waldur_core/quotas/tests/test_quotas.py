@@ -1,9 +1,10 @@
 from datetime import timedelta
 
 from ddt import ddt, data
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework import test, status
-from reversion.models import Version
 
 from waldur_core.core import utils as core_utils
 from waldur_core.quotas.tests import factories
@@ -50,10 +51,8 @@ class QuotaHistoryTest(test.APITransactionTestCase):
 
         self.quota = factories.QuotaFactory(scope=self.customer)
         self.url = factories.QuotaFactory.get_url(self.quota, 'history')
-        # Hook for test: lets say that revision was created one hour ago
-        version = Version.objects.get_for_object(self.quota).filter(revision__date_created__lte=timezone.now()).first()
-        version.revision.date_created = timezone.now() - timedelta(hours=1)
-        version.revision.save()
+        # Hook for test: lets say that sample was created one hour ago
+        self.quota.samples.update(timestamp=timezone.now() - timedelta(hours=1))
 
     def test_old_version_of_quota_is_available(self):
         old_usage = self.quota.usage
@@ -90,4 +89,37 @@ class QuotaHistoryTest(test.APITransactionTestCase):
         self.assertEqual(response.data[2]['point'], end_timestamp)
 
 
+class QuotaListTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.staff = structure_factories.UserFactory(is_staff=True)
+        structure_factories.ProjectFactory.create_batch(3)
+        self.url = factories.QuotaFactory.get_list_url()
+
+    def test_quotas_are_paginated_by_cursor(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get(self.url, {'page_size': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 5)
+        self.assertIn('rel="next"', response['Link'])
+
+    def test_scope_url_is_rendered(self):
+        customer = structure_factories.CustomerFactory()
+        self.client.force_authenticate(self.staff)
+        response = self.client.get(self.url, {'page_size': 300})
+
+        scope_url = structure_factories.CustomerFactory.get_url(customer)
+        self.assertIn(scope_url, [quota['scope'] for quota in response.data])
+
+    def test_number_of_queries_does_not_depend_on_number_of_scopes(self):
+        self.client.force_authenticate(self.staff)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.url, {'page_size': 300})
+        queries_count = len(context.captured_queries)
+
+        structure_factories.ProjectFactory.create_batch(3)
+        with self.assertNumQueries(queries_count):
+            self.client.get(self.url, {'page_size': 300})
+
+
 # TODO: add CRUD tests for quota endpoint.
@@ -3,6 +3,7 @@ from rest_framework import test, status
 
 from waldur_core.logging.models import Alert
 from waldur_core.logging.tasks import check_threshold
+from waldur_core.quotas.models import Quota
 from waldur_core.quotas.tests.factories import QuotaFactory
 from waldur_core.structure.tests.factories import ProjectFactory, UserFactory
 
@@ -36,6 +37,46 @@ class QuotaThresholdAlertTest(test.APITestCase):
             object_id=self.project.id,
             alert_type='threshold_exceeded').exists())
 
+    def test_if_quota_usage_is_below_threshold_alert_is_closed(self):
+        self.quota.threshold = 100
+        self.quota.usage = 200
+        self.quota.save()
+        check_threshold()
+
+        self.quota.usage = 20
+        self.quota.save()
+        check_threshold()
+
+        self.assertFalse(Alert.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.project),
+            object_id=self.project.id,
+            alert_type='threshold_exceeded',
+            closed__isnull=True).exists())
+
+    def test_alerts_of_scopes_without_threshold_are_not_closed(self):
+        other_project = ProjectFactory()
+        alert = Alert.objects.create(
+            content_type=ContentType.objects.get_for_model(other_project),
+            object_id=other_project.id,
+            alert_type='threshold_exceeded',
+            severity=Alert.SeverityChoices.WARNING,
+            message='Threshold is exceeded.')
+
+        check_threshold()
+
+        alert.refresh_from_db()
+        self.assertIsNone(alert.closed)
+
+    def test_only_quotas_over_threshold_are_loaded(self):
+        self.quota.threshold = 100
+        self.quota.usage = 200
+        self.quota.save()
+        other_quota = ProjectFactory().quotas.get(name='nc_resource_count')
+        other_quota.threshold = 100
+        other_quota.save()
+
+        self.assertEqual(list(Quota.get_over_threshold_objects()), [self.quota])
+
     def test_user_can_update_threshold(self):
         self.client.force_authenticate(UserFactory(is_staff=True))
 
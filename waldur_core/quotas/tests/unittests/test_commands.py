@@ -1,5 +1,6 @@
 from django.core.management import call_command
 from django.test import TestCase
+from django.utils.six import StringIO
 
 from waldur_core.structure.tests import factories as structure_factories
 
@@ -23,3 +24,21 @@ class RecalculateCommandTest(TestCase):
 
         call_command('recalculatequotas')
         self.assertEqual(customer.quotas.get(name='nc_resource_count').usage, 0)
+
+    def test_dry_run_does_not_change_quotas(self):
+        customer = structure_factories.CustomerFactory()
+        structure_factories.ProjectFactory(customer=customer)
+
+        customer.quotas.filter(name='nc_project_count').update(usage=10)
+
+        out = StringIO()
+        call_command('recalculatequotas', dry_run=True, stdout=out)
+        self.assertEqual(customer.quotas.get(name='nc_project_count').usage, 10)
+        self.assertIn('Customer #%s "nc_project_count": 10.0 -> 1' % customer.id, out.getvalue())
+
+    def test_missing_quotas_are_initialized(self):
+        customer = structure_factories.CustomerFactory()
+        customer.quotas.filter(name='nc_project_count').delete()
+
+        call_command('recalculatequotas')
+        self.assertTrue(customer.quotas.filter(name='nc_project_count').exists())
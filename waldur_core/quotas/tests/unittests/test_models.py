@@ -1,9 +1,13 @@
 import random
+from datetime import timedelta
 
+from django.db.models import signals
 from django.test import TestCase
+from django.utils import timezone
 
-from ..models import GrandparentModel
+from ..models import ChildModel, GrandparentModel, ParentModel
 from ... import exceptions
+from ...models import Quota, QuotaSample
 
 
 class QuotaModelMixinTest(TestCase):
@@ -79,3 +83,235 @@ class QuotaModelMixinTest(TestCase):
         sum_of_quotas = GrandparentModel.get_sum_of_quotas_as_dict(
             instances, quota_names=['regular_quota'], fields=['limit'])
         self.assertEqual({'regular_quota': -1}, sum_of_quotas)
+
+
+class InitQuotasTest(TestCase):
+
+    def setUp(self):
+        self.grandparent = GrandparentModel.objects.create()
+        self.parent = ParentModel.objects.create(parent=self.grandparent)
+
+    def create_children(self, count):
+        ChildModel.objects.bulk_create([ChildModel(parent=self.parent) for _ in range(count)])
+        return list(ChildModel.objects.filter(parent=self.parent))
+
+    def test_missing_quotas_are_created_for_scopes_created_in_bulk(self):
+        children = self.create_children(3)
+
+        created = ChildModel.init_quotas(children)
+
+        self.assertEqual(len(created), 3 * len(ChildModel.get_quotas_names()))
+        for child in children:
+            self.assertEqual(sorted(child.quotas.values_list('name', flat=True)),
+                             sorted(ChildModel.get_quotas_names()))
+            self.assertEqual(child.quotas.get(name='limit_aggregator_quota').limit, 0)
+
+    def test_quotas_are_created_with_constant_number_of_queries(self):
+        children = self.create_children(10)
+
+        # existing quotas, savepoint, insert, reload, samples, savepoint release
+        with self.assertNumQueries(6):
+            ChildModel.init_quotas(children)
+
+    def test_existing_quotas_are_not_changed(self):
+        child = ChildModel.objects.create(parent=self.parent)
+        child.set_quota_usage('regular_quota', 5)
+
+        self.assertEqual(ChildModel.init_quotas([child]), [])
+        self.assertEqual(child.quotas.get(name='regular_quota').usage, 5)
+
+    def test_quotas_with_failed_creation_condition_are_skipped(self):
+        children = self.create_children(2)
+        field = ChildModel.Quotas.regular_quota
+        field.creation_condition = lambda scope: scope.pk == children[0].pk
+        try:
+            ChildModel.init_quotas(children)
+        finally:
+            field.creation_condition = None
+
+        self.assertTrue(children[0].quotas.filter(name='regular_quota').exists())
+        self.assertFalse(children[1].quotas.filter(name='regular_quota').exists())
+
+    def test_history_samples_are_created(self):
+        children = self.create_children(2)
+
+        created = ChildModel.init_quotas(children)
+
+        self.assertEqual(QuotaSample.objects.filter(quota__in=created).count(), len(created))
+
+    def test_initial_values_are_propagated_to_aggregator_quotas(self):
+        field = ChildModel.Quotas.limit_aggregator_quota
+        field.default_limit = 7
+        try:
+            ChildModel.init_quotas(self.create_children(2))
+        finally:
+            field.default_limit = 0
+
+        self.assertEqual(self.parent.quotas.get(name='limit_aggregator_quota').usage, 14)
+        self.assertEqual(self.grandparent.quotas.get(name='limit_aggregator_quota').usage, 14)
+
+
+class ScopeQuotasTest(TestCase):
+
+    def setUp(self):
+        self.instance = GrandparentModel.objects.create()
+
+    def test_all_quotas_are_loaded_with_one_query(self):
+        with self.assertNumQueries(1):
+            quotas = self.instance.get_scope_quotas()
+            for name in GrandparentModel.get_quotas_names():
+                quotas.get(name)
+                self.assertEqual(quotas.get(name).scope, self.instance)
+
+    def test_changed_quotas_are_written_back(self):
+        quotas = self.instance.get_scope_quotas()
+        quotas.set_limit('regular_quota', 20)
+        quotas.add_usage('quota_with_default_limit', 5)
+        quotas.save()
+
+        self.assertEqual(self.instance.quotas.get(name='regular_quota').limit, 20)
+        self.assertEqual(self.instance.quotas.get(name='quota_with_default_limit').usage, 5)
+        self.assertEqual(self.instance.quotas.get(name='quota_with_default_limit').limit, 100)
+
+    def test_nothing_is_written_if_quotas_were_not_changed(self):
+        quotas = self.instance.get_scope_quotas()
+        quotas.set_limit('quota_with_default_limit', 100)
+        with self.assertNumQueries(0):
+            quotas.save()
+
+    def test_quota_samples_are_created_on_save(self):
+        quotas = self.instance.get_scope_quotas()
+        quotas.set_usage('regular_quota', 13)
+        quotas.save()
+
+        quota = self.instance.quotas.get(name='regular_quota')
+        self.assertEqual(quota.samples.latest('timestamp').usage, 13)
+
+    def test_missing_quota_raises_does_not_exist_error(self):
+        quotas = self.instance.get_scope_quotas(['regular_quota'])
+        self.assertRaises(Quota.DoesNotExist, quotas.get, 'quota_with_default_limit')
+
+    def test_add_usage_validates_quota_limit(self):
+        quotas = self.instance.get_scope_quotas()
+        self.assertRaises(exceptions.QuotaValidationError,
+                          quotas.add_usage, 'quota_with_default_limit', 200, validate=True)
+
+    def test_validate_quota_change_returns_exceeded_quotas(self):
+        errors = self.instance.validate_quota_change({'quota_with_default_limit': 200, 'regular_quota': 200})
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('quota_with_default_limit'))
+
+    def test_usage_deltas_are_applied_atomically(self):
+        quotas = self.instance.get_scope_quotas()
+        # usage is changed concurrently after snapshot was loaded
+        self.instance.set_quota_usage('regular_quota', 10)
+        quotas.add_usage('regular_quota', 5)
+        quotas.save()
+
+        self.assertEqual(quotas.get('regular_quota').usage, 15)
+        self.assertEqual(self.instance.quotas.get(name='regular_quota').usage, 15)
+
+    def test_usage_delta_is_kept_if_the_same_usage_is_set(self):
+        quotas = self.instance.get_scope_quotas()
+        quotas.add_usage('regular_quota', 5)
+        quotas.set_usage('regular_quota', quotas.get('regular_quota').usage)
+        quotas.save()
+
+        self.assertEqual(self.instance.quotas.get(name='regular_quota').usage, 5)
+
+    def test_usage_delta_is_replaced_if_other_usage_is_set(self):
+        quotas = self.instance.get_scope_quotas()
+        quotas.add_usage('regular_quota', 5)
+        quotas.set_usage('regular_quota', 3)
+        quotas.save()
+
+        self.assertEqual(self.instance.quotas.get(name='regular_quota').usage, 3)
+
+
+class ApplyQuotaUsageDeltaTest(TestCase):
+
+    def setUp(self):
+        self.instance = GrandparentModel.objects.create()
+
+    def test_usage_is_increased_in_database(self):
+        quota = self.instance.quotas.get(name='regular_quota')
+        self.instance.set_quota_usage('regular_quota', 10)
+
+        exceeded = self.instance.apply_quota_usage_delta('regular_quota', 5)
+
+        self.assertFalse(exceeded)
+        quota.refresh_from_db()
+        self.assertEqual(quota.usage, 15)
+
+    def test_usage_is_not_changed_if_limit_is_exceeded(self):
+        self.instance.set_quota_usage('quota_with_default_limit', 90)
+
+        exceeded = self.instance.apply_quota_usage_delta('quota_with_default_limit', 20, validate=True)
+
+        self.assertTrue(exceeded)
+        self.assertEqual(self.instance.quotas.get(name='quota_with_default_limit').usage, 90)
+
+    def test_usage_could_reach_limit(self):
+        self.instance.set_quota_usage('quota_with_default_limit', 90)
+
+        exceeded = self.instance.apply_quota_usage_delta('quota_with_default_limit', 10, validate=True)
+
+        self.assertFalse(exceeded)
+        self.assertEqual(self.instance.quotas.get(name='quota_with_default_limit').usage, 100)
+
+    def test_negative_delta_is_not_validated(self):
+        self.instance.set_quota_usage('quota_with_default_limit', 200)
+
+        exceeded = self.instance.apply_quota_usage_delta('quota_with_default_limit', -10, validate=True)
+
+        self.assertFalse(exceeded)
+        self.assertEqual(self.instance.quotas.get(name='quota_with_default_limit').usage, 190)
+
+    def test_quota_sample_is_created(self):
+        self.instance.apply_quota_usage_delta('regular_quota', 7)
+
+        quota = self.instance.quotas.get(name='regular_quota')
+        self.assertEqual(quota.samples.latest('timestamp').usage, 7)
+
+    def test_missing_quota_raises_does_not_exist_error(self):
+        self.assertRaises(Quota.DoesNotExist, self.instance.apply_quota_usage_delta, 'unknown_quota', 1)
+
+    def test_post_save_handlers_receive_previous_usage(self):
+        self.instance.set_quota_usage('regular_quota', 10)
+        changes = []
+
+        def handler(sender, instance, **kwargs):
+            changes.append((instance.tracker.previous('usage'), instance.usage))
+
+        signals.post_save.connect(handler, sender=Quota)
+        try:
+            self.instance.apply_quota_usage_delta('regular_quota', 5)
+        finally:
+            signals.post_save.disconnect(handler, sender=Quota)
+
+        self.assertEqual(changes, [(10, 15)])
+
+
+class QuotaSampleManagerTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        instance = GrandparentModel.objects.create()
+        self.quota = instance.quotas.get(name='regular_quota')
+        self.quota.samples.all().delete()
+        for hours, usage in ((3, 1), (2, 2), (1, 3)):
+            QuotaSample.objects.create(
+                quota=self.quota, timestamp=self.now - timedelta(hours=hours), limit=10, usage=usage)
+
+    def get_values(self, *hours):
+        points = [self.now - timedelta(hours=h) for h in hours]
+        return QuotaSample.objects.get_values_at([self.quota.id], points)[self.quota.id]
+
+    def test_value_is_taken_from_the_latest_sample_before_point(self):
+        self.assertEqual(self.get_values(2.5, 1.5, 0), [(10, 1), (10, 2), (10, 3)])
+
+    def test_value_is_none_if_there_are_no_samples_before_point(self):
+        self.assertEqual(self.get_values(4, 0.5), [None, (10, 3)])
+
+    def test_values_are_loaded_with_one_query(self):
+        with self.assertNumQueries(1):
+            self.get_values(2.5, 1.5, 0.5)
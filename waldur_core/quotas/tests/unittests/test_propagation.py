@@ -0,0 +1,116 @@
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from .. import models as test_models
+from ... import propagation
+
+
+class PropagationTest(TestCase):
+
+    def setUp(self):
+        self.grandparent = test_models.GrandparentModel.objects.create()
+        self.parent = test_models.ParentModel.objects.create(parent=self.grandparent)
+        self.children = [test_models.ChildModel.objects.create(parent=self.parent) for _ in range(3)]
+        self.quota_name = 'usage_aggregator_quota'
+
+    def set_children_usage(self, usage):
+        for child in self.children:
+            child.set_quota_usage(self.quota_name, usage)
+
+    def get_usage(self, scope):
+        return scope.quotas.get(name=self.quota_name).usage
+
+    def test_deltas_are_applied_on_buffer_close(self):
+        with propagation.deferred_propagation():
+            self.set_children_usage(10)
+            self.assertEqual(self.get_usage(self.parent), 0)
+            self.assertEqual(self.get_usage(self.grandparent), 0)
+
+        self.assertEqual(self.get_usage(self.parent), 30)
+        self.assertEqual(self.get_usage(self.grandparent), 30)
+
+    def test_deltas_are_coalesced_per_ancestor_quota(self):
+        with propagation.deferred_propagation():
+            self.set_children_usage(10)
+            buffer = propagation.get_buffer()
+            # each child quota is aggregated by two parent quotas and one grandparent quota
+            self.assertEqual(len(buffer.deltas), 9)
+            with CaptureQueriesContext(connection) as context:
+                buffer.flush()
+
+        updates = [q['sql'] for q in context.captured_queries if q['sql'].startswith('UPDATE "quotas_quota"')]
+        # one UPDATE per ancestor scope
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(self.get_usage(self.parent), 30)
+        self.assertEqual(self.get_usage(self.grandparent), 30)
+
+    def test_nested_buffers_are_flushed_once(self):
+        with propagation.deferred_propagation():
+            with propagation.deferred_propagation():
+                self.set_children_usage(10)
+            self.assertEqual(self.get_usage(self.parent), 0)
+
+        self.assertEqual(self.get_usage(self.parent), 30)
+
+    def test_rolled_back_changes_are_not_propagated(self):
+        with propagation.deferred_propagation():
+            self.set_children_usage(10)
+            try:
+                with transaction.atomic():
+                    self.children[0].set_quota_usage(self.quota_name, 20)
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        self.assertEqual(self.children[0].quotas.get(name=self.quota_name).usage, 10)
+        self.assertEqual(self.get_usage(self.parent), 30)
+
+    def test_disabled_propagation_does_not_change_aggregator_quotas(self):
+        with propagation.disabled_propagation():
+            self.set_children_usage(10)
+
+        self.assertEqual(self.get_usage(self.parent), 0)
+
+    def test_aggregator_quotas_are_recalculated_after_disabled_propagation(self):
+        with propagation.disabled_propagation(recalculate=True):
+            self.set_children_usage(10)
+            self.assertEqual(self.get_usage(self.parent), 0)
+
+        self.assertEqual(self.get_usage(self.parent), 30)
+        self.assertEqual(self.get_usage(self.grandparent), 30)
+
+    def test_validation_takes_into_account_deltas_that_are_not_propagated(self):
+        self.parent.set_quota_limit(self.quota_name, 40)
+        with propagation.deferred_propagation():
+            self.set_children_usage(10)
+
+            self.assertEqual(len(self.parent.validate_quota_change({self.quota_name: 20})), 1)
+            self.assertEqual(self.parent.validate_quota_change({self.quota_name: 10}), [])
+            self.assertTrue(self.parent.apply_quota_usage_delta(self.quota_name, 20, validate=True))
+
+    def test_validation_takes_into_account_deltas_of_grandparent_aggregator_of_aggregator(self):
+        # grandparent quota aggregates parent aggregator quota that is changed only on flush
+        quota_name = 'children_limit_quota'
+        self.grandparent.set_quota_limit(quota_name, 40)
+        with propagation.deferred_propagation():
+            for child in self.children:
+                child.set_quota_limit('limit_aggregator_quota', 10)
+
+            self.assertEqual(self.grandparent.quotas.get(name=quota_name).usage, 0)
+            self.assertEqual(len(self.grandparent.validate_quota_change({quota_name: 20})), 1)
+            self.assertEqual(self.grandparent.validate_quota_change({quota_name: 10}), [])
+
+        self.assertEqual(self.grandparent.quotas.get(name=quota_name).usage, 30)
+
+    def test_validation_skips_deltas_of_rolled_back_changes(self):
+        self.parent.set_quota_limit(self.quota_name, 40)
+        with propagation.deferred_propagation():
+            try:
+                with transaction.atomic():
+                    self.set_children_usage(10)
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            self.assertEqual(self.parent.validate_quota_change({self.quota_name: 20}), [])
@@ -0,0 +1,93 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from .. import models as test_models
+from ... import recalculation
+
+
+class QuotaRecalculatorTest(TestCase):
+
+    def setUp(self):
+        self.grandparent = test_models.GrandparentModel.objects.create()
+
+    def create_parents(self, count):
+        parents = []
+        for _ in range(count):
+            parent = test_models.ParentModel.objects.create(parent=self.grandparent)
+            test_models.ChildModel.objects.create(parent=parent)
+            parent.quotas.filter(name='counter_quota').update(usage=10)
+            parents.append(parent)
+        return parents
+
+    def count_queries(self, parents):
+        ids = [parent.pk for parent in parents]
+        with CaptureQueriesContext(connection) as context:
+            recalculation.recalculate_counters_batch(test_models.ParentModel._meta.label, ids)
+        return len(context.captured_queries)
+
+    def test_number_of_queries_does_not_depend_on_number_of_scopes(self):
+        self.assertEqual(self.count_queries(self.create_parents(2)), self.count_queries(self.create_parents(5)))
+
+    def test_counter_usage_is_recalculated(self):
+        parent = self.create_parents(1)[0]
+
+        changes = recalculation.recalculate_counters_batch(test_models.ParentModel._meta.label, [parent.pk])
+
+        self.assertEqual(parent.quotas.get(name='counter_quota').usage, 1)
+        self.assertIn(('counter_quota', 10, 1), [(c.name, c.old_usage, c.new_usage) for c in changes])
+
+    def test_dry_run_does_not_write_usages(self):
+        parent = self.create_parents(1)[0]
+
+        recalculator = recalculation.QuotaRecalculator(dry_run=True)
+        recalculator.recalculate_counters()
+
+        self.assertEqual(parent.quotas.get(name='counter_quota').usage, 10)
+        self.assertTrue(recalculator.changes)
+
+    def test_aggregators_are_recalculated_after_their_children(self):
+        parent = self.create_parents(1)[0]
+        child = parent.children.first()
+        child.quotas.filter(name='usage_aggregator_quota').update(usage=5)
+
+        recalculation.QuotaRecalculator().recalculate_aggregators()
+
+        self.assertEqual(parent.quotas.get(name='usage_aggregator_quota').usage, 5)
+        self.assertEqual(parent.quotas.get(name='second_usage_aggregator_quota').usage, 5)
+        self.assertEqual(self.grandparent.quotas.get(name='usage_aggregator_quota').usage, 5)
+
+    def count_aggregator_queries(self, parents):
+        ids = [parent.pk for parent in parents]
+        with CaptureQueriesContext(connection) as context:
+            recalculation.recalculate_aggregators_batch(
+                test_models.ParentModel._meta.label, ['usage_aggregator_quota'], ids, dry_run=True)
+        return len(context.captured_queries)
+
+    def test_number_of_aggregator_queries_does_not_depend_on_number_of_scopes(self):
+        self.assertEqual(self.count_aggregator_queries(self.create_parents(2)),
+                         self.count_aggregator_queries(self.create_parents(5)))
+
+    def test_aggregator_levels_are_detected_without_scopes_in_database(self):
+        test_models.GrandparentModel.objects.all().delete()
+
+        levels = [set((model, field.name) for model, field in level)
+                  for level in recalculation.get_aggregator_levels()]
+
+        self.assertIn((test_models.ParentModel, 'children_limit_quota'), levels[0])
+        self.assertIn((test_models.GrandparentModel, 'children_limit_quota'), levels[1])
+
+    def test_dry_run_aggregates_computed_usages_of_children(self):
+        parent = self.create_parents(1)[0]
+        child = parent.children.first()
+        child.quotas.filter(name='limit_aggregator_quota').update(limit=7)
+
+        recalculator = recalculation.QuotaRecalculator(dry_run=True)
+        recalculator.recalculate_aggregators()
+
+        changes = {(c.content_type_id, c.object_id, c.name): c.new_usage for c in recalculator.changes}
+        grandparent_key = (ContentType.objects.get_for_model(self.grandparent).id,
+                           self.grandparent.pk, 'children_limit_quota')
+        self.assertEqual(changes[grandparent_key], 7)
+        self.assertEqual(self.grandparent.quotas.get(name='children_limit_quota').usage, 0)
@@ -4,10 +4,8 @@ from django.utils.translation import ugettext_lazy as _
 from rest_framework import exceptions as rf_exceptions, decorators, response, status
 from rest_framework import mixins
 from rest_framework import viewsets
-from reversion import revisions as reversion
-from reversion.models import Version
 
-from waldur_core.core.pagination import UnlimitedLinkHeaderPagination
+from waldur_core.core.pagination import LinkHeaderCursorPagination
 from waldur_core.core.serializers import HistorySerializer
 from waldur_core.core.utils import datetime_to_timestamp
 from waldur_core.quotas import models, serializers, filters, exceptions
@@ -18,8 +16,7 @@ class QuotaViewSet(mixins.UpdateModelMixin,
     queryset = models.Quota.objects.all()
     serializer_class = serializers.QuotaSerializer
     lookup_field = 'uuid'
-    # XXX: Remove a custom pagination class once the quota calculation has been made more efficient
-    pagination_class = UnlimitedLinkHeaderPagination
+    pagination_class = LinkHeaderCursorPagination
     filter_class = filters.QuotaFilterSet
 
     def get_queryset(self):
@@ -29,7 +26,8 @@ class QuotaViewSet(mixins.UpdateModelMixin,
         """
         To get an actual value for object quotas limit and usage issue a **GET** request against */api/<objects>/*.
 
-        To get all quotas visible to the user issue a **GET** request against */api/quotas/*
+        To get all quotas visible to the user issue a **GET** request against */api/quotas/*.
+        Quotas are paginated by cursor, use links from **Link** header to get next or previous page.
         """
         return super(QuotaViewSet, self).list(request, *args, **kwargs)
 
@@ -137,16 +135,14 @@ class QuotaViewSet(mixins.UpdateModelMixin,
 
         quota = self.get_object()
         serializer = self.get_serializer(quota)
+        points = history_serializer.get_filter_data()
+        values = models.QuotaSample.objects.get_values_at([quota.id], points)[quota.id]
         serialized_versions = []
-        for point_date in history_serializer.get_filter_data():
+        for point_date, value in zip(points, values):
             serialized = {'point': datetime_to_timestamp(point_date)}
-            version = Version.objects.get_for_object(quota).filter(revision__date_created__lte=point_date)
-            if version.exists():
-                # make copy of serialized data and update field that are stored in version
-                version_object = version.first()._object_version.object
+            if value is not None:
+                # make copy of serialized data and update fields that are stored in history
                 serialized['object'] = serializer.data.copy()
-                serialized['object'].update({
-                    f: getattr(version_object, f) for f in quota.get_version_fields()
-                })
+                serialized['object']['limit'], serialized['object']['usage'] = value
             serialized_versions.append(serialized)
         return response.Response(serialized_versions, status=status.HTTP_200_OK)
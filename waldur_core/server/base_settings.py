@@ -63,6 +63,7 @@ MIDDLEWARE = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'waldur_core.logging.middleware.CaptureEventContextMiddleware',
+    'waldur_core.quotas.middleware.DeferredQuotaPropagationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -214,12 +215,19 @@ CELERYBEAT_SCHEDULE = {
         'args': (),
     },
     'recalculate-price-estimates': {
-        'task': 'waldur_core.cost_tracking.recalculate_estimate',
+        'task': 'waldur_core.cost_tracking.schedule_estimate_recalculation',
         # To avoid bugs and unexpected behavior - do not re-calculate estimates
         # right in the end of the month.
         'schedule': crontab(minute=10),
         'args': (),
     },
+    'reconcile-price-estimates': {
+        'task': 'waldur_core.cost_tracking.schedule_estimate_recalculation',
+        # Hourly recalculation processes only changed estimates,
+        # full recalculation fixes estimates that were missed.
+        'schedule': crontab(minute=40, hour=2),
+        'kwargs': {'full': True},
+    },
     'close-alerts-without-scope': {
         'task': 'waldur_core.logging.close_alerts_without_scope',
         'schedule': timedelta(minutes=30),
@@ -245,6 +253,8 @@ CELERYBEAT_SCHEDULE = {
 # Logging
 # Send verified request on webhook processing
 VERIFY_WEBHOOK_REQUESTS = True
+# Compile and emit events in background thread, see waldur_core.logging.loggers.AsyncEventEmitter
+ASYNC_EVENTS_EMISSION = False
 
 
 # Extensions
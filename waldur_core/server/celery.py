@@ -57,3 +57,16 @@ def bind_event_context(sender=None, **kwargs):
 @signals.task_postrun.connect
 def unbind_event_context(sender=None, **kwargs):
     reset_event_context()
+
+
+# Aggregator quotas changes are collected during task execution and applied once after the task.
+@signals.task_prerun.connect
+def open_quota_propagation_buffer(sender=None, **kwargs):
+    from waldur_core.quotas import propagation
+    propagation.open_buffer()
+
+
+@signals.task_postrun.connect
+def close_quota_propagation_buffer(sender=None, **kwargs):
+    from waldur_core.quotas import propagation
+    propagation.close_buffer(failed=kwargs.get('state') == 'FAILURE')
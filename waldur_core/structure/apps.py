@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 from django.db.models import signals
 from django_fsm import signals as fsm_signals
 
@@ -12,8 +12,8 @@ class StructureConfig(AppConfig):
     def ready(self):
         from waldur_core.core.models import CoordinatesMixin
         from waldur_core.structure.executors import check_cleanup_executors
-        from waldur_core.structure.models import ResourceMixin, Service, TagMixin, VirtualMachine
-        from waldur_core.structure import handlers
+        from waldur_core.structure.models import ResourceMixin, Service, ServiceProjectLink, TagMixin, VirtualMachine
+        from waldur_core.structure import handlers, managers
         from waldur_core.structure import signals as structure_signals
 
         from django.core import checks
@@ -104,6 +104,99 @@ class StructureConfig(AppConfig):
             dispatch_uid='waldur_core.structure.handlers.log_project_role_updated',
         )
 
+        for model in structure_models_with_roles:
+            structure_signals.structure_role_granted.connect(
+                handlers.clean_permitted_ids_cache_on_role_change,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.clean_permitted_ids_cache_on_%s_role_granted' %
+                             model.__name__,
+            )
+
+            structure_signals.structure_role_revoked.connect(
+                handlers.clean_permitted_ids_cache_on_role_change,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.clean_permitted_ids_cache_on_%s_role_revoked' %
+                             model.__name__,
+            )
+
+        for model in (CustomerPermission, ProjectPermission):
+            signals.post_save.connect(
+                handlers.clean_permitted_ids_cache_on_permission_change,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.clean_permitted_ids_cache_on_%s_save' % model.__name__,
+            )
+
+            signals.post_delete.connect(
+                handlers.clean_permitted_ids_cache_on_permission_change,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.clean_permitted_ids_cache_on_%s_delete' % model.__name__,
+            )
+
+        for index, model in enumerate([Project] + Service.get_all_models()):
+            signals.post_save.connect(
+                handlers.clean_permitted_events_uuids_cache_on_customer_scope_save,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.'
+                             'clean_permitted_events_uuids_cache_on_customer_scope_save_{}_{}'.format(
+                                 model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.clean_permitted_events_uuids_cache_on_customer_scope_delete,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.'
+                             'clean_permitted_events_uuids_cache_on_customer_scope_delete_{}_{}'.format(
+                                 model.__name__, index),
+            )
+
+        for index, model in enumerate(ServiceProjectLink.get_all_models()):
+            signals.post_save.connect(
+                handlers.clean_permitted_events_uuids_cache_on_link_save,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.'
+                             'clean_permitted_events_uuids_cache_on_link_save_{}_{}'.format(
+                                 model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.clean_permitted_events_uuids_cache_on_link_delete,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.'
+                             'clean_permitted_events_uuids_cache_on_link_delete_{}_{}'.format(
+                                 model.__name__, index),
+            )
+
+        scope_models = [model for model in apps.get_models() if managers.has_visibility_rules(model)]
+        for index, model in enumerate(scope_models):
+            signals.post_save.connect(
+                handlers.update_scope_visibility,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.update_scope_visibility_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.delete_scope_visibility,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.delete_scope_visibility_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+        for index, model in enumerate(managers.get_visibility_links()):
+            signals.post_save.connect(
+                handlers.update_related_scope_visibility,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.update_related_scope_visibility_on_save_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.update_related_scope_visibility,
+                sender=model,
+                dispatch_uid='waldur_core.structure.handlers.update_related_scope_visibility_on_delete_{}_{}'.format(
+                    model.__name__, index),
+            )
+
         signals.pre_delete.connect(
             handlers.revoke_roles_on_project_deletion,
             sender=Project,
@@ -3,15 +3,17 @@ from __future__ import unicode_literals
 import logging
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 
 from waldur_core.core import utils
 from waldur_core.core.tasks import send_task
 from waldur_core.core.models import StateMixin
-from waldur_core.structure import SupportedServices, signals
+from waldur_core.logging.loggers import clean_permitted_events_uuids_cache
+from waldur_core.structure import SupportedServices, managers, signals
 from waldur_core.structure.log import event_logger
-from waldur_core.structure.models import (Customer, CustomerPermission, Project, ProjectPermission,
-                                          Service, ServiceSettings)
+from waldur_core.structure.models import (Customer, CustomerPermission, CustomerRole, Project, ProjectPermission,
+                                          ScopeVisibility, Service, ServiceSettings)
 
 
 logger = logging.getLogger(__name__)
@@ -342,3 +344,60 @@ def clean_tags_cache_after_tagged_item_saved(sender, instance, **kwargs):
 
 def clean_tags_cache_before_tagged_item_deleted(sender, instance, **kwargs):
     instance.content_object.clean_tag_cache()
+
+
+def clean_permitted_ids_cache_on_role_change(sender, user, **kwargs):
+    managers.clean_permitted_ids_cache(user)
+
+
+def clean_permitted_ids_cache_on_permission_change(sender, instance, **kwargs):
+    try:
+        user = instance.user
+    except ObjectDoesNotExist:
+        # permission is deleted together with user
+        return
+    managers.clean_permitted_ids_cache(user)
+
+
+def _clean_permitted_events_uuids_cache(permissions):
+    for permission in permissions.filter(is_active=True).select_related('user'):
+        clean_permitted_events_uuids_cache(permission.user)
+
+
+def clean_permitted_events_uuids_cache_on_customer_scope_save(sender, instance, created=False, **kwargs):
+    """ Projects and services of customer are found by their own terms for customer roles other than owner. """
+    if created:
+        clean_permitted_events_uuids_cache_on_customer_scope_delete(sender, instance)
+
+
+def clean_permitted_events_uuids_cache_on_customer_scope_delete(sender, instance, **kwargs):
+    permissions = CustomerPermission.objects.filter(customer_id=instance.customer_id)
+    _clean_permitted_events_uuids_cache(permissions.exclude(role=CustomerRole.OWNER))
+
+
+def clean_permitted_events_uuids_cache_on_link_save(sender, instance, created=False, **kwargs):
+    """ Services linked to project are found by service terms for project members. """
+    if created:
+        clean_permitted_events_uuids_cache_on_link_delete(sender, instance)
+
+
+def clean_permitted_events_uuids_cache_on_link_delete(sender, instance, **kwargs):
+    _clean_permitted_events_uuids_cache(ProjectPermission.objects.filter(project_id=instance.project_id))
+
+
+def update_scope_visibility(sender, instance, created=False, update_fields=None, **kwargs):
+    if not created and update_fields and not managers.get_visibility_fields(sender) & set(update_fields):
+        return
+    ScopeVisibility.objects.update_for_objects(sender, [instance.pk])
+
+
+def delete_scope_visibility(sender, instance, **kwargs):
+    ScopeVisibility.objects.delete_for_objects(sender, [instance.pk])
+
+
+def update_related_scope_visibility(sender, instance, **kwargs):
+    """ Update index of objects that are visible through instance, for example, customer of project. """
+    for model, link_field in managers.get_visibility_links().get(sender, []):
+        object_id = getattr(instance, link_field.attname)
+        if object_id is not None:
+            ScopeVisibility.objects.update_for_objects(model, [object_id])
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from waldur_core.structure.managers import get_visibility_indexed_models
+from waldur_core.structure.models import ScopeVisibility
+
+
+class Command(BaseCommand):
+    help = """ Rebuild index of customers and projects that give access to structure objects """
+
+    def handle(self, *args, **options):
+        for model in get_visibility_indexed_models():
+            ScopeVisibility.objects.rebuild([model])
+            self.stdout.write('Visibility index of %s objects is rebuilt' % model.__name__)
@@ -1,8 +1,67 @@
+from collections import defaultdict
 from operator import or_
 
-from django.db import models
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils.lru_cache import lru_cache
 
 from waldur_core.core.managers import GenericKeyMixin, SummaryQuerySet
+from waldur_core.logging.loggers import clean_permitted_events_uuids_cache
+
+
+PERMITTED_IDS_CACHE_TIMEOUT = 60 * 60
+
+
+def _get_permitted_ids_cache_key(user):
+    return 'permitted_ids:%s' % user.uuid.hex
+
+
+def get_permitted_ids(user):
+    """ Return ids of customers and projects where user has active role.
+
+        Result is cached per user and has format {entity: {role: [object ids]}}, for example:
+        {
+            'customer': {'owner': [1, 2]},
+            'project': {'admin': [3], 'manager': [4]},
+        }
+        Cache is invalidated when user role is granted, revoked or changed.
+        Expired permissions are revoked by check_expired_permissions task.
+    """
+    key = _get_permitted_ids_cache_key(user)
+    permitted_ids = cache.get(key)
+    if permitted_ids is None:
+        from waldur_core.structure.models import CustomerPermission, ProjectPermission
+
+        permitted_ids = {}
+        for entity, permission_model in (('customer', CustomerPermission), ('project', ProjectPermission)):
+            ids = defaultdict(list)
+            rows = permission_model.objects.filter(user=user, is_active=True).values_list('role', entity + '_id')
+            for role, object_id in rows:
+                ids[role].append(object_id)
+            permitted_ids[entity] = dict(ids)
+        cache.set(key, permitted_ids, PERMITTED_IDS_CACHE_TIMEOUT)
+    return permitted_ids
+
+
+def clean_permitted_ids_cache(user):
+    key = _get_permitted_ids_cache_key(user)
+    cache.delete(key)
+    # Concurrent request could cache permissions before transaction is committed.
+    transaction.on_commit(lambda: cache.delete(key))
+    # Events terms are also used for hooks routing.
+    clean_permitted_events_uuids_cache(user)
+
+
+def _is_many_valued_path(model, path):
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        if field.many_to_many or field.one_to_many:
+            return True
+        model = field.related_model
+    return False
 
 
 def filter_queryset_for_user(queryset, user):
@@ -11,6 +70,13 @@ def filter_queryset_for_user(queryset, user):
     if user is None or user.is_staff or user.is_support:
         return queryset
 
+    try:
+        permissions = queryset.model.Permissions
+    except AttributeError:
+        return queryset
+
+    permitted_ids = get_permitted_ids(user)
+
     def create_q(entity):
         try:
             path = getattr(permissions, '%s_path' % entity)
@@ -18,26 +84,20 @@ def filter_queryset_for_user(queryset, user):
             return None
 
         role = getattr(permissions, '%s_role' % entity, None)
-
-        if path == 'self':
-            prefix = ''
+        if role:
+            ids = permitted_ids[entity].get(role, [])
         else:
-            prefix = path + '__'
-
-        kwargs = {
-            prefix + 'permissions__user': user,
-            prefix + 'permissions__is_active': True
-        }
+            ids = sum(permitted_ids[entity].values(), [])
 
-        if role:
-            kwargs[prefix + 'permissions__role'] = role
+        if path == 'self':
+            return models.Q(pk__in=ids)
 
-        return models.Q(**kwargs)
+        if _is_many_valued_path(queryset.model, path):
+            # Filtering through to-many relation produces duplicates, so subquery is used instead of DISTINCT.
+            subquery = queryset.model._base_manager.filter(**{path + '__in': ids}).values('pk')
+            return models.Q(pk__in=subquery)
 
-    try:
-        permissions = queryset.model.Permissions
-    except AttributeError:
-        return queryset
+        return models.Q(**{path + '__in': ids})
 
     q_objects = [q_object for q_object in (
         create_q(entity) for entity in filtered_relations
@@ -52,17 +112,12 @@ def filter_queryset_for_user(queryset, user):
     else:
         q_objects.append(models.Q(**extra_q))
 
-    try:
-        # Whether both customer and project filtering requested?
-        any_of_q = reduce(or_, q_objects)
-        return queryset.filter(any_of_q).distinct()
-    except TypeError:
-        # Or any of customer and project filtering requested?
-        return queryset.filter(q_objects[0])
-    except IndexError:
+    if not q_objects:
         # Looks like no filters are there
         return queryset
 
+    return queryset.filter(reduce(or_, q_objects))
+
 
 class StructureQueryset(models.QuerySet):
     """ Provides additional filtering by customer or project (based on permission definition).
@@ -177,3 +232,172 @@ class PrivateServiceSettingsManager(ServiceSettingsManager):
 
     def get_queryset(self):
         return super(PrivateServiceSettingsManager, self).get_queryset().filter(shared=False)
+
+
+def get_visibility_paths(model):
+    """ Return dictionary {entity: path} of model paths to customer and project. """
+    permissions = getattr(model, 'Permissions', None)
+    paths = {}
+    for entity in ('customer', 'project'):
+        path = getattr(permissions, '%s_path' % entity, None)
+        if path:
+            paths[entity] = path
+    return paths
+
+
+def has_visibility_rules(model):
+    permissions = getattr(model, 'Permissions', None)
+    return bool(get_visibility_paths(model) or getattr(permissions, 'extra_query', None))
+
+
+@lru_cache(maxsize=1)
+def get_visibility_indexed_models():
+    """ Return concrete models that are filtered by permissions and should be stored in visibility index. """
+    return [model for model in apps.get_models() if not model._meta.proxy and has_visibility_rules(model)]
+
+
+def get_visibility_dependencies(model):
+    """ Return list of (link model, link field) pairs for to-many paths of model to customer or project.
+
+        For example, customer is visible for project members, so customer index
+        should be updated when project is created or deleted: (Project, customer field).
+        Only the first relation of path is tracked, changes of deeper relations
+        are not expected and could be fixed with rebuildscopevisibility command.
+    """
+    dependencies = []
+    for path in get_visibility_paths(model).values():
+        if path == 'self':
+            continue
+        field = model._meta.get_field(path.split('__')[0])
+        if field.one_to_many:
+            dependencies.append((field.related_model, field.field))
+        elif field.many_to_many:
+            through = field.remote_field.through if field.concrete else field.through
+            for through_field in through._meta.get_fields():
+                if through_field.many_to_one and through_field.related_model == model:
+                    dependencies.append((through, through_field))
+    return dependencies
+
+
+@lru_cache(maxsize=1)
+def get_visibility_links():
+    """ Return dictionary {link model: [(indexed model, link field)]}, see get_visibility_dependencies. """
+    links = defaultdict(list)
+    for model in get_visibility_indexed_models():
+        for link_model, link_field in get_visibility_dependencies(model):
+            links[link_model].append((model, link_field))
+    return dict(links)
+
+
+def get_visibility_fields(model):
+    """ Return names of model fields that affect its visibility index rows. """
+    permissions = getattr(model, 'Permissions', None)
+    lookups = list(get_visibility_paths(model).values()) + list(getattr(permissions, 'extra_query', None) or [])
+    return {lookup.split('__')[0] for lookup in lookups}
+
+
+class ScopeVisibilityManager(models.Manager):
+    """ Denormalized index of customers and projects that give access to objects of structure models.
+
+        Index rows are built from Permissions class of model, so models of plugins are indexed
+        automatically. Index allows to filter rows with generic foreign key (quotas, alerts)
+        for user with one subquery instead of separate permissions subquery for each scope model.
+    """
+
+    def _get_rows(self, model, object_ids):
+        permissions = model.Permissions
+        queryset = model.objects.filter(pk__in=object_ids)
+        rows = set()
+        for entity, path in get_visibility_paths(model).items():
+            role = getattr(permissions, '%s_role' % entity, None) or ''
+            if path == 'self':
+                values = ((object_id, object_id) for object_id in queryset.values_list('pk', flat=True))
+            else:
+                values = queryset.values_list('pk', path)
+            for object_id, entity_id in values:
+                if entity_id is not None:
+                    customer_id = entity_id if entity == 'customer' else None
+                    project_id = entity_id if entity == 'project' else None
+                    rows.add((object_id, customer_id, project_id, role, False))
+
+        extra_q = getattr(permissions, 'extra_query', None)
+        if extra_q:
+            for object_id in queryset.filter(**extra_q).values_list('pk', flat=True):
+                rows.add((object_id, None, None, '', True))
+        return rows
+
+    def _create_rows(self, content_type, rows):
+        self.bulk_create(self.model(
+            content_type=content_type,
+            object_id=object_id,
+            customer_id=customer_id,
+            project_id=project_id,
+            role=role,
+            is_shared=is_shared,
+        ) for object_id, customer_id, project_id, role, is_shared in rows)
+
+    def update_for_objects(self, model, object_ids):
+        """ Synchronize index rows of given objects with their current relations. """
+        model = model._meta.concrete_model
+        content_type = ContentType.objects.get_for_model(model)
+        rows = self._get_rows(model, object_ids)
+        index = self.filter(content_type=content_type, object_id__in=object_ids)
+        existing_rows = set(index.values_list('object_id', 'customer_id', 'project_id', 'role', 'is_shared'))
+        if rows == existing_rows:
+            return
+        with transaction.atomic():
+            index.delete()
+            self._create_rows(content_type, rows)
+
+    def delete_for_objects(self, model, object_ids):
+        content_type = ContentType.objects.get_for_model(model)
+        self.filter(content_type=content_type, object_id__in=object_ids).delete()
+
+    def rebuild(self, scope_models=None):
+        """ Recreate index rows of all objects of given models (all indexed models by default). """
+        if scope_models is None:
+            scope_models = get_visibility_indexed_models()
+        for model in scope_models:
+            content_type = ContentType.objects.get_for_model(model)
+            object_ids = model.objects.values_list('pk', flat=True)
+            with transaction.atomic():
+                self.filter(content_type=content_type).delete()
+                self._create_rows(content_type, self._get_rows(model, object_ids))
+
+    def _get_visibility_query(self, user):
+        permitted_ids = get_permitted_ids(user)
+        query = models.Q(is_shared=True)
+        for entity in ('customer', 'project'):
+            ids_by_role = permitted_ids[entity]
+            all_ids = sum(ids_by_role.values(), [])
+            if all_ids:
+                query |= models.Q(role='', **{entity + '_id__in': all_ids})
+            for role, ids in ids_by_role.items():
+                query |= models.Q(role=role, **{entity + '_id__in': ids})
+        return query
+
+    def filter_for_user(self, queryset, user, scope_models):
+        """ Filter queryset of model with generic foreign key by visibility of its scope for user.
+
+            scope_models - models that could be scopes of queryset objects. Objects of scope
+            models that are not filtered by permissions are visible for all users.
+        """
+        if user is None or user.is_staff or user.is_support:
+            return queryset
+
+        indexed_models = get_visibility_indexed_models()
+        restricted_ids = set()
+        unrestricted_ids = set()
+        for model in scope_models:
+            content_type_id = ContentType.objects.get_for_model(model).id
+            if model._meta.concrete_model in indexed_models:
+                restricted_ids.add(content_type_id)
+            else:
+                unrestricted_ids.add(content_type_id)
+
+        visible_ids = (self.filter(self._get_visibility_query(user), content_type_id=OuterRef('content_type_id'))
+                       .values('object_id'))
+        return queryset.filter(
+            models.Q(content_type_id__in=unrestricted_ids) |
+            models.Q(content_type_id__in=restricted_ids, object_id__in=Subquery(visible_ids))
+        )
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Index is built from Permissions classes of current models, which are not available
+# in historical models, so it is filled with rebuildscopevisibility command after migration.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('structure', '0054_payment_details'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScopeVisibility',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('role', models.CharField(blank=True, max_length=30)),
+                ('is_shared', models.BooleanField(default=False)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType')),
+                ('customer', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='structure.Customer')),
+                ('project', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='structure.Project')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='scopevisibility',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -32,8 +32,8 @@ from waldur_core.core.validators import validate_name, validate_cidr_list, FileT
 from waldur_core.monitoring.models import MonitoringModelMixin
 from waldur_core.quotas import models as quotas_models, fields as quotas_fields
 from waldur_core.logging.loggers import LoggableMixin
-from waldur_core.structure.managers import StructureManager, filter_queryset_for_user, \
-    ServiceSettingsManager, PrivateServiceSettingsManager, SharedServiceSettingsManager
+from waldur_core.structure.managers import StructureManager, filter_queryset_for_user, get_permitted_ids, \
+    ServiceSettingsManager, PrivateServiceSettingsManager, SharedServiceSettingsManager, ScopeVisibilityManager
 from waldur_core.structure.signals import structure_role_granted, structure_role_revoked
 from waldur_core.structure.images import ImageModelMixin
 from waldur_core.structure import SupportedServices
@@ -83,6 +83,17 @@ class StructureLoggableMixin(LoggableMixin):
         key = core_utils.camel_case_to_underscore(cls.__name__) + '_uuid'
         return {key: uuids}
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        """
+        Events of objects connected to customer or project contain customer and project UUIDs
+        in their context, so they are found by customer and project terms.
+        """
+        permissions = getattr(cls, 'Permissions', None)
+        if hasattr(permissions, 'customer_path') or hasattr(permissions, 'project_path'):
+            return {}
+        return cls.get_permitted_objects_uuids(user)
+
 
 class TagMixin(models.Model):
     """
@@ -450,6 +461,11 @@ class Customer(core_models.UuidMixin,
             )
         return {'customer_uuid': filter_queryset_for_user(customer_queryset, user).values_list('uuid', flat=True)}
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        owned_ids = get_permitted_ids(user)['customer'].get(CustomerRole.OWNER, [])
+        return {'customer_uuid': cls.objects.filter(id__in=owned_ids).values_list('uuid', flat=True)}
+
     def __str__(self):
         return '%(name)s (%(abbreviation)s)' % {
             'name': self.name,
@@ -622,6 +638,16 @@ class Project(core_models.DescribableMixin,
     def get_log_fields(self):
         return ('uuid', 'customer', 'name')
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        # Projects of owned customers are found by customer terms.
+        permitted_ids = get_permitted_ids(user)
+        customer_ids = [customer_id for role, ids in permitted_ids['customer'].items()
+                        if role != CustomerRole.OWNER for customer_id in ids]
+        project_ids = sum(permitted_ids['project'].values(), [])
+        projects = cls.objects.filter(Q(id__in=project_ids) | Q(customer_id__in=customer_ids))
+        return {'project_uuid': projects.values_list('uuid', flat=True)}
+
     def get_parents(self):
         return [self.customer]
 
@@ -633,6 +659,28 @@ class Project(core_models.DescribableMixin,
             m.objects.filter(project=self) for m in ServiceProjectLink.get_all_models())
 
 
+class ScopeVisibility(models.Model):
+    """ Row of index that maps object of structure model to customer or project that gives access to it.
+
+        Object could have several rows, for example, customer is visible for its owners
+        and for members of all its projects. Row with is_shared flag makes object visible
+        for all users. Rows are maintained by signal handlers, see ScopeVisibilityManager.
+    """
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    # Index rows of deleted customers and projects are removed by handlers of scope objects,
+    # database constraints are not used because rows could be updated during cascade deletion.
+    customer = models.ForeignKey('structure.Customer', related_name='+', null=True, db_constraint=False)
+    project = models.ForeignKey('structure.Project', related_name='+', null=True, db_constraint=False)
+    role = models.CharField(max_length=30, blank=True)
+    is_shared = models.BooleanField(default=False)
+
+    objects = ScopeVisibilityManager()
+
+    class Meta(object):
+        index_together = ('content_type', 'object_id')
+
+
 @python_2_unicode_compatible
 class ServiceCertification(core_models.UuidMixin, core_models.DescribableMixin):
     link = models.URLField(max_length=255, blank=True)
@@ -721,6 +769,16 @@ class ServiceSettings(quotas_models.ExtendableQuotaModelMixin,
     def get_log_fields(self):
         return ('uuid', 'name', 'customer')
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        """
+        Settings of owned customers are found by customer terms. Shared settings and settings
+        visible to other customer roles do not have matching terms, so they are found by UUID.
+        """
+        owned_ids = get_permitted_ids(user)['customer'].get(CustomerRole.OWNER, [])
+        service_settings = filter_queryset_for_user(cls.objects.all(), user).exclude(customer_id__in=owned_ids)
+        return {'service_settings_uuid': service_settings.values_list('uuid', flat=True)}
+
     def _get_log_context(self, entity_name):
         context = super(ServiceSettings, self)._get_log_context(entity_name)
         context['service_settings_type'] = self.get_type_display()
@@ -806,6 +864,17 @@ class Service(core_models.UuidMixin,
     def get_log_fields(self):
         return ('uuid', 'customer', 'settings')
 
+    @classmethod
+    def get_permitted_events_uuids(cls, user):
+        """
+        Service events do not contain project UUID, so services that are visible
+        to customer support or to members of linked projects are found by UUID.
+        Services of owned customers are found by customer terms.
+        """
+        owned_ids = get_permitted_ids(user)['customer'].get(CustomerRole.OWNER, [])
+        services = filter_queryset_for_user(cls.objects.all(), user).exclude(customer_id__in=owned_ids)
+        return {'service_uuid': services.values_list('uuid', flat=True)}
+
     def _get_log_context(self, entity_name):
         context = super(Service, self)._get_log_context(entity_name)
         context['service_type'] = SupportedServices.get_name_for_model(self)
@@ -1058,12 +1127,11 @@ class ResourceMixin(MonitoringModelMixin,
 
         # XXX: a hack for IaaS / PaaS / SaaS tags
         # XXX: should be moved to itacloud assembly
-        if self.tags.filter(name='IaaS').exists():
-            context['resource_delivery_model'] = 'IaaS'
-        elif self.tags.filter(name='PaaS').exists():
-            context['resource_delivery_model'] = 'PaaS'
-        elif self.tags.filter(name='SaaS').exists():
-            context['resource_delivery_model'] = 'SaaS'
+        tags = self.get_tags()
+        for delivery_model in ('IaaS', 'PaaS', 'SaaS'):
+            if delivery_model in tags:
+                context['resource_delivery_model'] = delivery_model
+                break
 
         return context
 
@@ -0,0 +1,138 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from waldur_core.quotas.models import Quota
+from waldur_core.structure import managers, models
+from waldur_core.structure.tests import factories
+
+
+class PermittedIdsCacheTest(TestCase):
+    def setUp(self):
+        self.user = factories.UserFactory()
+        self.customer = factories.CustomerFactory()
+        self.project = factories.ProjectFactory(customer=self.customer)
+
+    def test_permitted_ids_are_cached(self):
+        self.customer.add_user(self.user, models.CustomerRole.OWNER)
+        managers.get_permitted_ids(self.user)
+
+        with self.assertNumQueries(0):
+            permitted_ids = managers.get_permitted_ids(self.user)
+
+        self.assertEqual(permitted_ids['customer'], {models.CustomerRole.OWNER: [self.customer.id]})
+        self.assertEqual(permitted_ids['project'], {})
+
+    def test_cache_is_invalidated_when_role_is_granted(self):
+        managers.get_permitted_ids(self.user)
+        self.project.add_user(self.user, models.ProjectRole.ADMINISTRATOR)
+
+        permitted_ids = managers.get_permitted_ids(self.user)
+        self.assertEqual(permitted_ids['project'], {models.ProjectRole.ADMINISTRATOR: [self.project.id]})
+
+    def test_cache_is_invalidated_when_role_is_revoked(self):
+        self.project.add_user(self.user, models.ProjectRole.ADMINISTRATOR)
+        managers.get_permitted_ids(self.user)
+        self.project.remove_user(self.user)
+
+        self.assertEqual(managers.get_permitted_ids(self.user)['project'], {})
+
+    def test_cache_is_invalidated_when_permission_is_deleted(self):
+        self.project.add_user(self.user, models.ProjectRole.ADMINISTRATOR)
+        managers.get_permitted_ids(self.user)
+        models.ProjectPermission.objects.filter(user=self.user).delete()
+
+        self.assertEqual(managers.get_permitted_ids(self.user)['project'], {})
+
+
+class FilterQuerysetForUserTest(TestCase):
+    def setUp(self):
+        self.user = factories.UserFactory()
+        self.customer = factories.CustomerFactory()
+        self.customer.add_user(self.user, models.CustomerRole.OWNER)
+        self.project = factories.ProjectFactory(customer=self.customer)
+        self.project.add_user(self.user, models.ProjectRole.ADMINISTRATOR)
+        self.other_project = factories.ProjectFactory()
+
+    def test_queryset_is_filtered_without_permission_joins(self):
+        queryset = managers.filter_queryset_for_user(models.Project.objects.all(), self.user)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(list(queryset), [self.project])
+
+        sql = context.captured_queries[0]['sql']
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotIn('permission', sql)
+
+    def test_user_without_roles_does_not_see_objects(self):
+        user = factories.UserFactory()
+        queryset = managers.filter_queryset_for_user(models.Project.objects.all(), user)
+        self.assertFalse(queryset.exists())
+
+    def test_customer_is_listed_once_for_user_with_several_roles(self):
+        factories.ProjectFactory(customer=self.customer).add_user(self.user, models.ProjectRole.MANAGER)
+
+        queryset = managers.filter_queryset_for_user(models.Customer.objects.all(), self.user)
+        self.assertEqual(list(queryset), [self.customer])
+
+
+class ScopeVisibilityTest(TestCase):
+    def setUp(self):
+        self.customer = factories.CustomerFactory()
+        self.project = factories.ProjectFactory(customer=self.customer)
+
+    def get_rows(self, scope):
+        content_type = ContentType.objects.get_for_model(scope)
+        return set(models.ScopeVisibility.objects.filter(content_type=content_type, object_id=scope.pk)
+                   .values_list('customer_id', 'project_id', 'is_shared'))
+
+    def test_index_is_created_for_new_object(self):
+        self.assertEqual(self.get_rows(self.project), {(self.customer.id, None, False), (None, self.project.id, False)})
+
+    def test_customer_index_is_updated_when_project_is_created_or_deleted(self):
+        self.assertIn((None, self.project.id, False), self.get_rows(self.customer))
+
+        self.project.delete()
+        self.assertEqual(self.get_rows(self.customer), {(self.customer.id, None, False)})
+
+    def test_shared_flag_is_updated(self):
+        service_settings = factories.ServiceSettingsFactory(customer=None, shared=False)
+        self.assertEqual(self.get_rows(service_settings), set())
+
+        service_settings.shared = True
+        service_settings.save()
+        self.assertEqual(self.get_rows(service_settings), {(None, None, True)})
+
+    def test_index_is_deleted_with_object(self):
+        customer = factories.CustomerFactory()
+        customer.delete()
+        self.assertEqual(self.get_rows(customer), set())
+
+    def test_rebuild_restores_index(self):
+        models.ScopeVisibility.objects.all().delete()
+        models.ScopeVisibility.objects.rebuild()
+        self.assertEqual(self.get_rows(self.project), {(self.customer.id, None, False), (None, self.project.id, False)})
+
+
+class FilterForUserTest(TestCase):
+    def setUp(self):
+        self.user = factories.UserFactory()
+        self.project = factories.ProjectFactory()
+        self.project.add_user(self.user, models.ProjectRole.ADMINISTRATOR)
+        self.other_project = factories.ProjectFactory()
+
+    def test_quotas_are_filtered_by_scope_visibility(self):
+        quotas = Quota.objects.filtered_for_user(self.user)
+
+        self.assertTrue(quotas.filter(object_id=self.project.id).exists())
+        self.assertTrue(quotas.filter(object_id=self.project.customer.id).exists())
+        self.assertFalse(quotas.filter(object_id=self.other_project.id).exists())
+        self.assertFalse(quotas.filter(object_id=self.other_project.customer.id).exists())
+
+    def test_quotas_are_filtered_with_one_subquery(self):
+        with CaptureQueriesContext(connection) as context:
+            list(Quota.objects.filtered_for_user(self.user))
+
+        sql = context.captured_queries[-1]['sql']
+        self.assertEqual(sql.count('SELECT'), 2)
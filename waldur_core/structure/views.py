@@ -2,11 +2,12 @@ from __future__ import unicode_literals
 
 import time
 import logging
-from collections import defaultdict
+import operator
 from functools import partial
 
 from django.conf import settings as django_settings
 from django.contrib import auth
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 from django.db.models import Q
 from django.http import Http404
@@ -20,7 +21,6 @@ from rest_framework import serializers as rf_serializers
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import PermissionDenied, MethodNotAllowed, NotFound, APIException, ValidationError
 from rest_framework.response import Response
-from reversion.models import Version
 
 from waldur_core.core import managers as core_managers
 from waldur_core.core import mixins as core_mixins
@@ -32,7 +32,7 @@ from waldur_core.core import views as core_views
 from waldur_core.core.utils import datetime_to_timestamp, sort_dict
 from waldur_core.logging import models as logging_models
 from waldur_core.logging.loggers import expand_alert_groups
-from waldur_core.quotas.models import QuotaModelMixin, Quota
+from waldur_core.quotas.models import QuotaModelMixin, Quota, QuotaSample
 from waldur_core.structure import (
     SupportedServices, ServiceBackendError, ServiceBackendNotImplemented,
     filters, managers, models, permissions, serializers)
@@ -1793,28 +1793,27 @@ class QuotaTimelineStatsView(views.APIView):
         ranges = self.get_ranges(request)
         items = request.query_params.getlist('item') or self.get_all_spls_quotas()
 
-        collector = QuotaTimelineCollector()
-        for item in items:
-            for scope in scopes:
-                values = self.get_stats_for_scope(item, scope, ranges)
-                for (end, start), (limit, usage) in zip(ranges, values):
-                    collector.add_quota(start, end, item, limit, usage)
+        collector = QuotaTimelineCollector(ranges)
+        for quota_name, values in self.get_stats(items, scopes, ranges):
+            collector.add_quota(quota_name, values)
 
         stats = map(sort_dict, collector.to_dict())[::-1]
         return Response(stats, status=status.HTTP_200_OK)
 
     def get_quota_scopes(self, request):
+        """ Return querysets of quotas scopes. Scopes are not loaded, querysets are used as subqueries. """
         serializer = serializers.AggregateSerializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
-        scopes = sum([list(qs) for qs in serializer.get_service_project_links(request.user)], [])
-        # XXX: quick and dirty hack for OpenStack: use tenants instead of SPLs as quotas scope.
-        new_scopes = []
-        for index, scope in enumerate(scopes):
-            if scope.service.settings.type == 'OpenStack':
-                new_scopes += list(scope.tenants.all())
-            else:
-                new_scopes.append(scope)
-        return new_scopes
+        scopes = []
+        for queryset in serializer.get_service_project_links(request.user):
+            # XXX: quick and dirty hack for OpenStack: use tenants instead of SPLs as quotas scope.
+            if hasattr(queryset.model, 'tenants'):
+                tenants_field = queryset.model.tenants.field
+                openstack_links = queryset.filter(service__settings__type='OpenStack')
+                scopes.append(tenants_field.model.objects.filter(**{tenants_field.name + '__in': openstack_links}))
+                queryset = queryset.exclude(service__settings__type='OpenStack')
+            scopes.append(queryset)
+        return scopes
 
     def get_all_spls_quotas(self):
         # XXX: quick and dirty hack for OpenStack: use tenants instead of SPLs as quotas scope.
@@ -1822,25 +1821,29 @@ class QuotaTimelineStatsView(views.APIView):
                       for m in models.ServiceProjectLink.get_all_models()]
         return sum([spl_model.get_quotas_names() for spl_model in spl_models], [])
 
-    def get_stats_for_scope(self, quota_name, scope, dates):
-        stats_data = []
-        try:
-            quota = scope.quotas.get(name=quota_name)
-        except Quota.DoesNotExist:
-            return stats_data
-        versions = Version.objects.get_for_object(quota).select_related('revision').filter(
-            revision__date_created__lte=dates[0][0]).iterator()
-        version = None
-        for end, start in dates:
-            try:
-                while version is None or version.revision.date_created > end:
-                    version = versions.next()
-                stats_data.append((version._object_version.object.limit,
-                                   version._object_version.object.usage))
-            except StopIteration:
-                break
-
-        return stats_data
+    def get_stats(self, quota_names, scopes, dates):
+        """ Return list of (quota name, values) pairs, values are (limit, usage) at the end of each date range.
+
+            Quotas of all scopes are selected with one query and their history samples
+            are loaded in batches, so number of queries does not depend on number of scopes.
+            Values are returned until the first range without quota history.
+        """
+        if not scopes:
+            return []
+        query = reduce(operator.or_, (
+            Q(content_type=ContentType.objects.get_for_model(queryset.model), object_id__in=queryset.values('pk'))
+            for queryset in scopes))
+        quotas = list(Quota.objects.filter(query, name__in=quota_names).values_list('id', 'name'))
+
+        points = [end for end, start in dates]
+        values = QuotaSample.objects.get_values_at([quota_id for quota_id, _ in quotas], points)
+        stats = []
+        for quota_id, quota_name in quotas:
+            quota_values = values[quota_id]
+            if None in quota_values:
+                quota_values = quota_values[:quota_values.index(None)]
+            stats.append((quota_name, quota_values))
+        return stats
 
     def get_ranges(self, request):
         mapped = {
@@ -1878,33 +1881,40 @@ class QuotaTimelineCollector(object):
             }
         ]
     """
-    def __init__(self):
-        self.ranges = set()
-        self.items = set()
-        self.limits = defaultdict(int)
-        self.usages = defaultdict(int)
-
-    def add_quota(self, start, end, item, limit, usage):
-        key = (start, end, item)
-        if limit == -1 or self.limits[key] == -1:
-            self.limits[key] = -1
-        else:
-            self.limits[key] += limit
-        self.usages[key] += usage
-        self.ranges.add((start, end))
-        self.items.add(item)
+    def __init__(self, ranges):
+        # ranges are (end, start) pairs ordered from the latest to the earliest one
+        self.ranges = ranges
+        self.filled_ranges_count = 0
+        self.limits = {}
+        self.usages = {}
+
+    def add_quota(self, item, values):
+        """ Add quota (limit, usage) values of the first len(values) ranges to item totals.
+            If any quota limit is -1, total limit is -1 too.
+        """
+        if not values:
+            return
+        limits = self.limits.setdefault(item, [0] * len(self.ranges))
+        usages = self.usages.setdefault(item, [0] * len(self.ranges))
+        for index, (limit, usage) in enumerate(values):
+            if limit == -1 or limits[index] == -1:
+                limits[index] = -1
+            else:
+                limits[index] += limit
+            usages[index] += usage
+        self.filled_ranges_count = max(self.filled_ranges_count, len(values))
 
     def to_dict(self):
         table = []
-        for start, end in sorted(self.ranges):
+        for index in reversed(range(self.filled_ranges_count)):
+            end, start = self.ranges[index]
             row = {
                 'from': datetime_to_timestamp(start),
                 'to': datetime_to_timestamp(end)
             }
-            for item in sorted(self.items):
-                key = (start, end, item)
-                row['%s_limit' % item] = self.limits[key]
-                row['%s_usage' % item] = self.usages[key]
+            for item in sorted(self.limits):
+                row['%s_limit' % item] = self.limits[item][index]
+                row['%s_usage' % item] = self.usages[item][index]
             table.append(row)
         return table
 